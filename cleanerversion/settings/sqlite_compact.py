@@ -0,0 +1,7 @@
+"""
+Django settings for testing CleanerVersion with compact (binary) UUID storage.
+"""
+
+from .sqlite import *
+
+VERSIONS_COMPACT_UUID_STORAGE = True
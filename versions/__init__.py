@@ -0,0 +1,35 @@
+def batch(using=None, timestamp=None):
+    """
+    Returns a context manager recording the changes made to Versionable
+    objects (clone(), save(), delete() and adding or removing many-to-many
+    relations) while it is active, and writing them with a few bulk
+    statements per model when it exits.
+
+    :param str using: database alias to use.  If None, the database for
+        writing each model is used.
+    :param datetime timestamp: timestamp of the versions created and
+        terminated by the batch.  Defaults to the time the batch is entered.
+    :return: versions.unitofwork.VersionedBatch
+    """
+    from versions.unitofwork import VersionedBatch
+    return VersionedBatch(using=using, timestamp=timestamp)
+
+
+def snapshot(time, queryset, follow=()):
+    """
+    Loads the objects of a queryset and the objects reachable from them
+    through the given versioned relations, all as of the same point in time.
+
+    Each relation is read with a single query, and the related objects are
+    cached on the loaded objects, so that accessing the relations does not
+    query the database.  Every loaded object has the point in time as its
+    query time.
+
+    :param datetime time: the point in time; None for the current state
+    :param queryset: the root objects
+    :param follow: relation paths to follow, like the lookups of
+        prefetch_related(), e.g. ['team__city', 'awards']
+    :return: list of the root objects
+    """
+    from versions.graph import SnapshotLoader
+    return SnapshotLoader(time, using=queryset.db).load(queryset, follow)
@@ -5,6 +5,7 @@ from django.db.models.deletion import (
 )
 
 import versions.models
+from versions.settings import settings as versions_settings
 
 
 class VersionedCollector(Collector):
@@ -110,6 +111,7 @@ class VersionedCollector(Collector):
                 instances.reverse()
 
             # delete instances
+            events = []
             for model, instances in self.data.items():
                 if self.is_versionable(model):
                     for instance in instances:
@@ -118,6 +120,8 @@ class VersionedCollector(Collector):
                             # By default, no signal is sent when deleting a
                             # Versionable.
                             self.versionable_post_delete(instance, timestamp)
+                        events.append(self.versionable_event(instance,
+                                                             timestamp))
                 else:
                     query = sql.DeleteQuery(model)
                     pk_list = [obj.pk for obj in instances]
@@ -129,6 +133,9 @@ class VersionedCollector(Collector):
                                 sender=model, instance=obj, using=self.using
                             )
 
+            versions.models.log_version_events(
+                [event for event in events if event is not None], self.using)
+
         # update collected instances
         for model, instances_for_fieldvalues in self.field_updates.items():
             for (field, value), instances in instances_for_fieldvalues.items():
@@ -182,6 +189,24 @@ class VersionedCollector(Collector):
         """
         pass
 
+    def versionable_event(self, instance, timestamp):
+        """
+        Gets the VersionEvent logging the deletion of the instance, if
+        VERSIONS_EVENT_LOG is enabled.
+
+        :param Versionable instance:
+        :param datetime timestamp:
+        :return: VersionEvent or None
+        """
+        if not versions_settings.VERSIONS_EVENT_LOG:
+            return None
+        VersionEvent = versions.models.VersionEvent
+        if instance.__class__._meta.auto_created:
+            return VersionEvent.for_relation_entry(VersionEvent.UNLINKED,
+                                                   instance, timestamp)
+        return VersionEvent.for_version(VersionEvent.DELETED, instance,
+                                        timestamp, old_id=instance.id)
+
     def versionable_delete(self, instance, timestamp):
         """
         Soft-deletes the instance, setting it's version_end_date to timestamp.
@@ -12,6 +12,8 @@ from django.db.models.fields.related_descriptors import \
 from django.db.models.query_utils import Q
 from django.utils.functional import cached_property
 
+from versions.settings import settings as versions_settings
+from versions.unitofwork import get_active_batch
 from versions.util import get_utc_now
 
 
@@ -454,7 +456,10 @@ def create_versioned_forward_many_to_many_manager(superclass, rel,
 
         def _remove_items_at(self, timestamp, source_field_name,
                              target_field_name, *objs):
+            from versions.models import VersionEvent, log_version_events
+
             if objs:
+                timestamp_given = timestamp
                 if timestamp is None:
                     timestamp = get_utc_now()
                 old_ids = set()
@@ -473,13 +478,26 @@ def create_versioned_forward_many_to_many_manager(superclass, rel,
                         old_ids.add(fk_val)
                     else:
                         old_ids.add(obj)
+                batch = get_active_batch()
+                if batch is not None and timestamp_given is None:
+                    # Terminated when the batch is flushed
+                    batch.remove_relations(self.through, source_field_name,
+                                           target_field_name,
+                                           self.instance.id, old_ids)
+                    return
                 db = router.db_for_write(self.through, instance=self.instance)
                 qs = self.through._default_manager.using(db).filter(**{
                     source_field_name: self.instance.id,
                     '%s__in' % target_field_name: old_ids
                 }).as_of(timestamp)
-                for relation in qs:
-                    relation._delete_at(timestamp)
+                events = []
+                with transaction.atomic(using=db, savepoint=False):
+                    for relation in qs:
+                        relation._delete_at(timestamp)
+                        if versions_settings.VERSIONS_EVENT_LOG:
+                            events.append(VersionEvent.for_relation_entry(
+                                VersionEvent.UNLINKED, relation, timestamp))
+                    log_version_events(events, db)
 
         if 'add' in dir(many_related_manager_klass):
             def add(self, *objs):
@@ -488,6 +506,13 @@ def create_versioned_forward_many_to_many_manager(superclass, rel,
                         "Adding many-to-many related objects is only possible "
                         "on the current version")
 
+                batch = get_active_batch()
+                if batch is not None and \
+                        not hasattr(self.through, '__init_backup__'):
+                    # Added when the batch is flushed
+                    batch.add_relations(self, objs)
+                    return
+
                 # The ManyRelatedManager.add() method uses the through model's
                 # default manager to get a queryset when looking at which
                 # objects already exist in the database.
@@ -497,14 +522,39 @@ def create_versioned_forward_many_to_many_manager(superclass, rel,
                 # specified.
                 klass = self.through._default_manager.get_queryset().__class__
                 __using_backup = klass.using
+                __bulk_create_backup = klass.bulk_create
+                created = []
 
                 def using_replacement(self, *args, **kwargs):
                     qs = __using_backup(self, *args, **kwargs)
                     return qs.as_of(None)
 
+                # The entries created by the add are collected from the bulk
+                # insert, so that they can be logged without querying for
+                # them again
+                def bulk_create_replacement(self, objs, *args, **kwargs):
+                    objs = __bulk_create_backup(self, objs, *args, **kwargs)
+                    created.extend(objs)
+                    return objs
+
                 klass.using = using_replacement
-                super(VersionedManyRelatedManager, self).add(*objs)
-                klass.using = __using_backup
+                klass.bulk_create = bulk_create_replacement
+                db = router.db_for_write(self.through, instance=self.instance)
+                try:
+                    with transaction.atomic(using=db, savepoint=False):
+                        super(VersionedManyRelatedManager, self).add(*objs)
+                        if versions_settings.VERSIONS_EVENT_LOG:
+                            from versions.models import (VersionEvent,
+                                                         log_version_events)
+                            log_version_events([
+                                VersionEvent.for_relation_entry(
+                                    VersionEvent.LINKED, relation,
+                                    relation.version_start_date)
+                                for relation in created
+                                if isinstance(relation, self.through)], db)
+                finally:
+                    klass.using = __using_backup
+                    klass.bulk_create = __bulk_create_backup
 
             def add_at(self, timestamp, *objs):
                 """
@@ -257,10 +257,17 @@ class VersionedExtraWhere(ExtraWhere):
         self.related_alias = remote_alias
         self._as_of_time_set = False
         self.as_of_time = None
+        self.until = None
         self._joined_alias = None
 
-    def set_as_of(self, as_of_time):
+    def set_as_of(self, as_of_time, until=None):
+        """
+        :param datetime as_of_time: the point in time, or the start of the
+            period, at which the joined versions must be valid
+        :param datetime until: the end of the period, if any
+        """
         self.as_of_time = as_of_time
+        self.until = until
         self._as_of_time_set = True
 
     def set_joined_alias(self, joined_alias):
@@ -285,9 +292,10 @@ class VersionedExtraWhere(ExtraWhere):
         if self._as_of_time_set:
             if self.as_of_time:
                 sql = self.historic_sql
-                params = [self.as_of_time] * 2
-                # 2 is the number of occurences of the timestamp in an
-                # as_of-filter expression
+                # The version must start before the end of the period and
+                # end after its start; for a point in time, both are the same
+                until = self.as_of_time if self.until is None else self.until
+                params = [until, self.as_of_time]
             else:
                 # If as_of_time was set to None, we're dealing with a query
                 # for "current" values
@@ -318,68 +326,37 @@ class VersionedWhereNode(WhereNode):
         VersionedExtraWhere.as_sql() to be able to add time restrictions for
         those tables based on the VersionedQuery's querytime value.
 
-        :param qn: In Django 1.7 & 1.8 this is a compiler; in 1.6, it's an
-            instance-method
+        :param qn: The SQL compiler
         :param connection: A DB connection
         :return: A tuple consisting of (sql_string, result_params)
         """
         # self.children is an array of VersionedExtraWhere-objects
+        querytime = getattr(qn, 'querytime', None) or qn.query.querytime
         for child in self.children:
             if isinstance(child, VersionedExtraWhere) and not child.params:
-                # Django 1.7 & 1.8 handles compilers as objects
-                _query = qn.query
-                query_time = _query.querytime.time
-                apply_query_time = _query.querytime.active
-                alias_map = _query.alias_map
-                # In Django 1.8, use the Join objects in alias_map
-                self._set_child_joined_alias(child, alias_map)
-                if apply_query_time:
+                self._set_child_joined_alias(child, qn.query.alias_map)
+                if querytime.active:
                     # Add query parameters that have not been added till now
-                    child.set_as_of(query_time)
+                    child.set_as_of(querytime.time, querytime.until)
                 else:
                     # Remove the restriction if it's not required
                     child.sqls = []
         return super(VersionedWhereNode, self).as_sql(qn, connection)
 
-    @staticmethod
-    def _set_child_joined_alias_using_join_map(child, join_map, alias_map):
-        """
-        Set the joined alias on the child, for Django <= 1.7.x.
-        :param child:
-        :param join_map:
-        :param alias_map:
-        """
-        for lhs, table, join_cols in join_map:
-            if lhs is None:
-                continue
-            if lhs == child.alias:
-                relevant_alias = child.related_alias
-            elif lhs == child.related_alias:
-                relevant_alias = child.alias
-            else:
-                continue
-
-            join_info = alias_map[relevant_alias]
-            if join_info.join_type is None:
-                continue
-
-            if join_info.lhs_alias in [child.alias, child.related_alias]:
-                child.set_joined_alias(relevant_alias)
-                break
-
     @staticmethod
     def _set_child_joined_alias(child, alias_map):
         """
-        Set the joined alias on the child, for Django >= 1.8.0
-        :param child:
-        :param alias_map:
+        Set the joined alias on the child: of child.alias and
+        child.related_alias, the one whose join has the other one as parent.
+        This is the table joined by the join the restriction belongs to,
+        whichever side of the relation it is on.
+
+        :param child: a VersionedExtraWhere
+        :param alias_map: the alias_map of the compiled query
         """
-        for table in alias_map:
-            join = alias_map[table]
-            if not isinstance(join, Join):
-                continue
-            lhs = join.parent_alias
-            if (lhs == child.alias and table == child.related_alias) \
-                    or (lhs == child.related_alias and table == child.alias):
-                child.set_joined_alias(table)
-                break
+        for alias, parent_alias in ((child.alias, child.related_alias),
+                                    (child.related_alias, child.alias)):
+            join = alias_map.get(alias)
+            if isinstance(join, Join) and join.parent_alias == parent_alias:
+                child.set_joined_alias(alias)
+                return
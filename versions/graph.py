@@ -0,0 +1,186 @@
+# Copyright 2014 Swisscom, Sophia Engineering
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import OrderedDict
+
+from django.db.models import ManyToManyRel, ManyToOneRel
+
+from versions.fields import VersionedForeignKey, VersionedManyToManyField
+from versions.models import cache_related_object
+
+
+def _follow_tree(follow):
+    """
+    Turns relation paths like 'players__awards' into a tree of nested
+    OrderedDicts, so that common prefixes are followed once.
+    """
+    tree = OrderedDict()
+    for path in follow:
+        node = tree
+        for name in path.split('__'):
+            node = node.setdefault(name, OrderedDict())
+    return tree
+
+
+def _get_relation(model, name):
+    for field in model._meta.get_fields():
+        if field.auto_created and not field.concrete:
+            if field.get_accessor_name() == name:
+                return field
+        elif field.name == name:
+            return field
+    raise ValueError("%s has no relation '%s'" % (
+        model._meta.object_name, name))
+
+
+def _set_prefetched(instance, accessor_name, cache_name, objs):
+    """
+    Fills the cache of a related manager, like prefetch_related does.
+    """
+    if not hasattr(instance, '_prefetched_objects_cache'):
+        instance._prefetched_objects_cache = {}
+    queryset = getattr(instance, accessor_name).get_queryset()
+    queryset._result_cache = objs
+    queryset._prefetch_done = True
+    instance._prefetched_objects_cache[cache_name] = queryset
+
+
+class SnapshotLoader(object):
+    """
+    Loads a graph of Versionable objects as of a point in time, used by
+    versions.snapshot().
+
+    Every relation followed is read with a single query, restricted to the
+    versions valid at the point in time.  Objects reached more than once are
+    loaded once; the loader keeps one instance per model and identity.
+    """
+
+    def __init__(self, time, using=None):
+        self.time = time
+        self.using = using
+        self._objects = {}
+
+    def objects(self, model):
+        """
+        :return: dict of the loaded objects of the model, by identity
+        """
+        return self._objects.setdefault(model, OrderedDict())
+
+    def _query(self, model, **filters):
+        return model.objects.using(self.using).as_of(self.time).filter(
+            **filters)
+
+    def _register(self, objs):
+        """
+        Replaces the given objects by the instances already loaded for their
+        identities, and registers the others.
+        """
+        registered = []
+        for obj in objs:
+            loaded = self.objects(obj.__class__)
+            registered.append(loaded.setdefault(obj.identity, obj))
+        return registered
+
+    def load(self, queryset, follow=()):
+        """
+        Loads the objects of the queryset and the objects related to them
+        through the given relation paths.
+
+        :param queryset: the root objects; the query time of the queryset is
+            replaced by the point in time of the loader
+        :param follow: relation paths, like prefetch_related lookups
+        :return: list of the root objects
+        """
+        roots = self._register(queryset.using(self.using).as_of(self.time))
+        self._follow(queryset.model, roots, _follow_tree(follow))
+        return roots
+
+    def _follow(self, model, instances, tree):
+        for name, subtree in tree.items():
+            relation = _get_relation(model, name)
+            if isinstance(relation, VersionedForeignKey):
+                related = self._follow_foreign_key(instances, relation)
+            elif isinstance(relation, ManyToOneRel) and \
+                    isinstance(relation.field, VersionedForeignKey):
+                related = self._follow_reverse_foreign_key(
+                    instances, relation, name)
+            elif isinstance(relation, VersionedManyToManyField):
+                related = self._follow_many_to_many(
+                    instances, relation, name, relation.name,
+                    relation.m2m_field_name(),
+                    relation.m2m_reverse_field_name())
+            elif isinstance(relation, ManyToManyRel) and \
+                    isinstance(relation.field, VersionedManyToManyField):
+                related = self._follow_many_to_many(
+                    instances, relation.field, name,
+                    relation.field.related_query_name(),
+                    relation.field.m2m_reverse_field_name(),
+                    relation.field.m2m_field_name())
+            else:
+                raise ValueError("'%s' of %s is not a versioned relation" % (
+                    name, model._meta.object_name))
+            if subtree and related:
+                self._follow(related[0].__class__, related, subtree)
+
+    def _follow_foreign_key(self, instances, field):
+        model = field.remote_field.model
+        loaded = self.objects(model)
+        identities = set(getattr(instance, field.attname)
+                         for instance in instances) - {None} - set(loaded)
+        if identities:
+            self._register(self._query(model, identity__in=identities))
+        related = OrderedDict()
+        for instance in instances:
+            obj = loaded.get(getattr(instance, field.attname))
+            cache_related_object(instance, field, obj)
+            if obj is not None:
+                related[obj.identity] = obj
+        return list(related.values())
+
+    def _follow_reverse_foreign_key(self, instances, rel, accessor_name):
+        field = rel.field
+        by_identity = OrderedDict(
+            (instance.identity, []) for instance in instances)
+        related = self._register(self._query(
+            rel.related_model, **{field.attname + '__in': list(by_identity)}))
+        for obj in related:
+            by_identity[getattr(obj, field.attname)].append(obj)
+        for instance in instances:
+            objs = by_identity[instance.identity]
+            for obj in objs:
+                cache_related_object(obj, field, instance)
+            _set_prefetched(instance, accessor_name,
+                            field.related_query_name(), objs)
+        return related
+
+    def _follow_many_to_many(self, instances, field, accessor_name,
+                             cache_name, source_name, target_name):
+        through = field.remote_field.through
+        source = through._meta.get_field(source_name).attname
+        target = through._meta.get_field(target_name).attname
+        model = through._meta.get_field(target_name).remote_field.model
+        links = list(self._query(
+            through, **{source + '__in': [i.id for i in instances]}
+        ).values_list(source, target))
+        targets = self._query(model, id__in=set(t for s, t in links))
+        by_id = dict((obj.id, obj) for obj in self._register(targets))
+        by_source = dict((instance.id, []) for instance in instances)
+        for source_id, target_id in links:
+            if target_id in by_id:
+                by_source[source_id].append(by_id[target_id])
+        for instance in instances:
+            _set_prefetched(instance, accessor_name, cache_name,
+                            by_source[instance.id])
+        return list(OrderedDict(
+            (obj.identity, obj) for obj in by_id.values()).values())
@@ -0,0 +1,153 @@
+# Copyright 2014 Swisscom, Sophia Engineering
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from bisect import bisect_right
+
+from django.db.models import QuerySet
+
+from versions.models import QueryTime, cache_related_object
+
+
+class HistoryIndex(object):
+    """
+    Holds the versions of a Versionable model in memory, and answers point
+    in time lookups without querying the database.
+
+    The versions are loaded once, with a single streamed query.  They are
+    stored per identity, as a column of version start dates sorted in
+    ascending order, a column of version end dates, and the rows of field
+    values; the version valid at a point in time is found by binary search
+    in the start dates.
+    """
+
+    def __init__(self, queryset):
+        """
+        :param queryset: the Versionable model, or a queryset selecting the
+            versions to load; the query time of the queryset is ignored
+        """
+        if not isinstance(queryset, QuerySet):
+            queryset = queryset.objects.all()
+        self.model = queryset.model
+        self.using = queryset.db
+        opts = self.model._meta
+        self.field_names = [f.attname for f in opts.concrete_fields]
+        self._identity_field = opts.get_field('identity')
+        identity = self.field_names.index('identity')
+        start = self.field_names.index('version_start_date')
+        end = self.field_names.index('version_end_date')
+
+        queryset = queryset.order_by('identity', 'version_start_date')
+        queryset.querytime = QueryTime(time=None, active=False)
+        self._versions = {}
+        for row in queryset.values_list(*self.field_names).iterator():
+            versions = self._versions.get(row[identity])
+            if versions is None:
+                versions = self._versions[row[identity]] = ([], [], [])
+            versions[0].append(row[start])
+            versions[1].append(row[end])
+            versions[2].append(row)
+
+    def __len__(self):
+        return len(self._versions)
+
+    def __contains__(self, identity):
+        return self._identity_field.to_python(identity) in self._versions
+
+    def _instance(self, row, time):
+        instance = self.model.from_db(self.using, self.field_names, row)
+        instance._querytime = QueryTime(time=time, active=True)
+        return instance
+
+    def _find(self, versions, time):
+        starts, ends, rows = versions
+        if time is None:
+            position = len(starts) - 1
+            valid = ends[position] is None
+        else:
+            position = bisect_right(starts, time) - 1
+            valid = position >= 0 and (ends[position] is None or
+                                       ends[position] > time)
+        return rows[position] if valid else None
+
+    def get(self, identity, time=None):
+        """
+        Gets the version of an object valid at the given point in time.
+
+        :param identity: the identity of the object
+        :param datetime time: the point in time; None for the current version
+        :return: Versionable, with the point in time as query time
+        :raises: the model's DoesNotExist if the object did not exist at the
+            point in time
+        """
+        versions = self._versions.get(self._identity_field.to_python(
+            identity))
+        row = self._find(versions, time) if versions else None
+        if row is None:
+            raise self.model.DoesNotExist(
+                '%s matching identity %s does not exist at %s.' % (
+                    self.model._meta.object_name, identity, time))
+        return self._instance(row, time)
+
+    def as_of(self, time=None):
+        """
+        Gets the versions of all objects valid at the given point in time.
+
+        :param datetime time: the point in time; None for the current
+            versions
+        :return: list of Versionable, with the point in time as query time
+        """
+        instances = []
+        for versions in self._versions.values():
+            row = self._find(versions, time)
+            if row is not None:
+                instances.append(self._instance(row, time))
+        return instances
+
+    def versions(self, identity):
+        """
+        Gets all loaded versions of an object, ordered by their start date.
+
+        :param identity: the identity of the object
+        :return: list of Versionable, without query time
+        """
+        versions = self._versions.get(self._identity_field.to_python(
+            identity), ([], [], []))
+        return [self.model.from_db(self.using, self.field_names, row)
+                for row in versions[2]]
+
+    def resolve(self, instance, field_name):
+        """
+        Resolves a VersionedForeignKey of an instance to this index's model
+        in memory: the related object valid at the query time of the
+        instance is looked up in the index, and cached on the instance so
+        that accessing the field does not query the database.
+
+        :param Versionable instance: the object holding the foreign key
+        :param str field_name: the name of the foreign key field
+        :return: the related Versionable, or None if the foreign key is
+            empty or the related object did not exist at that time
+        """
+        field = instance._meta.get_field(field_name)
+        if field.remote_field.model is not self.model:
+            raise ValueError("'%s' does not refer to %s" % (
+                field_name, self.model._meta.label))
+        identity = getattr(instance, field.attname)
+        related_object = None
+        if identity is not None:
+            try:
+                related_object = self.get(identity, instance.as_of)
+            except self.model.DoesNotExist:
+                pass
+        cache_related_object(instance, field, related_object)
+        return related_object
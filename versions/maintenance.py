@@ -0,0 +1,326 @@
+# Copyright 2014 Swisscom, Sophia Engineering
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import OrderedDict
+
+from django.apps import apps
+from django.db import connections, router, transaction
+from django.db.models import Case, F, Q, Value, When
+from django.db.models.sql.subqueries import DeleteQuery
+
+from versions.fields import VersionedManyToManyField
+from versions.models import get_history_model
+
+
+def _versioned_through_models(model):
+    """
+    Gets the intermediary models of the versioned many-to-many relations the
+    given model takes part in, on either side, with the names of their
+    fields referring to the model.
+
+    :return: OrderedDict mapping intermediary models to lists of field names
+    """
+    through_models = OrderedDict()
+    for field in model._meta.get_fields(include_hidden=True):
+        if isinstance(field, VersionedManyToManyField):
+            through_models.setdefault(field.remote_field.through, []).append(
+                field.m2m_field_name())
+        elif field.many_to_many and field.auto_created and \
+                isinstance(field.field, VersionedManyToManyField):
+            through_models.setdefault(
+                field.field.remote_field.through, []).append(
+                field.field.m2m_reverse_field_name())
+    return through_models
+
+
+def pruned_tables(model, before):
+    """
+    Gets the querysets selecting the versions of the given model that were
+    terminated before the given point in time, and the rows of the
+    intermediary models of the versioned many-to-many relations it takes
+    part in (on either side) that were terminated before it or refer to
+    one of these versions.
+
+    The version of an object carrying its identity as id is kept, since
+    versioned foreign keys refer to it.
+
+    The intermediary models come first, so that deleting the rows in the
+    given order never leaves rows referring to deleted versions.
+
+    :param model: Versionable model
+    :param datetime before: versions terminated before this point in time are
+        selected
+    :return: list of (model, queryset) tuples; model is the model whose table
+        the rows are stored in
+    """
+    table_model = get_history_model(model) or model
+    pruned = table_model._base_manager.filter(
+        version_end_date__lt=before).exclude(id=F('identity'))
+    tables = []
+    for through, field_names in _versioned_through_models(model).items():
+        condition = Q(version_end_date__lt=before)
+        for field_name in field_names:
+            attname = through._meta.get_field(field_name).attname
+            condition |= Q(**{attname + '__in': pruned.values('id')})
+        tables.append((through, through._base_manager.filter(condition)))
+    tables.append((table_model, pruned))
+    return tables
+
+
+def prune_versions(model, before, batch_size=1000, using=None):
+    """
+    Deletes the versions of the given model that were terminated before the
+    given point in time, and the rows of the intermediary models of its
+    versioned many-to-many relations that were terminated before it or refer
+    to the deleted versions (see pruned_tables).
+
+    Rows are deleted in batches of at most batch_size rows, each batch in its
+    own transaction.  This is a generator yielding the number of rows deleted
+    after each batch, allowing the caller to throttle or report progress.
+
+    :param model: Versionable model
+    :param datetime before: versions terminated before this point in time are
+        deleted
+    :param int batch_size: maximum number of rows deleted per batch
+    :param str using: database alias to use.  If None, the database for
+        writing the model is used.
+    """
+    using = using or router.db_for_write(model)
+    for table_model, queryset in pruned_tables(model, before):
+        queryset = queryset.using(using)
+        while True:
+            with transaction.atomic(using=using):
+                pks = list(queryset.values_list('pk', flat=True)[:batch_size])
+                if not pks:
+                    break
+                DeleteQuery(table_model).delete_batch(pks, using)
+            yield len(pks)
+
+
+def _compacted_fields(model):
+    return [f for f in model._meta.concrete_fields
+            if f.name not in model.VERSIONABLE_FIELDS]
+
+
+def _adjacent_identical_versions_sql(model, connection):
+    """
+    Gets the SQL selecting pairs of adjacent versions of the same identity
+    whose non-versioning fields have equal values.  It has a placeholder for
+    the condition restricting the earlier versions (alias a).
+    """
+    qn = connection.ops.quote_name
+    conditions = ['a.{0} = b.{1}'.format(qn('identity'), qn('identity')),
+                  'a.{0} = b.{1}'.format(qn('version_end_date'),
+                                         qn('version_start_date'))]
+    for field in _compacted_fields(model):
+        conditions.append(
+            '(a.{0} = b.{0} OR (a.{0} IS NULL AND b.{0} IS NULL))'.format(
+                qn(field.column)))
+    return 'FROM {table} a JOIN {table} b ON {conditions} WHERE %s'.format(
+        table=qn(model._meta.db_table), conditions=' AND '.join(conditions))
+
+
+def _m2m_boundaries_match(model, pairs, using):
+    """
+    Gets the pairs of (earlier, later, boundary) versions whose versioned
+    many-to-many relations are the same at the boundary between them.
+    """
+    ids = [pk for pair in pairs for pk in pair[:2]]
+    for field in model._meta.many_to_many:
+        if not isinstance(field, VersionedManyToManyField):
+            continue
+        through = field.remote_field.through
+        source = through._meta.get_field(field.m2m_field_name()).attname
+        target = through._meta.get_field(
+            field.m2m_reverse_field_name()).attname
+        ended, started = {}, {}
+        for row in through._base_manager.using(using).filter(
+                **{source + '__in': ids}).values_list(
+                source, target, 'version_start_date', 'version_end_date'):
+            ended.setdefault((row[0], row[3]), set()).add(row[1])
+            started.setdefault((row[0], row[2]), set()).add(row[1])
+        pairs = [(earlier, later, boundary)
+                 for earlier, later, boundary in pairs
+                 if ended.get((earlier, boundary), set()) ==
+                 started.get((later, boundary), set())]
+    return pairs
+
+
+def _referencing_fields(model):
+    return [(related_model, field)
+            for related_model in apps.get_models(include_auto_created=True)
+            for field in related_model._meta.local_fields
+            if field.is_relation and field.remote_field.model is model]
+
+
+def _update_mapped(model, using, field, key_field, values):
+    """
+    Sets the given field of the rows of the model to the value mapped to
+    their key_field value, with a single UPDATE statement per chunk of keys,
+    using a CASE expression.
+
+    :param dict values: maps values of key_field to the new values of field
+    """
+    keys = list(values)
+    batch_size = connections[using].ops.bulk_batch_size(
+        ['key'] * 3, keys) or 1
+    for start in range(0, len(keys), batch_size):
+        chunk = keys[start:start + batch_size]
+        model._base_manager.using(using).filter(
+            **{key_field.attname + '__in': chunk}).update(**{
+                field.attname: Case(*[
+                    When(**{key_field.attname: key,
+                            'then': Value(values[key], output_field=field)})
+                    for key in chunk], output_field=field)})
+
+
+def _merge_chains(model, pairs, using):
+    """
+    Merges the chains of adjacent versions given as (earlier, later, boundary)
+    pairs into the latest version of each chain, which keeps its id.
+
+    The chains are merged with a fixed number of statements, whatever their
+    number: an UPDATE of the start dates of the kept versions, an UPDATE per
+    field referring to the model, and a DELETE of the merged versions.
+
+    :return: number of versions removed
+    """
+    later_of = dict((earlier, later) for earlier, later, boundary in pairs)
+    later_versions = set(later_of.values())
+    first_of, survivor_of = {}, {}
+    for first in later_of:
+        if first in later_versions:
+            continue
+        chain = [first]
+        while chain[-1] in later_of:
+            chain.append(later_of[chain[-1]])
+        first_of[chain[-1]] = first
+        for merged in chain[:-1]:
+            survivor_of[merged] = chain[-1]
+    if not survivor_of:
+        return 0
+
+    opts = model._meta
+    starts = dict(model._base_manager.using(using).filter(
+        pk__in=list(first_of.values())).values_list(
+        'pk', 'version_start_date'))
+    _update_mapped(model, using, opts.get_field('version_start_date'),
+                   opts.pk, dict((survivor, starts[first])
+                                 for survivor, first in first_of.items()))
+    for related_model, field in _referencing_fields(model):
+        _update_mapped(related_model, using, field, field, survivor_of)
+    DeleteQuery(model).delete_batch(list(survivor_of), using)
+    return len(survivor_of)
+
+
+def _renumber_versions(model, identities, using):
+    """
+    Renumbers the versions of the given identities, with a single SELECT
+    and a single UPDATE statement per chunk of renumbered versions.
+    """
+    opts = model._meta
+    numbers = {}
+    last_identity = None
+    for pk, identity, old_number in model._base_manager.using(using).filter(
+            identity__in=identities).order_by(
+            'identity', 'version_start_date').values_list(
+            'pk', 'identity', model.VERSION_NUMBER_FIELD):
+        number = number + 1 if identity == last_identity else 1
+        last_identity = identity
+        if number != old_number:
+            numbers[pk] = number
+    if numbers:
+        _update_mapped(model, using,
+                       opts.get_field(model.VERSION_NUMBER_FIELD), opts.pk,
+                       numbers)
+
+
+def compact_versions(model, batch_size=1000, using=None):
+    """
+    Merges adjacent versions of the same object whose fields (except the
+    versioning fields) and versioned many-to-many relations are equal, as
+    left behind by cloning objects without changing them.
+
+    Each run of such versions is merged into its latest version, which keeps
+    its id and gets the start date of the earliest one.  Rows referring to
+    the removed versions (e.g. many-to-many entries) are re-pointed to it,
+    and the many-to-many entries split by the cloning are merged as well,
+    on either side of the relations.
+
+    Adjacent versions are detected with a single query per batch of
+    identities, and merged and renumbered with a number of statements that
+    does not depend on the number of versions in the batch.  Each batch is
+    processed in its own transaction.  This is a
+    generator yielding the number of rows removed after each batch.
+
+    Models using a history table (see VERSION_HISTORY_TABLE) are not
+    supported.
+
+    :param model: Versionable model
+    :param int batch_size: maximum number of identities processed per batch
+    :param str using: database alias to use.  If None, the database for
+        writing the model is used.
+    """
+    if get_history_model(model):
+        raise ValueError('Compacting models using a history table is not '
+                         'supported')
+    using = using or router.db_for_write(model)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    pairs_sql = _adjacent_identical_versions_sql(model, connection)
+    identities_sql = 'SELECT DISTINCT a.{0} {1} ORDER BY a.{0} LIMIT {2}'
+    first_identities_sql = identities_sql.format(
+        qn('identity'), pairs_sql % '1 = 1', int(batch_size))
+    next_identities_sql = identities_sql.format(
+        qn('identity'), pairs_sql % 'a.{0} > %s'.format(qn('identity')),
+        int(batch_size))
+    to_python = model._meta.pk.to_python
+
+    last_identity = None
+    while True:
+        with transaction.atomic(using=using), \
+                connection.cursor() as cursor:
+            if last_identity is None:
+                cursor.execute(first_identities_sql)
+            else:
+                cursor.execute(next_identities_sql, [last_identity])
+            identities = [row[0] for row in cursor.fetchall()]
+            if not identities:
+                break
+            last_identity = identities[-1]
+
+            cursor.execute(
+                'SELECT a.{0}, b.{0} {1}'.format(
+                    qn('id'), pairs_sql % 'a.{0} IN ({1})'.format(
+                        qn('identity'), ', '.join(['%s'] * len(identities)))),
+                identities)
+            pairs = [(to_python(earlier), to_python(later))
+                     for earlier, later in cursor.fetchall()]
+            starts = dict(model._base_manager.using(using).filter(
+                pk__in=[later for earlier, later in pairs]).values_list(
+                'pk', 'version_start_date'))
+            pairs = _m2m_boundaries_match(
+                model, [(earlier, later, starts[later])
+                        for earlier, later in pairs], using)
+            removed = _merge_chains(model, pairs, using)
+            if model.VERSION_NUMBER_FIELD:
+                identity_to_python = model._meta.get_field(
+                    'identity').to_python
+                _renumber_versions(model, [identity_to_python(identity)
+                                           for identity in identities], using)
+        yield removed
+
+    for through in _versioned_through_models(model):
+        for removed in compact_versions(through, batch_size, using):
+            yield removed
@@ -0,0 +1,62 @@
+import time
+
+from django.apps import apps
+from django.core.management.base import BaseCommand
+
+from versions.maintenance import compact_versions
+from versions.models import Versionable, get_history_model
+
+
+class Command(BaseCommand):
+    help = ("Merges adjacent versions of Versionable objects whose fields and "
+            "versioned many-to-many relations are equal.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'app_label', nargs='*',
+            help='Only compact models of these applications.')
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Maximum number of objects processed per transaction.')
+        parser.add_argument(
+            '--sleep', type=float, default=0,
+            help='Seconds to wait between two batches.')
+        parser.add_argument(
+            '--database',
+            help='Database alias to use. Defaults to the database used for '
+                 'writing each model.')
+
+    def handle(self, *args, **options):
+        if options['app_label']:
+            app_configs = [apps.get_app_config(label)
+                           for label in options['app_label']]
+        else:
+            app_configs = apps.get_app_configs()
+
+        for app_config in app_configs:
+            for model in app_config.get_models():
+                if not issubclass(model, Versionable):
+                    continue
+                if get_history_model(model):
+                    if options['verbosity'] > 1:
+                        self.stdout.write(
+                            '%s: skipped, uses a history table'
+                            % model._meta.label)
+                    continue
+                self.compact(model, options)
+
+    def compact(self, model, options):
+        started = time.time()
+        removed = 0
+        for count in compact_versions(model, options['batch_size'],
+                                      options['database']):
+            removed += count
+            if options['verbosity'] > 1:
+                self.stdout.write('  %s: %d rows removed' % (
+                    model._meta.label, removed))
+            if options['sleep']:
+                time.sleep(options['sleep'])
+        elapsed = time.time() - started
+        self.stdout.write('%s: %d rows removed in %.1fs (%.1f rows/s)' % (
+            model._meta.label, removed, elapsed,
+            removed / elapsed if elapsed else 0))
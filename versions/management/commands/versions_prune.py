@@ -0,0 +1,60 @@
+import time
+
+from django.apps import apps
+from django.core.management.base import BaseCommand
+
+from versions.maintenance import prune_versions
+from versions.models import Versionable
+from versions.util import get_utc_now
+
+
+class Command(BaseCommand):
+    help = ("Deletes the versions of Versionable models having a "
+            "VERSION_RETENTION that were terminated longer ago than their "
+            "retention period.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'app_label', nargs='*',
+            help='Only prune models of these applications.')
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Maximum number of rows deleted per transaction.')
+        parser.add_argument(
+            '--sleep', type=float, default=0,
+            help='Seconds to wait between two batches.')
+        parser.add_argument(
+            '--database',
+            help='Database alias to use. Defaults to the database used for '
+                 'writing each model.')
+
+    def handle(self, *args, **options):
+        if options['app_label']:
+            app_configs = [apps.get_app_config(label)
+                           for label in options['app_label']]
+        else:
+            app_configs = apps.get_app_configs()
+
+        now = get_utc_now()
+        for app_config in app_configs:
+            for model in app_config.get_models():
+                if not issubclass(model, Versionable) or \
+                        not model.VERSION_RETENTION:
+                    continue
+                self.prune(model, now - model.VERSION_RETENTION, options)
+
+    def prune(self, model, before, options):
+        started = time.time()
+        deleted = 0
+        for count in prune_versions(model, before, options['batch_size'],
+                                    options['database']):
+            deleted += count
+            if options['verbosity'] > 1:
+                self.stdout.write('  %s: %d rows deleted' % (
+                    model._meta.label, deleted))
+            if options['sleep']:
+                time.sleep(options['sleep'])
+        elapsed = time.time() - started
+        self.stdout.write('%s: %d rows deleted in %.1fs (%.1f rows/s)' % (
+            model._meta.label, deleted, elapsed,
+            deleted / elapsed if elapsed else 0))
@@ -0,0 +1,30 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VersionEvent',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True,
+                                           serialize=False)),
+                ('timestamp', models.DateTimeField()),
+                ('kind', models.CharField(choices=[
+                    ('created', 'created'), ('cloned', 'cloned'),
+                    ('deleted', 'deleted'), ('restored', 'restored'),
+                    ('linked', 'linked'), ('unlinked', 'unlinked')],
+                    max_length=10)),
+                ('model', models.CharField(max_length=255)),
+                ('identity', models.UUIDField()),
+                ('old_id', models.UUIDField(null=True)),
+                ('new_id', models.UUIDField(null=True)),
+                ('related_id', models.UUIDField(null=True)),
+            ],
+        ),
+    ]
@@ -14,25 +14,34 @@
 
 import copy
 import datetime
+import itertools
+import threading
 import uuid
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
 
 from django.core.exceptions import SuspiciousOperation, ObjectDoesNotExist
-from django.db import models, router, transaction
-from django.db.models import Q
+from django.db import NotSupportedError, connections, models, router, \
+    transaction
+from django.db.models import Max, Q
 from django.db.models.constants import LOOKUP_SEP
+from django.db.models.expressions import Ref
 from django.db.models.fields.related import ForeignKey
 from django.db.models.query import QuerySet, ModelIterable
-from django.db.models.sql.datastructures import Join
+from django.db.models.signals import class_prepared
+from django.db.models.sql.datastructures import BaseTable, Join
+from django.db.models.sql.constants import GET_ITERATOR_CHUNK_SIZE
 from django.db.models.sql.query import Query
-from django.db.models.sql.where import WhereNode
+from django.db.models.sql.where import AND
+from django.db.models.sql.subqueries import DeleteQuery
 from django.utils import six
 from django.utils.timezone import utc
 
 from versions.exceptions import DeletionOfNonCurrentVersionError
 from versions.settings import get_versioned_delete_collector_class, \
     settings as versions_settings
-from versions.util import get_utc_now
+from versions.unitofwork import VersionedBatch, get_active_batch, \
+    immediate_writes
+from versions.util import get_utc_now, uuid7
 
 
 def get_utc_now():
@@ -41,12 +50,92 @@ def get_utc_now():
 
 def validate_uuid(uuid_obj):
     """
-    Check that the UUID object is in fact a valid version 4 uuid.
+    Check that the UUID object is in fact a valid version 4 uuid, or a valid
+    version 7 uuid if time-ordered UUIDs are enabled.
     """
-    return isinstance(uuid_obj, uuid.UUID) and uuid_obj.version == 4
+    if not isinstance(uuid_obj, uuid.UUID):
+        return False
+    if versions_settings.VERSIONS_TIME_ORDERED_UUIDS:
+        return uuid_obj.version in (4, 7)
+    return uuid_obj.version == 4
 
 
-QueryTime = namedtuple('QueryTime', 'time active')
+QueryTime = namedtuple('QueryTime', 'time active until')
+QueryTime.__new__.__defaults__ = (None,)
+SyncResult = namedtuple('SyncResult', 'created updated deleted')
+Change = namedtuple('Change', 'kind identity old_id new_id')
+ChangeSet = namedtuple('ChangeSet', 'created updated deleted')
+CHANGED_FLAG_PREFIX = '_changed_'
+Difference = namedtuple('Difference',
+                        'kind identity old_id new_id changed_fields')
+TimeSeries = namedtuple('TimeSeries', 'identities timestamps values')
+
+
+def forget_related_object(instance, field):
+    """
+    Removes the related object cached on the instance for the given
+    ForeignKey field, e.g. after its column value was changed.
+    """
+    if hasattr(field, 'delete_cached_value'):
+        if field.is_cached(instance):
+            field.delete_cached_value(instance)
+    else:
+        instance.__dict__.pop(field.get_cache_name(), None)
+
+
+def cache_related_object(instance, field, related_object):
+    """
+    Caches the related object on the instance for the given ForeignKey
+    field, so that accessing the field does not query the database.
+    """
+    if hasattr(field, 'set_cached_value'):
+        field.set_cached_value(instance, related_object)
+    else:
+        setattr(instance, field.get_cache_name(), related_object)
+
+
+class CompactUUIDField(models.UUIDField):
+    """
+    A UUIDField that is stored as 16 bytes of binary data on database
+    backends without a native UUID type (e.g. SQLite), instead of a 32 or
+    36 character string.
+
+    On backends with a native UUID type (PostgreSQL), the native type is
+    used. The Python value is always a uuid.UUID object.
+    """
+    description = 'Universally unique identifier, stored in binary form'
+
+    def get_internal_type(self):
+        # Prevents backends from applying their UUIDField converters (which
+        # expect hex strings) to the binary values
+        return 'BinaryField'
+
+    def db_type(self, connection):
+        if connection.features.has_native_uuid_field:
+            return 'uuid'
+        if connection.vendor == 'mysql':
+            return 'binary(16)'
+        if connection.vendor == 'oracle':
+            return 'RAW(16)'
+        return super(CompactUUIDField, self).db_type(connection)
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if value is None:
+            return None
+        if not isinstance(value, uuid.UUID):
+            value = self.to_python(value)
+        if connection.features.has_native_uuid_field:
+            return value
+        return connection.Database.Binary(value.bytes)
+
+    def from_db_value(self, value, expression, connection, *args):
+        return self.to_python(value)
+
+    def to_python(self, value):
+        if isinstance(value, (six.memoryview, bytearray)) or (
+                isinstance(value, six.binary_type) and len(value) == 16):
+            return uuid.UUID(bytes=bytes(value))
+        return super(CompactUUIDField, self).to_python(value)
 
 
 class ForeignKeyRequiresValueError(ValueError):
@@ -80,6 +169,39 @@ class VersionManager(models.Manager):
         """
         return self.get_queryset().as_of(time)
 
+    def during(self, start, end):
+        """
+        Filters the versions valid at any point in time of a period; see
+        VersionedQuerySet.during.
+
+        :param datetime start: start of the period
+        :param datetime end: end of the period
+        :return: VersionedQuerySet
+        """
+        return self.get_queryset().during(start, end)
+
+    def with_changes(self, fields=None):
+        """
+        Annotates each version with the names of the fields changed since the
+        previous version; see VersionedQuerySet.with_changes.
+
+        :param list fields: names of the fields to compare
+        :return: VersionedQuerySet
+        """
+        return self.get_queryset().with_changes(fields)
+
+    def count_series(self, timestamps, field=None, as_array=False):
+        """
+        Counts the objects existing at each of the given points in time; see
+        VersionedQuerySet.count_series.
+
+        :param list timestamps: the points in time to count the objects at
+        :param str field: name of a field to group the counts by
+        :param bool as_array: whether to return NumPy arrays
+        :return: list, numpy.ndarray or OrderedDict
+        """
+        return self.get_queryset().count_series(timestamps, field, as_array)
+
     def next_version(self, object, relations_as_of='end'):
         """
         Return the next version of the given object.
@@ -103,6 +225,12 @@ class VersionManager(models.Manager):
         """
         if object.version_end_date is None:
             next = object
+        elif object.VERSION_NUMBER_FIELD:
+            next = self.filter(**{
+                'identity': object.identity,
+                object.VERSION_NUMBER_FIELD:
+                    getattr(object, object.VERSION_NUMBER_FIELD) + 1
+            }).first()
         else:
             next = self.filter(
                 Q(identity=object.identity),
@@ -121,8 +249,9 @@ class VersionManager(models.Manager):
         Return the previous version of the given object.
 
         In case there is no previous object existing, meaning the given object
-        is the first version of the object, then the function returns this
-        version.
+        is the first version of the object (or the first version left after
+        pruning older versions, see VERSION_RETENTION), then the function
+        returns this version.
 
         ``relations_as_of`` is used to fix the point in time for the version;
         this affects which related objects are returned when querying for
@@ -135,18 +264,25 @@ class VersionManager(models.Manager):
             relations. 'start'|'end'|datetime|None
         :return: Versionable
         """
-        if object.version_birth_date == object.version_start_date:
+        if object.version_birth_date == object.version_start_date or (
+                object.VERSION_NUMBER_FIELD and
+                getattr(object, object.VERSION_NUMBER_FIELD) <= 1):
             previous = object
+        elif object.VERSION_NUMBER_FIELD:
+            previous = self.filter(**{
+                'identity': object.identity,
+                object.VERSION_NUMBER_FIELD:
+                    getattr(object, object.VERSION_NUMBER_FIELD) - 1
+            }).first()
         else:
             previous = self.filter(
                 Q(identity=object.identity),
                 Q(version_end_date__lte=object.version_start_date)
             ).order_by('-version_end_date').first()
 
-            if not previous:
-                raise ObjectDoesNotExist(
-                    "previous_version couldn't find a previous version of "
-                    "object " + str(object.identity))
+        if not previous:
+            # Earlier versions have been pruned
+            previous = object
 
         return self.adjust_version_as_of(previous, relations_as_of)
 
@@ -184,6 +320,279 @@ class VersionManager(models.Manager):
 
         return self.adjust_version_as_of(current, relations_as_of)
 
+    def get_version(self, object, version_number, relations_as_of='end'):
+        """
+        Return the version with the given number (starting at 1 for the
+        first version) of the given object.
+
+        For models having a version number column (see NumberedVersionable),
+        this is a direct lookup on (identity, version_number). For other
+        models, the versions of the object are ordered by their
+        version_start_date.
+
+        ``relations_as_of`` is used to fix the point in time for the version;
+        see ``VersionManager.version_as_of`` for details on valid
+        ``relations_as_of`` values.
+
+        :param Versionable object: object whose version will be returned.
+        :param int version_number: the number of the version to return
+        :param mixed relations_as_of: determines point in time used to access
+            relations. 'start'|'end'|datetime|None
+        :return: Versionable
+        """
+        if version_number < 1:
+            raise ValueError("version_number must be 1 or greater")
+        versions = self.filter(identity=object.identity)
+        if object.VERSION_NUMBER_FIELD:
+            version = versions.filter(
+                **{object.VERSION_NUMBER_FIELD: version_number}).first()
+        else:
+            version = versions.order_by('version_start_date')[
+                version_number - 1:version_number].first()
+
+        if not version:
+            raise ObjectDoesNotExist(
+                "get_version couldn't find version {} of object {}".format(
+                    version_number, object.identity))
+
+        return self.adjust_version_as_of(version, relations_as_of)
+
+    def version_count(self, object):
+        """
+        Return the number of versions of the given object.
+
+        For models having a version number column (see NumberedVersionable),
+        this is the highest version number, which is read from the
+        (identity, version_number) index.
+
+        :param Versionable object: object whose versions will be counted.
+        :return: int
+        """
+        versions = self.filter(identity=object.identity)
+        if object.VERSION_NUMBER_FIELD:
+            return versions.aggregate(
+                count=Max(object.VERSION_NUMBER_FIELD))['count'] or 0
+        return versions.count()
+
+    def sync(self, rows, key_fields, timestamp=None):
+        """
+        Makes the current objects match the given rows, e.g. a full export
+        of an external system.
+
+        The current objects are read with a single query and matched with
+        the rows by the values of ``key_fields``.  Objects whose fields differ
+        from their row are cloned and updated, rows without a matching object
+        are created as new objects, and current objects without a matching
+        row are deleted.  All changes are written in bulk within a
+        versions.batch(), and share its timestamp.
+
+        :param rows: iterable of dicts, mapping field names (or attnames) to
+            values; only the fields present in a row are compared and updated
+        :param key_fields: name or list of names of the fields identifying an
+            object in the rows
+        :param timestamp: timestamp of the created and terminated versions;
+            defaults to now
+        :return: SyncResult, whose created, updated and deleted attributes
+            are lists of the created, new and deleted versions
+        """
+        if isinstance(key_fields, six.string_types):
+            key_fields = [key_fields]
+        opts = self.model._meta
+        key_fields = [opts.get_field(name) for name in key_fields]
+
+        def key_of(obj):
+            return tuple(getattr(obj, f.attname) for f in key_fields)
+
+        current = {}
+        for obj in self.current.all():
+            if current.setdefault(key_of(obj), obj) is not obj:
+                raise ValueError(
+                    "Several current objects have the key {}".format(
+                        key_of(obj)))
+
+        with VersionedBatch(using=self._db, timestamp=timestamp) as batch:
+            incoming = OrderedDict()
+            for row in rows:
+                fields = [opts.get_field(name) for name in row]
+                if any(f.name in self.model.VERSIONABLE_FIELDS
+                       for f in fields):
+                    raise ValueError(
+                        "Rows must not contain versioning fields")
+                obj = self.model(**row)
+                for field in fields:
+                    setattr(obj, field.attname,
+                            field.to_python(getattr(obj, field.attname)))
+                if key_of(obj) in incoming:
+                    raise ValueError(
+                        "Several rows have the key {}".format(key_of(obj)))
+                incoming[key_of(obj)] = (obj, fields)
+
+            created, updated = [], []
+            for key, (obj, fields) in incoming.items():
+                existing = current.pop(key, None)
+                if existing is None:
+                    obj.version_start_date = batch.timestamp
+                    obj.version_birth_date = batch.timestamp
+                    obj.save()
+                    created.append(obj)
+                elif any(getattr(existing, f.attname) !=
+                         getattr(obj, f.attname) for f in fields):
+                    version = existing.clone()
+                    for field in fields:
+                        setattr(version, field.attname,
+                                getattr(obj, field.attname))
+                        if field.is_relation:
+                            forget_related_object(version, field)
+                    version.save()
+                    updated.append(version)
+
+            deleted = list(current.values())
+            for obj in deleted:
+                obj.delete()
+        return SyncResult(created, updated, deleted)
+
+    def changes(self, since, until=None):
+        """
+        Gets the objects that were created, updated or deleted between two
+        points in time.  See iter_changes for details.
+
+        :param datetime since: start of the period (exclusive)
+        :param datetime until: end of the period (inclusive); defaults to now
+        :return: ChangeSet, whose created, updated and deleted attributes are
+            lists of Change tuples
+        """
+        changes = ChangeSet([], [], [])
+        for change in self.iter_changes(since, until):
+            getattr(changes, change.kind).append(change)
+        return changes
+
+    def iter_changes(self, since, until=None):
+        """
+        Iterates over the objects that were created, updated or deleted
+        between two points in time, ordered by their identity.
+
+        The changes are read with two queries, streaming the versions that
+        were valid at ``since`` and ended until ``until``, and the versions
+        that are valid at ``until`` and started after ``since``.  An object
+        which only has the latter was created, one only having the former
+        was deleted, and one having both was updated.  Objects created and
+        deleted within the period are not returned.
+
+        :param datetime since: start of the period (exclusive)
+        :param datetime until: end of the period (inclusive); defaults to now
+        :return: generator of Change tuples; kind is one of 'created',
+            'updated' or 'deleted', and old_id and new_id are the ids of the
+            versions valid at ``since`` and ``until`` (or None)
+        """
+        if until is not None and until < since:
+            raise ValueError("until must not be earlier than since")
+        if until is None:
+            new_versions = self.current
+        else:
+            new_versions = self.as_of(until)
+        new_versions = new_versions.filter(version_start_date__gt=since)
+        old_versions = self.as_of(since).filter(
+            version_end_date__isnull=False)
+        if until is not None:
+            old_versions = old_versions.filter(version_end_date__lte=until)
+
+        old_rows = old_versions.order_by('identity').values_list(
+            'identity', 'id').iterator()
+        new_rows = new_versions.order_by('identity').values_list(
+            'identity', 'id').iterator()
+        old, new = next(old_rows, None), next(new_rows, None)
+        while old is not None or new is not None:
+            if new is None or (old is not None and old[0] < new[0]):
+                yield Change('deleted', old[0], old[1], None)
+                old = next(old_rows, None)
+            elif old is None or new[0] < old[0]:
+                yield Change('created', new[0], None, new[1])
+                new = next(new_rows, None)
+            else:
+                yield Change('updated', new[0], old[1], new[1])
+                old, new = next(old_rows, None), next(new_rows, None)
+
+    def diff(self, t1, t2, fields=None):
+        """
+        Compares the objects valid at two points in time, and iterates over
+        the differences.
+
+        The comparison is done by the database, joining the versions valid
+        at t1 with the versions valid at t2 on their identity; the results
+        are streamed.  Objects whose version is the same at both points in
+        time are not compared field by field.
+
+        :param datetime t1: the point in time to compare from
+        :param datetime t2: the point in time to compare to
+        :param list fields: names of the fields to compare; defaults to all
+            fields except the versioning fields
+        :return: generator of Difference tuples; kind is one of 'added',
+            'removed' or 'changed', old_id and new_id are the ids of the
+            versions valid at t1 and t2 (or None), and changed_fields the
+            names of the fields whose values differ
+        """
+        opts = self.model._meta
+        if fields is None:
+            fields = [f for f in opts.concrete_fields
+                      if f.name not in self.model.VERSIONABLE_FIELDS]
+        else:
+            fields = [opts.get_field(name) for name in fields]
+
+        using = self.db
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        columns = ['identity', 'id'] + [f.attname for f in fields]
+        old_sql, old_params = self.as_of(t1).order_by().values(
+            *columns).query.get_compiler(using).as_sql()
+        new_sql, new_params = self.as_of(t2).order_by().values(
+            *columns).query.get_compiler(using).as_sql()
+
+        flags = ['CASE WHEN a.{0} = b.{0} OR '
+                 '(a.{0} IS NULL AND b.{0} IS NULL) THEN 0 ELSE 1 END'.format(
+                     qn(f.column)) for f in fields]
+        select = 'SELECT {}'.format(', '.join(
+            ['COALESCE(a.{0}, b.{0})'.format(qn('identity')),
+             'a.{}'.format(qn('id')), 'b.{}'.format(qn('id'))] + flags))
+        on = 'a.{0} = b.{0}'.format(qn('identity'))
+        changed = 'a.{0} <> b.{0} AND ({1})'.format(
+            qn('id'),
+            ' OR '.join('{} = 1'.format(flag) for flag in flags) or '1 = 0')
+        if connection.vendor in ('postgresql', 'oracle'):
+            sql = ('{select} FROM ({old}) a FULL OUTER JOIN ({new}) b '
+                   'ON {on} WHERE a.{id} IS NULL OR b.{id} IS NULL OR '
+                   '({changed})')
+            params = old_params + new_params
+        else:
+            # No FULL OUTER JOIN; find the added objects separately
+            sql = ('{select} FROM ({old}) a LEFT OUTER JOIN ({new}) b '
+                   'ON {on} WHERE b.{id} IS NULL OR ({changed}) '
+                   'UNION ALL '
+                   '{select} FROM ({new}) b LEFT OUTER JOIN ({old}) a '
+                   'ON {on} WHERE a.{id} IS NULL')
+            params = old_params + new_params + new_params + old_params
+        sql = sql.format(select=select, old=old_sql, new=new_sql, on=on,
+                         changed=changed, id=qn('id'))
+
+        id_field = opts.pk
+        with connection.chunked_cursor() as cursor:
+            cursor.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(GET_ITERATOR_CHUNK_SIZE)
+                if not rows:
+                    return
+                for row in rows:
+                    identity, old_id, new_id = [
+                        id_field.to_python(value) for value in row[:3]]
+                    if old_id is None:
+                        yield Difference('added', identity, None, new_id, [])
+                    elif new_id is None:
+                        yield Difference('removed', identity, old_id, None,
+                                         [])
+                    else:
+                        yield Difference('changed', identity, old_id, new_id,
+                                         [f.name for f, flag
+                                          in zip(fields, row[3:]) if flag])
+
     @staticmethod
     def adjust_version_as_of(version, relations_as_of):
         """
@@ -272,10 +681,11 @@ class VersionManager(models.Manager):
         version_birth_date set to some pre-defined timestamp
 
         :param timestamp: point in time at which the instance has to be created
-        :param id: version 4 UUID unicode object.  Usually this is not
-            specified, it will be automatically created.
-        :param forced_identity: version 4 UUID unicode object.  For internal
-            use only.
+        :param id: version 4 (or, with time-ordered UUIDs enabled, version 7)
+            UUID unicode object.  Usually this is not specified, it will be
+            automatically created.
+        :param forced_identity: version 4 (or 7) UUID unicode object.  For
+            internal use only.
         :param kwargs: arguments needed for initializing the instance
         :return: an instance of the class
         """
@@ -291,53 +701,256 @@ class VersionManager(models.Manager):
         kwargs['identity'] = ident
         kwargs['version_start_date'] = timestamp
         kwargs['version_birth_date'] = timestamp
-        return super(VersionManager, self).create(**kwargs)
-
-
-class VersionedWhereNode(WhereNode):
-    def as_sql(self, qn, connection):
-        """
-        This method identifies joined table aliases in order for
-        VersionedExtraWhere.as_sql() to be able to add time restrictions for
-        those tables based on the VersionedQuery's querytime value.
-
-        :param qn: In Django 1.7 & 1.8 this is a compiler
-        :param connection: A DB connection
-        :return: A tuple consisting of (sql_string, result_params)
-        """
-        # self.children is an array of VersionedExtraWhere-objects
-        from versions.fields import VersionedExtraWhere
-        for child in self.children:
-            if isinstance(child, VersionedExtraWhere) and not child.params:
-                _query = qn.query
-                query_time = _query.querytime.time
-                apply_query_time = _query.querytime.active
-                alias_map = _query.alias_map
-                self._set_child_joined_alias(child, alias_map)
-                if apply_query_time:
-                    # Add query parameters that have not been added till now
-                    child.set_as_of(query_time)
-                else:
-                    # Remove the restriction if it's not required
-                    child.sqls = []
-        return super(VersionedWhereNode, self).as_sql(qn, connection)
+        if not versions_settings.VERSIONS_EVENT_LOG or \
+                get_active_batch() is not None:
+            # Within a batch, the creation is logged when it is flushed
+            return super(VersionManager, self).create(**kwargs)
+        using = self._db or router.db_for_write(self.model)
+        with transaction.atomic(using=using, savepoint=False):
+            obj = super(VersionManager, self).create(**kwargs)
+            log_version_events([VersionEvent.for_version(
+                VersionEvent.CREATED, obj, timestamp, new_id=obj.id)],
+                using)
+        return obj
 
-    @staticmethod
-    def _set_child_joined_alias(child, alias_map):
-        """
-        Set the joined alias on the child, for Django >= 1.8.0
-        :param child:
-        :param alias_map:
-        """
-        for table in alias_map:
-            join = alias_map[table]
-            if not isinstance(join, Join):
-                continue
-            lhs = join.parent_alias
-            if (lhs == child.alias and table == child.related_alias) \
-                    or (lhs == child.related_alias and table == child.alias):
-                child.set_joined_alias(table)
-                break
+
+_history_models = {}
+"""Maps the db_table of models using a history table (see
+Versionable.VERSION_HISTORY_TABLE) to their history model"""
+
+_versioned_compilers = {}
+
+
+def get_history_model(model):
+    """
+    Return the model of the history table holding the terminated versions of
+    the given model, or None if the model keeps all its versions in a single
+    table.
+    """
+    return _history_models.get(model._meta.db_table)
+
+
+def _coalescing_registry(connection):
+    registry = getattr(connection, '_versions_coalescing_registry', None)
+    if registry is None:
+        registry = connection._versions_coalescing_registry = {}
+    return registry
+
+
+def register_coalescible_version(version, using):
+    """
+    Remember a version created by cloning inside a transaction, so that
+    further clones of it within the same transaction can be coalesced (see
+    the VERSIONS_TRANSACTION_COALESCING setting).  The versions are
+    forgotten when the transaction is committed.
+    """
+    connection = transaction.get_connection(using)
+    if not versions_settings.VERSIONS_TRANSACTION_COALESCING or \
+            not connection.in_atomic_block:
+        return
+    registry = _coalescing_registry(connection)
+    registry[(version._meta.label, version.identity)] = \
+        version.version_start_date
+    transaction.on_commit(registry.clear, using)
+
+
+def is_coalescible_version(version, using):
+    """
+    Check whether the given version was created by cloning in the current
+    transaction (see register_coalescible_version).
+
+    Rolling back the transaction, or a savepoint containing the clone,
+    restores the previous start date of the version in the database; the
+    start date is read back to make sure the clone is still in effect.
+    """
+    connection = transaction.get_connection(using)
+    if not versions_settings.VERSIONS_TRANSACTION_COALESCING or \
+            not connection.in_atomic_block:
+        return False
+    registry = _coalescing_registry(connection)
+    key = (version._meta.label, version.identity)
+    start_date = registry.get(key)
+    if start_date is None or start_date != version.version_start_date or \
+            not version.is_current:
+        return False
+    if version.__class__._base_manager.using(using).filter(
+            pk=version.pk, version_start_date=start_date,
+            version_end_date__isnull=True).exists():
+        return True
+    del registry[key]
+    return False
+
+
+CompiledSQLCacheInfo = namedtuple('CompiledSQLCacheInfo',
+                                  'hits misses currsize')
+
+_compiled_sql_cache = {}
+"""Maps (database alias, model, table alias, restriction kind) to the SQL
+template of a query time restriction"""
+
+_compiled_sql_cache_stats = {'hits': 0, 'misses': 0}
+
+
+def compiled_sql_cache_info():
+    """
+    Report the hits and misses of the cache of compiled query time
+    restrictions, and the number of templates it holds.
+
+    :return: CompiledSQLCacheInfo
+    """
+    return CompiledSQLCacheInfo(_compiled_sql_cache_stats['hits'],
+                                _compiled_sql_cache_stats['misses'],
+                                len(_compiled_sql_cache))
+
+
+def clear_compiled_sql_cache():
+    """
+    Empty the cache of compiled query time restrictions and reset its
+    statistics.
+    """
+    _compiled_sql_cache.clear()
+    _compiled_sql_cache_stats.update(hits=0, misses=0)
+
+
+class QueryTimeRestriction(object):
+    """
+    A where clause element restricting a VersionedQuery to the versions valid
+    at its query time.  Its SQL is compiled once per database, model, table
+    alias and kind of restriction; later queries of the same shape only bind
+    the timestamp as parameter.
+
+    There are three kinds of restrictions:
+    - START: version_start_date <= time
+    - END: (version_end_date > time OR version_end_date IS NULL)
+    - CURRENT: version_end_date IS NULL
+    """
+    START = 'start'
+    END = 'end'
+    CURRENT = 'current'
+
+    def __init__(self, model, alias, kind, time=None):
+        self.model = model
+        self.alias = alias
+        self.kind = kind
+        self.time = time
+
+    def _field(self):
+        name = 'version_start_date' if self.kind == self.START \
+            else 'version_end_date'
+        return self.model._meta.get_field(name)
+
+    def _build(self):
+        """
+        Build the lookups expressing the restriction, as add_q() would.
+        """
+        field = self._field()
+        col = field.get_col(self.alias)
+        if self.kind == self.START:
+            return field.get_lookup('lte')(col, self.time)
+        is_null = field.get_lookup('isnull')(col, True)
+        if self.kind == self.CURRENT:
+            return is_null
+        from .fields import VersionedWhereNode
+        return VersionedWhereNode(
+            [field.get_lookup('gt')(col, self.time), is_null], connector='OR')
+
+    def as_sql(self, compiler, connection):
+        key = (connection.alias, self.model, self.alias, self.kind)
+        sql = _compiled_sql_cache.get(key)
+        if sql is None:
+            _compiled_sql_cache_stats['misses'] += 1
+            sql, params = compiler.compile(self._build())
+            _compiled_sql_cache[key] = sql
+            return sql, params
+        _compiled_sql_cache_stats['hits'] += 1
+        if self.kind == self.CURRENT:
+            return sql, []
+        return sql, [self._field().get_db_prep_value(self.time, connection)]
+
+
+_compiling = threading.local()
+
+
+class VersionedCompilerMixin(object):
+    """
+    Restricts the where clause of compiled VersionedQueries to the versions
+    valid at their query time.  The restriction only exists in the compiler,
+    the query is left unchanged.
+
+    A VersionedQuery without query time that is compiled as a subquery of
+    another VersionedQuery (e.g. in Exists() or in a __in lookup) inherits
+    the query time of the outer query.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(VersionedCompilerMixin, self).__init__(*args, **kwargs)
+        self.querytime = self.query.querytime
+
+    def as_sql(self, *args, **kwargs):
+        outer_querytimes = getattr(_compiling, 'querytimes', None)
+        if outer_querytimes is None:
+            outer_querytimes = _compiling.querytimes = []
+        self.querytime = self.query.querytime
+        if not self.querytime.active and outer_querytimes:
+            self.querytime = outer_querytimes[-1]
+        outer_querytimes.append(self.querytime)
+        try:
+            return super(VersionedCompilerMixin, self).as_sql(*args, **kwargs)
+        finally:
+            outer_querytimes.pop()
+
+    def pre_sql_setup(self):
+        result = super(VersionedCompilerMixin, self).pre_sql_setup()
+        restrictions = self.query.get_querytime_restrictions(self.querytime)
+        if restrictions:
+            where = self.where
+            if where is None:
+                where = self.query.where_class(restrictions)
+            elif where.connector == AND and not where.negated:
+                where = where._new_instance(where.children + restrictions,
+                                            AND)
+            else:
+                where = where._new_instance([where] + restrictions, AND)
+            self.where = where
+        return result
+
+
+class HistoryTableCompilerMixin(object):
+    """
+    Makes SQL compilers read from both the main and the history table of
+    models using a history table, unless only current versions are queried.
+    """
+
+    def compile(self, node, *args, **kwargs):
+        sql, params = super(HistoryTableCompilerMixin, self).compile(
+            node, *args, **kwargs)
+        if isinstance(node, (BaseTable, Join)) and \
+                node.table_name in _history_models:
+            querytime = self.querytime
+            if not (querytime.active and querytime.time is None):
+                sql = self._history_table_source(node, sql)
+        return sql, params
+
+    def _history_table_source(self, node, sql):
+        """
+        Replace the table reference in the given FROM clause element by a
+        UNION ALL of the main and the history table.
+        """
+        qn = self.connection.ops.quote_name
+        history_model = _history_models[node.table_name]
+        columns = ', '.join(
+            qn(f.column) for f in history_model._meta.concrete_fields)
+        union = 'SELECT {cols} FROM {main} UNION ALL ' \
+                'SELECT {cols} FROM {history}'.format(
+                    cols=columns, main=qn(node.table_name),
+                    history=qn(history_model._meta.db_table))
+        table = self.quote_name_unless_alias(node.table_name)
+        if node.table_alias == node.table_name:
+            reference = alias = table
+        else:
+            reference = '%s %s' % (table, node.table_alias)
+            alias = node.table_alias
+        return sql.replace(reference, '(%s) %s' % (union, alias), 1)
 
 
 class VersionedQuery(Query):
@@ -366,30 +979,56 @@ class VersionedQuery(Query):
             pass
         return _clone
 
-    def get_compiler(self, *args, **kwargs):
+    def get_querytime_restrictions(self, querytime=None):
+        """
+        Get the where clause elements restricting the query to the versions
+        valid at its query time, if any.
+
+        :param QueryTime querytime: the query time to use instead of the
+            query's own one
+        :return: list of QueryTimeRestriction
+        """
+        querytime = querytime or self.querytime
+        if not querytime.active:
+            return []
+        time = querytime.time
+        if time is None:
+            restrictions = [(QueryTimeRestriction.CURRENT, None)]
+        else:
+            # For a period, the versions must start before its end and end
+            # after its start
+            until = time if querytime.until is None else querytime.until
+            restrictions = [(QueryTimeRestriction.END, time),
+                            (QueryTimeRestriction.START, until)]
+        alias = self.get_initial_alias()
+        return [QueryTimeRestriction(self.model, alias, kind, time)
+                for kind, time in restrictions]
+
+    def get_compiler(self, using=None, connection=None):
         """
         Add the query time restriction limit at the last moment.  Applying it
         earlier (e.g. by adding a filter to the queryset) does not allow the
         caching of related object to work (they are attached to a queryset;
         filter() returns a new queryset).
+
+        The restriction is added by the compiler (see VersionedCompilerMixin)
+        and never stored in the query, so that a query can be cloned and
+        compiled any number of times.
         """
-        if self.querytime.active and \
-                (not hasattr(self, '_querytime_filter_added') or
-                    not self._querytime_filter_added):
-            time = self.querytime.time
-            if time is None:
-                self.add_q(Q(version_end_date__isnull=True))
-            else:
-                self.add_q(
-                    (Q(version_end_date__gt=time) |
-                     Q(version_end_date__isnull=True)) &
-                    Q(version_start_date__lte=time)
-                )
-            # Ensure applying these filters happens only a single time (even
-            # if it doesn't falsify the query, it's just not very comfortable
-            # to read)
-            self._querytime_filter_added = True
-        return super(VersionedQuery, self).get_compiler(*args, **kwargs)
+        if using is None and connection is None:
+            raise ValueError("Need either using or connection")
+        if using:
+            connection = connections[using]
+        compiler_class = connection.ops.compiler(self.compiler)
+        key = (compiler_class, bool(_history_models))
+        if key not in _versioned_compilers:
+            mixins = (VersionedCompilerMixin,)
+            if _history_models:
+                mixins += (HistoryTableCompilerMixin,)
+            _versioned_compilers[key] = type(
+                str('Versioned' + compiler_class.__name__),
+                mixins + (compiler_class,), {})
+        return _versioned_compilers[key](self, connection, using)
 
     def build_filter(self, filter_expr, **kwargs):
         """
@@ -435,6 +1074,12 @@ class VersionedQuery(Query):
         :return: tuple
         """
         lookup, value = filter_expr
+        if isinstance(self.annotations.get(lookup.split(LOOKUP_SEP)[0]),
+                      FieldChanged):
+            raise NotSupportedError(
+                'The flags added by with_changes() can not be filtered on, '
+                'as they are computed after the filters; filter the returned '
+                'objects by their changed_fields instead')
         if self.querytime.active \
                 and isinstance(value, Versionable) and not value.is_latest:
             new_lookup = \
@@ -442,6 +1087,29 @@ class VersionedQuery(Query):
             filter_expr = (new_lookup, value.identity)
         return super(VersionedQuery, self).build_filter(filter_expr, **kwargs)
 
+    def get_aggregation(self, using, added_aggregate_names):
+        """
+        Leaves the flags added by with_changes() out of aggregations (e.g.
+        count()).  They do not change the number of rows, and with them,
+        Django would aggregate over a subquery grouped by the primary key,
+        where their window function is not allowed.
+        """
+        flags = set(alias for alias, annotation in self.annotations.items()
+                    if isinstance(annotation, FieldChanged))
+        if flags:
+            if any(_refers_to(self.annotations[name], flags)
+                   for name in added_aggregate_names):
+                raise NotSupportedError(
+                    'The flags added by with_changes() can not be '
+                    'aggregated')
+            for alias in flags:
+                del self.annotations[alias]
+            if self.annotation_select_mask is not None:
+                self.set_annotation_mask(
+                    self.annotation_select_mask - flags)
+        return super(VersionedQuery, self).get_aggregation(
+            using, added_aggregate_names)
+
     def add_immediate_loading(self, field_names):
         # TODO: Decide, whether we always want versionable fields to be loaded,
         # even if ``only`` is used and they would be deferred
@@ -449,6 +1117,58 @@ class VersionedQuery(Query):
         super(VersionedQuery, self).add_immediate_loading(field_names)
 
 
+def _refers_to(expression, aliases):
+    """
+    Tells whether the expression refers to any of the given annotations.
+    """
+    if isinstance(expression, Ref) and expression.refs in aliases:
+        return True
+    return any(_refers_to(source, aliases)
+               for source in expression.get_source_expressions()
+               if source is not None)
+
+
+class FieldChanged(models.Expression):
+    """
+    Evaluates to 1 if the value of a field differs from its value in the
+    previous version of the same object, and to 0 otherwise (or if there is
+    no previous version).  The previous version is found with the LAG window
+    function, among the rows selected by the query.
+    """
+    contains_aggregate = False
+    contains_over_clause = True
+
+    def __init__(self, field_name):
+        super(FieldChanged, self).__init__(output_field=models.IntegerField())
+        self.field_name = field_name
+
+    def resolve_expression(self, query=None, allow_joins=True, reuse=None,
+                           summarize=False, for_save=False):
+        c = self.copy()
+        c.is_summary = summarize
+        c.columns = [models.F(name).resolve_expression(
+            query, allow_joins, reuse, summarize, for_save)
+            for name in (self.field_name, 'id', 'identity',
+                         'version_start_date')]
+        return c
+
+    def get_source_expressions(self):
+        return getattr(self, 'columns', [])
+
+    def set_source_expressions(self, exprs):
+        self.columns = exprs
+
+    def as_sql(self, compiler, connection):
+        # The columns are plain column references, without parameters
+        value, id, identity, start = [compiler.compile(column)[0]
+                                      for column in self.columns]
+        window = 'OVER (PARTITION BY {} ORDER BY {})'.format(identity, start)
+        return ('CASE WHEN LAG({id}) {w} IS NULL THEN 0 '
+                'WHEN {v} = LAG({v}) {w} OR '
+                '({v} IS NULL AND LAG({v}) {w} IS NULL) THEN 0 '
+                'ELSE 1 END'.format(id=id, v=value, w=window), [])
+
+
 class VersionedQuerySet(QuerySet):
     """
     The VersionedQuerySet makes sure that every objects retrieved from it has
@@ -537,7 +1257,12 @@ class VersionedQuerySet(QuerySet):
         :return: Returns the item itself with the time set
         """
         if isinstance(item, Versionable):
-            item._querytime = self.querytime
+            if self.querytime.until is None:
+                item._querytime = self.querytime
+            else:
+                # A version valid during a period has no single point in
+                # time to follow its relations at
+                item._querytime = QueryTime(time=None, active=False)
         elif isinstance(item, VersionedQuerySet):
             item.querytime = self.querytime
         else:
@@ -559,6 +1284,225 @@ class VersionedQuerySet(QuerySet):
         clone.querytime = QueryTime(time=qtime, active=True)
         return clone
 
+    def during(self, start, end):
+        """
+        Restricts the queryset to the versions valid at any point in time
+        between start and end, both included; as_of(t) is the same as
+        during(t, t).  The versions of related objects joined by the query
+        are restricted to the same period.
+
+        The returned objects may contain several versions of an object.
+        Their query time is not set, as they are not valid at a single
+        point in time.
+
+        :param datetime start: start of the period
+        :param datetime end: end of the period
+        :return: VersionedQuerySet
+        """
+        if start is None or end is None or end < start:
+            raise ValueError(
+                'during() requires a start and an end, with start <= end')
+        clone = self._clone()
+        clone.querytime = QueryTime(time=start, active=True, until=end)
+        return clone
+
+    def with_changes(self, fields=None):
+        """
+        Annotates each version with the names of the fields whose values
+        differ from the previous version of the same object, available as
+        the changed_fields attribute of the returned objects.
+
+        The comparison is done by the database, using the LAG window
+        function over the versions of each identity ordered by their
+        version_start_date.  The previous version is looked up among the
+        versions selected by the queryset, so it should select whole
+        histories (e.g. filter on identity, not on time).  Slicing is
+        applied after the comparison, and count() leaves it out; filtering
+        on it raises NotSupportedError.
+
+        :param list fields: names of the fields to compare; defaults to all
+            fields except the versioning fields
+        :return: VersionedQuerySet
+        """
+        if fields is None:
+            fields = [f.name for f in self.model._meta.concrete_fields
+                      if f.name not in self.model.VERSIONABLE_FIELDS]
+        return self.annotate(**dict(
+            (CHANGED_FLAG_PREFIX + name, FieldChanged(name))
+            for name in fields))
+
+    def count_series(self, timestamps, field=None, as_array=False):
+        """
+        Counts the objects of the queryset existing at each of the given
+        points in time, with a single query joining the versions against the
+        list of points in time.
+
+        The versions selected by the queryset are considered, regardless of
+        its query time; the filters of the queryset apply to each version.
+
+        :param list timestamps: the points in time to count the objects at
+        :param str field: name of a field to group the counts by; the counts
+            are then returned per value of the field, each object being
+            counted for the value of its version valid at the point in time
+        :param bool as_array: whether to return NumPy arrays instead of lists
+            (requires NumPy)
+        :return: the counts, in the order of timestamps; if field is given,
+            an OrderedDict mapping the values of the field to their counts
+        """
+        timestamps = list(timestamps)
+        opts = self.model._meta
+        start_field = opts.get_field('version_start_date')
+        group_field = opts.get_field(field) if field else None
+        if group_field and group_field.is_relation:
+            to_python = group_field.target_field.to_python
+        elif group_field:
+            to_python = group_field.to_python
+        using = self.db
+        connection = connections[using]
+        qn = connection.ops.quote_name
+
+        queryset = self.order_by()
+        queryset.querytime = QueryTime(time=None, active=False)
+        columns = ['version_start_date', 'version_end_date']
+        if group_field:
+            columns.append(group_field.name)
+        inner_sql, inner_params = queryset.values(
+            *columns).query.get_compiler(using).as_sql()
+
+        if group_field:
+            select = 'ts.column1, v.{}, COUNT(*)'.format(
+                qn(group_field.column))
+            join = 'INNER JOIN'
+            group_by = 'ts.column1, v.{}'.format(qn(group_field.column))
+        else:
+            select = 'ts.column1, COUNT(v.{})'.format(
+                qn('version_start_date'))
+            join = 'LEFT OUTER JOIN'
+            group_by = 'ts.column1'
+        sql = ('SELECT {select} FROM ({timestamps}) ts {join} ({inner}) v '
+               'ON v.{start} <= ts.column2 AND (v.{end} > ts.column2 OR '
+               'v.{end} IS NULL) GROUP BY {group_by}')
+
+        if connection.vendor in ('postgresql', 'sqlite'):
+            row_sql, separator = '({}, %s)', ', '
+            prefix = 'VALUES '
+        else:
+            row_sql = 'SELECT {} AS column1, %s AS column2'
+            if connection.vendor == 'oracle':
+                row_sql += ' FROM DUAL'
+            separator, prefix = ' UNION ALL ', ''
+        # Each timestamp takes a parameter; the parameters of the filters are
+        # repeated in every batch and take up the remainder of the limit
+        max_params = getattr(connection.features, 'max_query_params', None)
+        if max_params is None and connection.vendor == 'sqlite':
+            # Not declared by the SQLite backend of Django < 2.0
+            max_params = 999
+        batch_size = connection.ops.bulk_batch_size(['timestamp'], timestamps)
+        if max_params:
+            batch_size = min(batch_size, max_params - len(inner_params))
+        batch_size = max(batch_size, 1)
+
+        counts = [0] * len(timestamps)
+        groups = OrderedDict()
+        with connection.cursor() as cursor:
+            for offset in range(0, len(timestamps), batch_size):
+                batch = timestamps[offset:offset + batch_size]
+                cursor.execute(sql.format(
+                    select=select, join=join, inner=inner_sql,
+                    group_by=group_by, start=qn('version_start_date'),
+                    end=qn('version_end_date'),
+                    timestamps=prefix + separator.join(
+                        row_sql.format(offset + i)
+                        for i in range(len(batch)))),
+                    [start_field.get_db_prep_value(t, connection)
+                     for t in batch] + list(inner_params))
+                for row in cursor.fetchall():
+                    if group_field:
+                        value = to_python(row[1])
+                        if value not in groups:
+                            groups[value] = [0] * len(timestamps)
+                        groups[value][row[0]] = row[2]
+                    else:
+                        counts[row[0]] = row[1]
+
+        if as_array:
+            import numpy
+            counts = numpy.array(counts, dtype=numpy.int64)
+            for value in groups:
+                groups[value] = numpy.array(groups[value], dtype=numpy.int64)
+        return groups if group_field else counts
+
+    def to_timeseries(self, field, start, end, step, fill_value=None,
+                      dtype=object):
+        """
+        Samples the value of a field of the objects of the queryset at
+        regular intervals, into a NumPy array with a row per object and a
+        column per point in time (requires NumPy).
+
+        The versions valid in the sampled period are fetched with a single
+        streamed query; the points in time each version is valid at are
+        looked up with numpy.searchsorted.  The versions selected by the
+        queryset are considered, regardless of its query time.
+
+        :param str field: name of the field to sample
+        :param datetime start: the first point in time
+        :param datetime end: the end of the sampled period (excluded)
+        :param timedelta step: the interval between two points in time
+        :param fill_value: the value of objects not existing at a point in
+            time
+        :param dtype: the NumPy data type of the values
+        :return: TimeSeries; identities lists the identities of the rows,
+            timestamps the sampled points in time, and values the array
+        """
+        import numpy
+
+        def microseconds(timestamp):
+            delta = timestamp - epoch
+            return (delta.days * 86400 + delta.seconds) * 10 ** 6 + \
+                delta.microseconds
+
+        epoch = datetime.datetime(1970, 1, 1, tzinfo=start.tzinfo and utc)
+        step_microseconds = microseconds(epoch + step)
+        if step_microseconds <= 0:
+            raise ValueError('step must be positive')
+        samples = numpy.arange(microseconds(start), microseconds(end),
+                               step_microseconds, dtype=numpy.int64)
+        timestamps = [start + i * step for i in range(len(samples))]
+
+        queryset = self.order_by('identity', 'version_start_date')
+        queryset.querytime = QueryTime(time=None, active=False)
+        versions = queryset.filter(
+            Q(version_end_date__gt=start) | Q(version_end_date__isnull=True),
+            version_start_date__lt=end,
+        ).values_list('identity', 'version_start_date', 'version_end_date',
+                      field).iterator()
+
+        identities = []
+        rows = []
+        never = numpy.iinfo(numpy.int64).max
+        while True:
+            chunk = list(itertools.islice(versions, GET_ITERATOR_CHUNK_SIZE))
+            if not chunk:
+                break
+            row_indexes = []
+            for identity, _, _, _ in chunk:
+                if not identities or identities[-1] != identity:
+                    identities.append(identity)
+                    rows.append(numpy.full(len(samples), fill_value,
+                                           dtype=dtype))
+                row_indexes.append(len(rows) - 1)
+            first = numpy.searchsorted(samples, numpy.array(
+                [microseconds(v[1]) for v in chunk], dtype=numpy.int64))
+            last = numpy.searchsorted(samples, numpy.array(
+                [never if v[2] is None else microseconds(v[2])
+                 for v in chunk], dtype=numpy.int64))
+            for row, i, j, version in zip(row_indexes, first, last, chunk):
+                rows[row][i:j] = version[3]
+
+        values = numpy.array(rows, dtype=dtype) if rows else \
+            numpy.full((0, len(samples)), fill_value, dtype=dtype)
+        return TimeSeries(identities, timestamps, values)
+
     def delete(self):
         """
         Deletes the records in the QuerySet.
@@ -597,18 +1541,30 @@ class Versionable(models.Model):
     """
     VERSION_IDENTIFIER_FIELD = 'id'
     OBJECT_IDENTIFIER_FIELD = 'identity'
+    VERSION_NUMBER_FIELD = None
+    VERSION_HISTORY_TABLE = False
+    VERSION_RETENTION = None
+    VERSION_TRACK_CHANGES = False
     VERSIONABLE_FIELDS = [VERSION_IDENTIFIER_FIELD, OBJECT_IDENTIFIER_FIELD,
                           'version_start_date',
                           'version_end_date', 'version_birth_date']
 
-    if versions_settings.VERSIONS_USE_UUIDFIELD:
+    if versions_settings.VERSIONS_COMPACT_UUID_STORAGE:
+        id = CompactUUIDField(primary_key=True)
+        """id stands for ID and is the primary key; sometimes also referenced
+        as the surrogate key"""
+    elif versions_settings.VERSIONS_USE_UUIDFIELD:
         id = models.UUIDField(primary_key=True)
         """id stands for ID and is the primary key; sometimes also referenced
         as the surrogate key"""
     else:
         id = models.CharField(max_length=36, primary_key=True)
 
-    if versions_settings.VERSIONS_USE_UUIDFIELD:
+    if versions_settings.VERSIONS_COMPACT_UUID_STORAGE:
+        identity = CompactUUIDField()
+        """identity is used as the identifier of an object, ignoring its
+        versions; sometimes also referenced as the natural key"""
+    elif versions_settings.VERSIONS_USE_UUIDFIELD:
         identity = models.UUIDField()
         """identity is used as the identifier of an object, ignoring its
         versions; sometimes also referenced as the natural key"""
@@ -667,7 +1623,164 @@ class Versionable(models.Model):
                 setattr(self, self.OBJECT_IDENTIFIER_FIELD,
                         getattr(self, self.VERSION_IDENTIFIER_FIELD))
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Versionable, cls).from_db(db, field_names, values)
+        if cls.VERSION_TRACK_CHANGES:
+            # Keep the values as loaded, for detecting changes (see
+            # get_dirty_fields)
+            instance._loaded_values = dict(
+                (f.attname, getattr(instance, f.attname))
+                for f in cls._meta.concrete_fields
+                if f.attname in field_names)
+        return instance
+
+    def save(self, force_insert=False, force_update=False, using=None,
+             update_fields=None):
+        batch = get_active_batch()
+        if batch is not None:
+            # Written when the batch is flushed
+            batch.save(self, force_insert)
+            return
+        super(Versionable, self).save(force_insert, force_update, using,
+                                      update_fields)
+        self._set_loaded_values(update_fields)
+
+    def _set_loaded_values(self, update_fields=None):
+        if not self.VERSION_TRACK_CHANGES:
+            return
+        loaded_values = dict(getattr(self, '_loaded_values', None) or {})
+        for field in self._meta.concrete_fields:
+            if update_fields is None or field.name in update_fields or \
+                    field.attname in update_fields:
+                loaded_values[field.attname] = getattr(self, field.attname)
+        self._loaded_values = loaded_values
+
+    def _get_loaded_values(self):
+        """
+        Gets the values of the fields as loaded from or saved to the
+        database.  Unless VERSION_TRACK_CHANGES is set, they are read from
+        the row of this version.
+
+        :return: dict of values by attname, or None if the object was
+            neither loaded from nor saved to the database
+        """
+        if self.VERSION_TRACK_CHANGES:
+            return getattr(self, '_loaded_values', None)
+        if self._state.adding:
+            return None
+        attnames = [f.attname for f in self._meta.concrete_fields
+                    if f.name not in self.VERSIONABLE_FIELDS]
+        using = router.db_for_read(self.__class__, instance=self)
+        row = self.__class__._base_manager.using(using).filter(
+            pk=self.pk).values_list(*attnames).first()
+        if row is None:
+            return None
+        return dict(zip(attnames, row))
+
+    def get_dirty_fields(self):
+        """
+        Gets the names of the fields whose values were changed since the
+        object was loaded from or saved to the database.  Versioning fields
+        are not taken into account.
+
+        :return: list of field names, or None if the object was neither
+            loaded from nor saved to the database
+        """
+        return self._get_dirty_fields(self._get_loaded_values())
+
+    def _get_dirty_fields(self, loaded_values):
+        if loaded_values is None:
+            return None
+        return [f.name for f in self._meta.concrete_fields
+                if f.name not in self.VERSIONABLE_FIELDS and
+                (f.attname not in loaded_values or
+                 getattr(self, f.attname) != loaded_values[f.attname])]
+
+    def _revert_fields(self, field_names, loaded_values):
+        """
+        Sets the given fields back to their values as loaded from or saved to
+        the database.
+        """
+        for name in field_names:
+            field = self._meta.get_field(name)
+            setattr(self, field.attname, loaded_values.get(field.attname))
+            if field.is_relation:
+                # Forget the related object assigned to this version
+                forget_related_object(self, field)
+
+    def save_versioned(self, forced_version_date=None):
+        """
+        Saves the changes made to this current version as a new version, and
+        returns the new version.
+
+        If no field was changed since the object was loaded from or saved to
+        the database, nothing is written and the object itself is returned.
+        Otherwise, the object is cloned: the previous version is written with
+        the values as loaded, and only the changed columns are written for
+        the new version.  Like with clone(), the object itself becomes the
+        previous version.  Unless VERSION_TRACK_CHANGES is set, the values
+        as loaded are read from the database first.
+
+        Changes of many-to-many relations are written immediately by the
+        related managers; they are not taken into account.
+
+        :param forced_version_date: a timestamp including tzinfo; this value
+            is usually set only internally!
+        :return: Versionable
+        """
+        loaded_values = self._get_loaded_values()
+        dirty_fields = self._get_dirty_fields(loaded_values)
+        if dirty_fields is None:
+            raise ValueError(
+                'Instance must be saved before it can be saved as a new '
+                'version')
+        if not dirty_fields:
+            return self
+
+        batch = get_active_batch()
+        if batch is not None:
+            if forced_version_date is not None:
+                with immediate_writes(self):
+                    return self.save_versioned(forced_version_date)
+            if batch.is_pending(self):
+                # The changes are written along with the pending version
+                return self
+            # Both versions are written when the batch is flushed
+            later = self.clone()
+            self._revert_fields(dirty_fields, loaded_values)
+            return later
+
+        using = router.db_for_write(self.__class__, instance=self)
+        if forced_version_date is None and \
+                is_coalescible_version(self, using):
+            # This version was created in the current transaction already
+            self.save(update_fields=dirty_fields, using=using)
+            return self
+
+        with transaction.atomic(using=using):
+            later = self.clone(forced_version_date, in_bulk=True)
+            del self._not_created
+            self._revert_fields(dirty_fields, loaded_values)
+            self.save(force_insert=True, using=using)
+
+            update_fields = dirty_fields + ['version_start_date']
+            if self.VERSION_NUMBER_FIELD:
+                update_fields.append(self.VERSION_NUMBER_FIELD)
+            later.save(update_fields=update_fields, using=using)
+            log_version_events([VersionEvent.for_version(
+                VersionEvent.CLONED, later, later.version_start_date,
+                old_id=self.id, new_id=later.id)], using)
+        if forced_version_date is None:
+            register_coalescible_version(later, using)
+        return later
+
     def delete(self, using=None, keep_parents=False):
+        batch = get_active_batch()
+        if batch is not None:
+            # Terminated when the batch is flushed
+            batch.delete(self)
+            return
         using = using or router.db_for_write(self.__class__, instance=self)
         assert self._get_pk_val() is not None, \
             "{} object can't be deleted because its {} attribute is set to " \
@@ -678,6 +1791,43 @@ class Versionable(models.Model):
         collector.collect([self], keep_parents=keep_parents)
         collector.delete(get_utc_now())
 
+    def _save_table(self, raw=False, cls=None, force_insert=False,
+                    force_update=False, using=None, update_fields=None):
+        """
+        For models using a history table, store terminated versions in the
+        history table and remove them from the main table.
+        """
+        history_model = get_history_model(cls or self.__class__)
+        if history_model is None or raw:
+            return super(Versionable, self)._save_table(
+                raw, cls, force_insert, force_update, using, update_fields)
+
+        cls = cls or self.__class__
+        if self.version_end_date is None:
+            updated = super(Versionable, self)._save_table(
+                raw, cls, force_insert, force_update, using, update_fields)
+            if not updated and not self._state.adding:
+                # The version was read from the history table (e.g. restored)
+                DeleteQuery(history_model).delete_batch([self.pk], using)
+            return updated
+
+        history = history_model(**{
+            f.attname: getattr(self, f.attname)
+            for f in history_model._meta.concrete_fields
+        })
+        if force_insert or self._state.adding:
+            # A new version, e.g. the previous version written by clone()
+            history.save(force_insert=True, using=using)
+            return False
+        with transaction.atomic(using=using, savepoint=False):
+            if DeleteQuery(cls).delete_batch([self.pk], using):
+                # The version was terminated, move it to the history table
+                history.save(force_insert=True, using=using)
+            else:
+                # The version was read from the history table
+                history.save(using=using)
+        return True
+
     def _delete_at(self, timestamp, using=None):
         """
         WARNING: This method is only for internal use, it should not be used
@@ -700,6 +1850,19 @@ class Versionable(models.Model):
     def is_current(self):
         return self.version_end_date is None
 
+    @property
+    def changed_fields(self):
+        """
+        Names of the fields whose values differ from the previous version,
+        if this object was fetched from a queryset using with_changes();
+        None otherwise.
+        """
+        flags = [(f.name, self.__dict__.get(CHANGED_FLAG_PREFIX + f.name))
+                 for f in self._meta.concrete_fields]
+        if all(flag is None for name, flag in flags):
+            return None
+        return [name for name, flag in flags if flag]
+
     @property
     def is_latest(self):
         """
@@ -738,17 +1901,26 @@ class Versionable(models.Model):
         """
         Returns a uuid value that is valid to use for id and identity fields.
 
-        :return: unicode uuid object if using UUIDFields, uuid unicode string
-            otherwise.
+        New values are random (version 4) UUIDs, or time-ordered (version 7)
+        UUIDs if the VERSIONS_TIME_ORDERED_UUIDS setting is True.
+
+        :return: unicode uuid object if using UUIDFields or compact UUID
+            storage, uuid unicode string otherwise.
         """
         if uuid_value:
             if not validate_uuid(uuid_value):
+                if versions_settings.VERSIONS_TIME_ORDERED_UUIDS:
+                    raise ValueError("uuid_value must be a valid UUID "
+                                     "version 4 or version 7 object")
                 raise ValueError(
                     "uuid_value must be a valid UUID version 4 object")
+        elif versions_settings.VERSIONS_TIME_ORDERED_UUIDS:
+            uuid_value = uuid7()
         else:
             uuid_value = uuid.uuid4()
 
-        if versions_settings.VERSIONS_USE_UUIDFIELD:
+        if versions_settings.VERSIONS_USE_UUIDFIELD or \
+                versions_settings.VERSIONS_COMPACT_UUID_STORAGE:
             return uuid_value
         else:
             return six.u(str(uuid_value))
@@ -776,7 +1948,9 @@ class Versionable(models.Model):
             already, if not necessary; this value is usually set only
             internally for performance optimization
         :return: returns a fresh clone of the original object
-            (with adjusted relations)
+            (with adjusted relations), or the object itself if it was created
+            by cloning in the current transaction and
+            VERSIONS_TRANSACTION_COALESCING is enabled
         """
         if not self.pk:
             raise ValueError('Instance must be saved before it can be cloned')
@@ -785,6 +1959,21 @@ class Versionable(models.Model):
             raise ValueError(
                 'This is a historical item and can not be cloned.')
 
+        forced_version_date_given = forced_version_date is not None
+        batch = get_active_batch()
+        if batch is not None and (in_bulk or forced_version_date_given):
+            # The batch only records clones at its own timestamp
+            with immediate_writes(self):
+                return self.clone(forced_version_date, in_bulk)
+        batched = batch is not None
+        if batched:
+            if batch.is_pending(self):
+                # This version is created by the batch already
+                return self
+            # The versions are written when the batch is flushed
+            forced_version_date = batch.timestamp
+            in_bulk = True
+
         if forced_version_date:
             if not self.version_start_date <= forced_version_date <= \
                     get_utc_now():
@@ -804,11 +1993,20 @@ class Versionable(models.Model):
             raise ValueError(
                 'Can not clone a model instance that has deferred fields')
 
+        using = router.db_for_write(self.__class__, instance=self)
+        if not in_bulk and not forced_version_date_given and \
+                is_coalescible_version(self, using):
+            # This version was created in the current transaction already
+            return self
+
         earlier_version = self
 
         later_version = copy.copy(earlier_version)
         later_version.version_end_date = None
         later_version.version_start_date = forced_version_date
+        if self.VERSION_NUMBER_FIELD:
+            setattr(later_version, self.VERSION_NUMBER_FIELD,
+                    getattr(earlier_version, self.VERSION_NUMBER_FIELD) + 1)
 
         # set earlier_version's ID to a new UUID so the clone (later_version)
         # can get the old one -- this allows 'head' to always have the original
@@ -819,16 +2017,31 @@ class Versionable(models.Model):
         if not in_bulk:
             # This condition might save us a lot of database queries if we are
             # being called from a loop like in .clone_relations
-            earlier_version.save()
-            later_version.save()
+            with transaction.atomic(using=using, savepoint=False):
+                # The earlier version is a new row
+                earlier_version._state.adding = True
+                earlier_version.save(using=using)
+                later_version.save(using=using)
+                log_version_events([VersionEvent.for_version(
+                    VersionEvent.CLONED, later_version, forced_version_date,
+                    old_id=earlier_version.id, new_id=later_version.id)],
+                    using)
         else:
             earlier_version._not_created = True
 
+        if batched:
+            # The batch re-creates the ManyToMany relations when flushed
+            batch.add_clone(earlier_version, later_version)
+            return later_version
+
         # re-create ManyToMany relations
         for field_name in self.get_all_m2m_field_names():
             earlier_version.clone_relations(later_version, field_name,
                                             forced_version_date)
 
+        if not in_bulk and not forced_version_date_given:
+            register_coalescible_version(later_version, using)
+
         return later_version
 
     def at(self, timestamp):
@@ -946,6 +2159,11 @@ class Versionable(models.Model):
             raise ValueError(
                 'Can not restore a model instance that has deferred fields')
 
+        if get_active_batch() is not None:
+            # Restoring depends on the current state of the database
+            with immediate_writes(self):
+                return self.restore(**kwargs)
+
         cls = self.__class__
         now = get_utc_now()
         restored = copy.copy(self)
@@ -953,7 +2171,7 @@ class Versionable(models.Model):
         restored.version_start_date = now
 
         fields = [f for f in cls._meta.local_fields if
-                  f.name not in Versionable.VERSIONABLE_FIELDS]
+                  f.name not in self.VERSIONABLE_FIELDS]
         for field in fields:
             if field.attname in kwargs:
                 # Fake an object in order to avoid a DB roundtrip
@@ -986,8 +2204,16 @@ class Versionable(models.Model):
                 latest.delete()
                 restored.version_start_date = latest.version_end_date
 
+            if self.VERSION_NUMBER_FIELD:
+                setattr(restored, self.VERSION_NUMBER_FIELD,
+                        cls.objects.version_count(self) + 1)
+
             self.save()
             restored.save()
+            log_version_events([VersionEvent.for_version(
+                VersionEvent.RESTORED, restored, restored.version_start_date,
+                old_id=self.id, new_id=restored.id)],
+                router.db_for_write(cls, instance=restored))
 
             # Update ManyToMany relations to point to the old version's id
             # instead of the restored version's id.
@@ -1027,6 +2253,8 @@ class Versionable(models.Model):
         self.id = self.identity = self.uuid()
         self.version_start_date = self.version_birth_date = get_utc_now()
         self.version_end_date = None
+        if self.VERSION_NUMBER_FIELD:
+            setattr(self, self.VERSION_NUMBER_FIELD, 1)
         return self
 
     @staticmethod
@@ -1046,3 +2274,176 @@ class Versionable(models.Model):
         return (instance.version_start_date <= querytime.time and
                 (instance.version_end_date is None or
                  instance.version_end_date > querytime.time))
+
+
+class NumberedVersionable(Versionable):
+    """
+    A Versionable having a version_number column, which numbers the versions
+    of an object consecutively, starting at 1.
+
+    The version number is maintained by clone() and restore(). It is indexed
+    together with the identity, allowing direct lookups of a given version
+    (VersionManager.get_version), cheap version counts
+    (VersionManager.version_count) and fast navigation between adjacent
+    versions (VersionManager.next_version and previous_version).
+    """
+    VERSION_NUMBER_FIELD = 'version_number'
+    VERSIONABLE_FIELDS = Versionable.VERSIONABLE_FIELDS + [
+        VERSION_NUMBER_FIELD]
+
+    version_number = models.PositiveIntegerField(default=1)
+    """version_number is the ordinal of the version among all versions of
+    the same identity"""
+
+    class Meta(Versionable.Meta):
+        abstract = True
+        index_together = [('identity', 'version_number')]
+
+
+class VersionEventManager(models.Manager):
+    """
+    Reads the version event log in the order it was written.
+    """
+
+    def read(self, after=0, limit=1000):
+        """
+        Returns the events written after the event with the id ``after``.
+
+        :param int after: id of the last event read before
+        :param int limit: maximum number of events to return
+        :return: list of VersionEvent, ordered by id
+        """
+        return list(self.filter(id__gt=after).order_by('id')[:limit])
+
+    def tail(self, after=0, batch_size=1000):
+        """
+        Reads the events written after the event with the id ``after``, in
+        batches, until no more events are found.
+
+        :param int after: id of the last event read before
+        :param int batch_size: maximum number of events per batch
+        :return: generator of lists of VersionEvent, ordered by id
+        """
+        while True:
+            events = self.read(after, batch_size)
+            if not events:
+                return
+            yield events
+            after = events[-1].id
+
+
+class VersionEvent(models.Model):
+    """
+    An entry of the version event log, written in the same transaction as
+    the change of a Versionable object or a versioned many-to-many relation
+    it describes, if VERSIONS_EVENT_LOG is enabled.
+
+    For objects, ``old_id`` and ``new_id`` are the ids of the versions ended
+    and started by the change.  For many-to-many relations, ``model`` is the
+    intermediary model, ``identity`` the id of the source object and
+    ``related_id`` the id of the target object.
+    """
+    CREATED = 'created'
+    CLONED = 'cloned'
+    DELETED = 'deleted'
+    RESTORED = 'restored'
+    LINKED = 'linked'
+    UNLINKED = 'unlinked'
+    KIND_CHOICES = [(kind, kind) for kind in
+                    (CREATED, CLONED, DELETED, RESTORED, LINKED, UNLINKED)]
+
+    id = models.BigAutoField(primary_key=True)
+    """id increases monotonically, and is used to tail the log"""
+
+    timestamp = models.DateTimeField()
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    model = models.CharField(max_length=255)
+    """model is the label of the model, e.g. 'app_label.modelname'"""
+
+    identity = models.UUIDField()
+    old_id = models.UUIDField(null=True)
+    new_id = models.UUIDField(null=True)
+    related_id = models.UUIDField(null=True)
+
+    objects = VersionEventManager()
+
+    @classmethod
+    def for_version(cls, kind, version, timestamp, old_id=None,
+                    new_id=None):
+        return cls(kind=kind, model=version._meta.label_lower,
+                   identity=version.identity, old_id=old_id, new_id=new_id,
+                   timestamp=timestamp)
+
+    @classmethod
+    def for_relation(cls, kind, through, source, target, timestamp):
+        return cls(kind=kind, model=through._meta.label_lower,
+                   identity=source, related_id=target, timestamp=timestamp)
+
+    @classmethod
+    def for_relation_entry(cls, kind, entry, timestamp):
+        """
+        Creates an event for an entry of a versioned many-to-many
+        intermediary model.
+        """
+        through = entry.__class__
+        for field in through._meta.auto_created._meta.many_to_many:
+            if field.remote_field.through is through:
+                source = through._meta.get_field(field.m2m_field_name())
+                target = through._meta.get_field(
+                    field.m2m_reverse_field_name())
+                return cls.for_relation(kind, through,
+                                        getattr(entry, source.attname),
+                                        getattr(entry, target.attname),
+                                        timestamp)
+
+
+def log_version_events(events, using=None):
+    """
+    Writes the given VersionEvents, if VERSIONS_EVENT_LOG is enabled.
+
+    :param list events: list of VersionEvent
+    :param str using: alias of the database the versions are written to
+    """
+    if events and versions_settings.VERSIONS_EVENT_LOG:
+        VersionEvent.objects.using(using).bulk_create(events)
+
+
+def create_history_model(model):
+    """
+    Create the model of the history table of the given model. The history
+    table has the same columns as the model's table; relations are stored as
+    plain columns without constraints.
+
+    :param model: a Versionable model with VERSION_HISTORY_TABLE set to True
+    :return: the history model
+    """
+    attrs = {'__module__': model.__module__}
+    for field in model._meta.local_concrete_fields:
+        if field.is_relation:
+            target = field.target_field
+            name, path, args, kwargs = target.deconstruct()
+            for key in ('primary_key', 'unique', 'default'):
+                kwargs.pop(key, None)
+            kwargs.update(null=field.null, db_column=field.column,
+                          db_index=True)
+            attrs[field.attname] = target.__class__(*args, **kwargs)
+        else:
+            attrs[field.name] = field.clone()
+
+    class Meta:
+        app_label = model._meta.app_label
+        db_table = model._meta.db_table + '_history'
+        index_together = [('identity', 'version_start_date')]
+
+    attrs['Meta'] = Meta
+    name = str(model.__name__ + 'History')
+    return type(name, (models.Model,), attrs)
+
+
+def versionable_class_prepared(sender, **kwargs):
+    if issubclass(sender, Versionable) and sender.VERSION_HISTORY_TABLE \
+            and not sender._meta.abstract and not sender._meta.proxy:
+        _history_models[sender._meta.db_table] = create_history_model(sender)
+
+
+class_prepared.connect(versionable_class_prepared)
@@ -19,6 +19,10 @@ class VersionsSettings(object):
     defaults = {
         'VERSIONED_DELETE_COLLECTOR': 'versions.deletion.VersionedCollector',
         'VERSIONS_USE_UUIDFIELD': VERSION[:3] >= (1, 8, 3),
+        'VERSIONS_TIME_ORDERED_UUIDS': False,
+        'VERSIONS_COMPACT_UUID_STORAGE': False,
+        'VERSIONS_TRANSACTION_COALESCING': False,
+        'VERSIONS_EVENT_LOG': False,
     }
 
     def __getattr__(self, name):
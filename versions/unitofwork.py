@@ -0,0 +1,408 @@
+# Copyright 2014 Swisscom, Sophia Engineering
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.db import DEFAULT_DB_ALIAS, connections, router, transaction
+from django.db.models import Case, F, Q, Value, When
+from django.db.models.sql import UpdateQuery
+
+import versions.models
+from versions.settings import get_versioned_delete_collector_class, \
+    settings as versions_settings
+from versions.util import get_utc_now
+
+_local = threading.local()
+
+
+def get_active_batch():
+    """
+    Gets the VersionedBatch active in the current thread, or None.
+    """
+    return getattr(_local, 'batch', None)
+
+
+@contextmanager
+def immediate_writes(instance):
+    """
+    Suspends the VersionedBatch active in the current thread, if any, so that
+    the changes made within the block are written immediately.  This is used
+    by operations the batch cannot record, like restore() or clone() with a
+    forced version date.
+
+    :param instance: the Versionable changed within the block
+    :raises: ValueError if the batch records changes of the same object,
+        which would overwrite the changes made within the block
+    """
+    batch = get_active_batch()
+    if batch is not None and batch.has_pending_changes(instance):
+        raise ValueError(
+            'Can not write changes of %s %s immediately while changes of it '
+            'are pending in versions.batch()' % (
+                instance._meta.object_name, instance.identity))
+    _local.batch = None
+    try:
+        yield
+    finally:
+        _local.batch = batch
+
+
+class BatchCollectorMixin(object):
+    """
+    Terminates the collected versions with a single UPDATE statement per
+    model, instead of saving them one by one.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(BatchCollectorMixin, self).__init__(*args, **kwargs)
+        self.terminated = OrderedDict()
+
+    def versionable_delete(self, instance, timestamp):
+        model = instance.__class__
+        if versions.models.get_history_model(model) or \
+                instance.version_end_date is not None:
+            super(BatchCollectorMixin, self).versionable_delete(
+                instance, timestamp)
+        else:
+            self.terminated.setdefault(model, []).append(instance.pk)
+
+    def delete(self, timestamp):
+        with transaction.atomic(using=self.using, savepoint=False):
+            super(BatchCollectorMixin, self).delete(timestamp)
+            for model, pks in self.terminated.items():
+                UpdateQuery(model).update_batch(
+                    pks, {'version_end_date': timestamp}, self.using)
+
+
+def _insert(model, objs, using):
+    """
+    Inserts new versions with a bulk INSERT per table.
+    """
+    history_model = versions.models.get_history_model(model)
+    current = objs
+    if history_model is not None:
+        current = [obj for obj in objs if obj.version_end_date is None]
+        history_model._base_manager.using(using).bulk_create([
+            history_model(**dict(
+                (f.attname, getattr(obj, f.attname))
+                for f in history_model._meta.concrete_fields))
+            for obj in objs if obj.version_end_date is not None])
+    model._base_manager.using(using).bulk_create(current)
+
+
+def _is_changed(obj, field):
+    loaded_values = getattr(obj, '_loaded_values', None)
+    return loaded_values is None or field.attname not in loaded_values or \
+        getattr(obj, field.attname) != loaded_values[field.attname]
+
+
+def _update(model, objs, using, fields=None):
+    """
+    Updates existing rows with a single UPDATE statement per chunk of
+    objects, using a CASE expression per changed column.  Rows whose value
+    did not change keep the value of their column, which also gives the
+    expression the type of the column when all new values are NULL.
+    """
+    if fields is None:
+        # The identity and the birth date of a row never change
+        fixed = (model.OBJECT_IDENTIFIER_FIELD, 'version_birth_date')
+        fields = [f for f in model._meta.concrete_fields
+                  if not f.primary_key and f.name not in fixed]
+    connection = connections[using]
+    batch_size = connection.ops.bulk_batch_size(
+        ['pk'] * (2 * len(fields) + 1), objs) or 1
+    for start in range(0, len(objs), batch_size):
+        chunk = objs[start:start + batch_size]
+        values = {}
+        for field in fields:
+            whens = [
+                When(pk=obj.pk, then=Value(getattr(obj, field.attname),
+                                           output_field=field))
+                for obj in chunk if _is_changed(obj, field)]
+            if whens:
+                values[field.name] = Case(*whens, default=F(field.attname),
+                                          output_field=field)
+        if values:
+            model._base_manager.using(using).filter(
+                pk__in=[obj.pk for obj in chunk]).update(**values)
+
+
+class VersionedBatch(object):
+    """
+    A unit of work for Versionable objects, used by versions.batch().
+
+    While it is active, clone(), save() and delete() of Versionable objects
+    and adding and removing many-to-many relations are recorded instead of
+    being written to the database.  When it exits, the recorded changes are
+    written with a few bulk statements per model, in a single transaction.
+    All versions created or terminated by the batch share its timestamp.
+    """
+
+    def __init__(self, using=None, timestamp=None):
+        self.using = using
+        self.timestamp = timestamp
+        self.nested = False
+        self._writes = OrderedDict()
+        self._changed_objects = set()
+        self._forced_inserts = set()
+        self._clones = []
+        self._deletes = OrderedDict()
+        self._relation_adds = OrderedDict()
+        self._relation_removes = OrderedDict()
+        self._events = []
+
+    def __enter__(self):
+        active = get_active_batch()
+        if active is not None:
+            self.nested = True
+            return active
+        if self.timestamp is None:
+            self.timestamp = get_utc_now()
+        _local.batch = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.nested:
+            return
+        _local.batch = None
+        if exc_type is None:
+            self.flush()
+
+    def db_for_write(self, model):
+        return self.using or router.db_for_write(model)
+
+    def is_pending(self, instance):
+        """
+        Checks whether the given object is recorded to be written by the
+        batch.
+        """
+        return id(instance) in self._writes
+
+    def has_pending_changes(self, instance):
+        """
+        Checks whether the batch records changes of any version of the
+        object the given version belongs to.
+        """
+        return (instance.__class__, instance.identity) in \
+            self._changed_objects
+
+    def save(self, instance, force_insert=False):
+        if force_insert:
+            self._forced_inserts.add(id(instance))
+        if self.is_pending(instance):
+            return
+        if instance._state.adding and \
+                instance.version_start_date >= self.timestamp:
+            # Objects created while the batch is active share its timestamp
+            if instance.version_birth_date == instance.version_start_date:
+                instance.version_birth_date = self.timestamp
+            instance.version_start_date = self.timestamp
+        self._writes[id(instance)] = instance
+        self._changed_objects.add((instance.__class__, instance.identity))
+
+    def add_clone(self, earlier_version, later_version):
+        self._writes[id(earlier_version)] = earlier_version
+        self._writes[id(later_version)] = later_version
+        self._clones.append((earlier_version, later_version))
+        self._changed_objects.add(
+            (later_version.__class__, later_version.identity))
+
+    def delete(self, instance):
+        self._deletes[id(instance)] = instance
+        self._changed_objects.add((instance.__class__, instance.identity))
+
+    def add_relations(self, manager, objs):
+        targets = [manager.target_field.get_foreign_related_value(obj)[0]
+                   if isinstance(obj, manager.model) else obj
+                   for obj in objs]
+        key = (manager.through, manager.source_field_name,
+               manager.target_field_name)
+        source = manager.related_val[0]
+        pairs = self._relation_adds.setdefault(key, OrderedDict())
+        for target in targets:
+            pairs[(source, target)] = None
+        if manager.symmetrical:
+            key = (manager.through, manager.target_field_name,
+                   manager.source_field_name)
+            pairs = self._relation_adds.setdefault(key, OrderedDict())
+            for target in targets:
+                pairs[(target, source)] = None
+
+    def remove_relations(self, through, source_field_name, target_field_name,
+                         source, targets):
+        key = (through, source_field_name, target_field_name)
+        removes = self._relation_removes.setdefault(key, OrderedDict())
+        removes.setdefault(source, set()).update(targets)
+
+    def flush(self):
+        """
+        Writes the recorded changes to the database.
+        """
+        using = self.using or DEFAULT_DB_ALIAS
+        with transaction.atomic(using=using):
+            self._flush_writes()
+            self._flush_relation_clones()
+            self._flush_relation_adds()
+            self._flush_relation_removes()
+            versions.models.log_version_events(self._events, using)
+            self._flush_deletes()
+
+    def _log(self, kind, instance=None, relation=None, **kwargs):
+        if versions_settings.VERSIONS_EVENT_LOG:
+            VersionEvent = versions.models.VersionEvent
+            if relation is not None:
+                self._events.append(VersionEvent.for_relation_entry(
+                    kind, relation, self.timestamp))
+            else:
+                self._events.append(VersionEvent.for_version(
+                    kind, instance, self.timestamp, **kwargs))
+
+    def _flush_writes(self):
+        VersionEvent = versions.models.VersionEvent
+        inserts, updates = OrderedDict(), OrderedDict()
+        for instance in self._writes.values():
+            model = instance.__class__
+            if instance._state.adding or \
+                    getattr(instance, '_not_created', False) or \
+                    id(instance) in self._forced_inserts:
+                inserts.setdefault(model, []).append(instance)
+                if instance._state.adding:
+                    self._log(VersionEvent.CREATED, instance,
+                              new_id=instance.id)
+            elif instance.version_end_date is not None and \
+                    versions.models.get_history_model(model):
+                # Terminated versions move to the history table
+                instance.save(using=self.db_for_write(model))
+            else:
+                updates.setdefault(model, []).append(instance)
+
+        for model, objs in inserts.items():
+            _insert(model, objs, self.db_for_write(model))
+        for model, objs in updates.items():
+            _update(model, objs, self.db_for_write(model))
+
+        for instance in self._writes.values():
+            instance.__dict__.pop('_not_created', None)
+            instance._state.adding = False
+            instance._state.db = self.db_for_write(instance.__class__)
+            instance._set_loaded_values()
+
+    def _flush_relation_clones(self):
+        """
+        Re-creates the many-to-many relations of the cloned objects, like
+        Versionable.clone_relations does for a single clone.
+        """
+        clones = OrderedDict()
+        for earlier_version, later_version in self._clones:
+            clones.setdefault(earlier_version.__class__, []).append(
+                (earlier_version, later_version))
+
+        for earlier_version, later_version in self._clones:
+            self._log(versions.models.VersionEvent.CLONED, later_version,
+                      old_id=earlier_version.id, new_id=later_version.id)
+
+        for model, pairs in clones.items():
+            earlier_ids = dict((later.pk, earlier.pk)
+                               for earlier, later in pairs)
+            sample = pairs[0][1]
+            for field_name in sample.get_all_m2m_field_names():
+                manager = getattr(sample, field_name)
+                through = manager.through
+                using = self.db_for_write(through)
+                source = manager.source_field.attname
+                relations = list(through._base_manager.using(using).filter(
+                    **{source + '__in': list(earlier_ids)}))
+
+                current = [r for r in relations if r.is_current]
+                terminated_copies = []
+                for relation in current:
+                    terminated = copy.copy(relation)
+                    terminated.id = relation.uuid()
+                    terminated.version_end_date = self.timestamp
+                    setattr(terminated, source,
+                            earlier_ids[getattr(relation, source)])
+                    terminated_copies.append(terminated)
+                through._base_manager.using(using).bulk_create(
+                    terminated_copies)
+                through._base_manager.using(using).filter(
+                    pk__in=[r.pk for r in current]).update(
+                    version_start_date=self.timestamp)
+
+                # Entries that have been pointing the current object, but
+                # have never been 'current'
+                non_current = [r for r in relations if not r.is_current]
+                for relation in non_current:
+                    setattr(relation, source,
+                            earlier_ids[getattr(relation, source)])
+                if non_current:
+                    _update(through, non_current, using,
+                            [manager.source_field])
+
+    def _flush_relation_adds(self):
+        for (through, source_field_name, target_field_name), pairs in \
+                self._relation_adds.items():
+            using = self.db_for_write(through)
+            source = through._meta.get_field(source_field_name).attname
+            target = through._meta.get_field(target_field_name).attname
+            existing = set(through._base_manager.using(using).filter(**{
+                'version_end_date__isnull': True,
+                source + '__in': set(s for s, t in pairs),
+                target + '__in': set(t for s, t in pairs),
+            }).values_list(source, target))
+            relations = [
+                through(**{source: s, target: t,
+                           'version_start_date': self.timestamp,
+                           'version_birth_date': self.timestamp})
+                for s, t in pairs if (s, t) not in existing]
+            through._base_manager.using(using).bulk_create(relations)
+            for relation in relations:
+                self._log(versions.models.VersionEvent.LINKED,
+                          relation=relation)
+
+    def _flush_relation_removes(self):
+        for (through, source_field_name, target_field_name), removes in \
+                self._relation_removes.items():
+            using = self.db_for_write(through)
+            source = through._meta.get_field(source_field_name).attname
+            target = through._meta.get_field(target_field_name).attname
+            condition = Q()
+            for source_value, targets in removes.items():
+                condition |= Q(**{source: source_value,
+                                  target + '__in': targets})
+            relations = through._base_manager.using(using).filter(
+                condition, version_end_date__isnull=True)
+            if versions_settings.VERSIONS_EVENT_LOG:
+                for relation in relations:
+                    self._log(versions.models.VersionEvent.UNLINKED,
+                              relation=relation)
+            relations.update(version_end_date=self.timestamp)
+
+    def _flush_deletes(self):
+        by_database = OrderedDict()
+        for instance in self._deletes.values():
+            using = self.db_for_write(instance.__class__)
+            by_database.setdefault(using, OrderedDict()).setdefault(
+                instance.__class__, []).append(instance)
+
+        collector_class = type(
+            str('Batch' + get_versioned_delete_collector_class().__name__),
+            (BatchCollectorMixin, get_versioned_delete_collector_class()), {})
+        for using, instances_by_model in by_database.items():
+            collector = collector_class(using=using)
+            for instances in instances_by_model.values():
+                collector.collect(instances)
+            collector.delete(self.timestamp)
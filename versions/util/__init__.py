@@ -1,7 +1,31 @@
+import binascii
 import datetime
+import os
+import time
+import uuid
 
 from django.utils.timezone import utc
 
 
 def get_utc_now():
     return datetime.datetime.utcnow().replace(tzinfo=utc)
+
+
+def uuid7():
+    """
+    Returns a time-ordered UUID, laid out like a version 7 UUID: a 48 bit
+    Unix timestamp in milliseconds, followed by the version, 12 bits of
+    sub-millisecond precision, the variant and 62 random bits.
+
+    Consecutively generated values sort in creation order, so that new rows
+    are appended to the right-hand side of B-tree indexes instead of being
+    scattered over random index pages.
+
+    :return: uuid.UUID
+    """
+    nanoseconds = int(time.time() * 10 ** 9)
+    milliseconds, remainder = divmod(nanoseconds, 10 ** 6)
+    fraction = remainder * 4096 // 10 ** 6
+    random_bits = int(binascii.hexlify(os.urandom(8)), 16) & ((1 << 62) - 1)
+    return uuid.UUID(int=(milliseconds << 80) | (7 << 76) | (fraction << 64) |
+                     (2 << 62) | random_bits)
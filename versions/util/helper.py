@@ -1,9 +1,12 @@
 from __future__ import absolute_import
 
-from versions.models import Versionable
+import uuid
+
+from versions.models import CompactUUIDField, Versionable
 
 from django import VERSION
 from django.db import connection, connections
+from django.utils import six
 
 if VERSION >= (1, 7):
     from django.apps import apps
@@ -30,3 +33,80 @@ def get_app_models(app_name, include_auto_created=False):
 def versionable_models(app_name, include_auto_created=False):
     return [m for m in get_app_models(app_name, include_auto_created) if
             issubclass(m, Versionable)]
+
+
+def _is_uuid_field(field):
+    return isinstance(field, CompactUUIDField) or (
+        issubclass(field.model, Versionable) and field.name in (
+            Versionable.VERSION_IDENTIFIER_FIELD,
+            Versionable.OBJECT_IDENTIFIER_FIELD))
+
+
+def uuid_columns(model):
+    """
+    Gets the names of the columns of the given model that hold Versionable
+    UUID values: the id and identity columns of Versionable models, and the
+    columns of relations to them (VersionedForeignKeys, but also plain
+    ForeignKeys to a Versionable).
+
+    :param model: Django model
+    :return: list of column names
+    """
+    return [field.column for field in model._meta.concrete_fields
+            if _is_uuid_field(field) or (
+                field.is_relation and _is_uuid_field(field.target_field))]
+
+
+def convert_uuid_columns_to_binary(app_name, database=None):
+    """
+    Rewrites the UUID values stored as strings (as CharField or UUIDField
+    on databases without a native uuid type) into their 16 byte binary form,
+    as expected when VERSIONS_COMPACT_UUID_STORAGE is enabled.
+
+    Intended to be run from a data migration (RunPython), after the column
+    types have been altered. Values that are already binary are left
+    untouched, so running it several times should leave the database in the
+    same state as running it once.
+
+    :param str app_name: application name whose models will be acted on.
+    :param str database: database alias to use.  If None, use default
+        connection.
+    :return: number of rows updated
+    :rtype: int
+    """
+    connection = database_connection(database)
+    if connection.features.has_native_uuid_field:
+        return 0
+
+    def to_binary(value):
+        if value is None or (isinstance(value, (six.memoryview, bytearray)) or
+                             (isinstance(value, six.binary_type) and
+                              len(value) == 16)):
+            return value
+        if isinstance(value, six.binary_type):
+            value = value.decode('ascii')
+        return connection.Database.Binary(uuid.UUID(value).bytes)
+
+    qn = connection.ops.quote_name
+    rows_updated = 0
+    with connection.cursor() as cursor:
+        for model in get_app_models(app_name, include_auto_created=True):
+            columns = uuid_columns(model)
+            if not columns:
+                continue
+            table = qn(model._meta.db_table)
+            pk_column = qn(model._meta.pk.column)
+            cursor.execute("SELECT %s, %s FROM %s" % (
+                pk_column, ', '.join(qn(c) for c in columns), table))
+            updates = []
+            for row in cursor.fetchall():
+                values = [to_binary(value) for value in row[1:]]
+                if any(new is not old for new, old in zip(values, row[1:])):
+                    updates.append(values + [row[0]])
+            if updates:
+                cursor.executemany("UPDATE %s SET %s WHERE %s = %%s" % (
+                    table, ', '.join('%s = %%s' % qn(c) for c in columns),
+                    pk_column), updates)
+                rows_updated += len(updates)
+
+    return rows_updated
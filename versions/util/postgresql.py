@@ -1,8 +1,14 @@
 from __future__ import absolute_import
 
-from django.db import connection as default_connection
+import datetime
+import re
+
+from django.db import NotSupportedError, \
+    connection as default_connection, transaction
+from django.utils.timezone import utc
 
 from versions.fields import VersionedForeignKey
+from versions.util import get_utc_now
 from .helper import database_connection, versionable_models
 
 
@@ -180,3 +186,251 @@ def create_current_version_unique_identity_indexes(app_name, database=None):
                     indexes_created += 1
 
     return indexes_created
+
+
+def current_partition_name(model):
+    """
+    Gets the name of the partition holding the current versions of the given
+    model's partitioned table.
+
+    :param model: Django model
+    :return: table name
+    """
+    return '%s_current' % model._meta.db_table
+
+
+def history_partition_name(model, month):
+    """
+    Gets the name of the partition holding the versions of the given model
+    that were terminated during the given month.
+
+    :param model: Django model
+    :param datetime month: any point in time within the month
+    :return: table name
+    """
+    return '%s_p%04d_%02d' % (model._meta.db_table, month.year, month.month)
+
+
+def _month_start(timestamp):
+    return datetime.datetime(timestamp.year, timestamp.month, 1, tzinfo=utc)
+
+
+def _next_month(month):
+    if month.month == 12:
+        return month.replace(year=month.year + 1, month=1)
+    return month.replace(month=month.month + 1)
+
+
+def _table_is_partitioned(cursor, table_name):
+    cursor.execute("SELECT relkind FROM pg_class "
+                   "WHERE relname = %s AND pg_table_is_visible(oid)",
+                   [table_name])
+    row = cursor.fetchone()
+    return row is not None and row[0] == 'p'
+
+
+def _history_partitions(cursor, model):
+    """
+    Gets the history partitions of the given model's table, as a dict
+    mapping the start of each partition's month to the partition name.
+    """
+    cursor.execute("""
+        SELECT c.relname
+        FROM pg_inherits i
+             JOIN pg_class c ON c.oid = i.inhrelid
+             JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = %s
+    """, [model._meta.db_table])
+    pattern = re.compile(
+        r'^%s_p(\d{4})_(\d{2})$' % re.escape(model._meta.db_table))
+    partitions = {}
+    for (name,) in cursor.fetchall():
+        match = pattern.match(name)
+        if match:
+            month = datetime.datetime(int(match.group(1)),
+                                      int(match.group(2)), 1, tzinfo=utc)
+            partitions[month] = name
+    return partitions
+
+
+def _create_history_partitions(cursor, connection, model, first, last):
+    """
+    Creates the missing monthly history partitions from the month of first
+    to the month of last. Rows of the new partitions' ranges that were stored
+    in the current (default) partition are moved to the new partitions.
+    """
+    qn = connection.ops.quote_name
+    table = qn(model._meta.db_table)
+    current = qn(current_partition_name(model))
+    existing = _history_partitions(cursor, model)
+    created = 0
+    month = _month_start(first)
+    while month <= last:
+        upper = _next_month(month)
+        if month not in existing:
+            partition = qn(history_partition_name(model, month))
+            cursor.execute("CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS)"
+                           % (partition, table))
+            cursor.execute(
+                "WITH moved AS (DELETE FROM %s WHERE version_end_date >= %%s "
+                "AND version_end_date < %%s RETURNING *) "
+                "INSERT INTO %s SELECT * FROM moved" % (current, partition),
+                [month, upper])
+            cursor.execute(
+                "ALTER TABLE %s ATTACH PARTITION %s "
+                "FOR VALUES FROM (%%s) TO (%%s)" % (table, partition),
+                [month, upper])
+            created += 1
+        month = upper
+    return created
+
+
+def partition_versionable_table(model, months_ahead=3, database=None):
+    """
+    Converts the table of a Versionable model to a table partitioned by range
+    of version_end_date (requires PostgreSQL 11 or later).
+
+    Current versions (version_end_date IS NULL) are stored in the default
+    partition, named <table>_current.  Terminated versions are stored in
+    monthly partitions, named <table>_pYYYY_MM.  Partitions are created from
+    the month of the oldest terminated version up to months_ahead months from
+    now; use create_version_history_partitions to keep creating future
+    partitions.
+
+    Partitioned tables can not have a primary key or unique constraints
+    which do not include version_end_date, which is nullable.  The primary
+    key and unique indexes are therefore replaced by non-unique indexes,
+    except for partial unique indexes on current versions (see
+    create_current_version_unique_indexes), which are created on the current
+    partition.  Foreign key constraints of the table and referring to the
+    table are dropped.
+
+    Running it on an already partitioned table does nothing.
+
+    :param model: Versionable model whose table will be partitioned
+    :param int months_ahead: number of future months to create partitions for
+    :param str database: database alias to use.  If None, use default
+        connection.
+    :return: number of history partitions created
+    :rtype: int
+    :raises NotSupportedError: on PostgreSQL versions before 11
+    """
+    connection = database_connection(database)
+    if connection.pg_version < 110000:
+        # Default partitions were introduced with PostgreSQL 11
+        raise NotSupportedError(
+            'Partitioning a versionable table requires PostgreSQL 11 or '
+            'later')
+    qn = connection.ops.quote_name
+    table_name = model._meta.db_table
+    unpartitioned = qn(table_name + '_unpartitioned')
+
+    with transaction.atomic(using=connection.alias), \
+            connection.cursor() as cursor:
+        if _table_is_partitioned(cursor, table_name):
+            return 0
+
+        cursor.execute("SELECT indexdef FROM pg_indexes "
+                       "WHERE tablename = %s", [table_name])
+        index_definitions = [row[0] for row in cursor.fetchall()]
+        cursor.execute("SELECT MIN(version_end_date) FROM %s"
+                       % qn(table_name))
+        oldest = cursor.fetchone()[0]
+
+        cursor.execute("ALTER TABLE %s RENAME TO %s"
+                       % (qn(table_name), unpartitioned))
+        cursor.execute("CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS) "
+                       "PARTITION BY RANGE (version_end_date)"
+                       % (qn(table_name), unpartitioned))
+        cursor.execute("CREATE TABLE %s PARTITION OF %s DEFAULT"
+                       % (qn(current_partition_name(model)),
+                          qn(table_name)))
+
+        now = get_utc_now()
+        last = now
+        for i in range(months_ahead):
+            last = _next_month(_month_start(last))
+        created = _create_history_partitions(
+            cursor, connection, model, oldest or now, last)
+
+        cursor.execute("INSERT INTO %s SELECT * FROM %s"
+                       % (qn(table_name), unpartitioned))
+        cursor.execute("DROP TABLE %s CASCADE" % unpartitioned)
+
+        for definition in index_definitions:
+            if definition.startswith('CREATE UNIQUE INDEX'):
+                if 'WHERE (version_end_date IS NULL)' in definition:
+                    definition = re.sub(
+                        r' ON (\S+?)%s USING ' % re.escape(table_name),
+                        r' ON \g<1>%s USING '
+                        % current_partition_name(model), definition)
+                else:
+                    definition = definition.replace(
+                        'CREATE UNIQUE INDEX', 'CREATE INDEX', 1)
+            cursor.execute(definition)
+
+    return created
+
+
+def create_version_history_partitions(model, months_ahead=3, database=None):
+    """
+    Creates the missing monthly history partitions of a table partitioned by
+    partition_versionable_table, up to months_ahead months from now.
+
+    Terminated versions falling into a month without partition are stored in
+    the current partition until then, so this should be run regularly (e.g.
+    in a monthly maintenance job).  Running it several times should leave the
+    database in the same state as running it once.
+
+    :param model: Versionable model whose table is partitioned
+    :param int months_ahead: number of future months to create partitions for
+    :param str database: database alias to use.  If None, use default
+        connection.
+    :return: number of history partitions created
+    :rtype: int
+    """
+    connection = database_connection(database)
+    with transaction.atomic(using=connection.alias), \
+            connection.cursor() as cursor:
+        existing = sorted(_history_partitions(cursor, model))
+        now = get_utc_now()
+        last = now
+        for i in range(months_ahead):
+            last = _next_month(_month_start(last))
+        first = existing[-1] if existing else now
+        return _create_history_partitions(
+            cursor, connection, model, min(first, now), last)
+
+
+def detach_version_history_partitions(model, before, database=None):
+    """
+    Detaches the history partitions of a table partitioned by
+    partition_versionable_table which only hold versions terminated before
+    the given point in time.
+
+    Detaching a partition is a metadata operation; the detached tables keep
+    their data and can be archived or dropped afterwards.  The versions they
+    hold are not visible through the model anymore.
+
+    :param model: Versionable model whose table is partitioned
+    :param datetime before: versions terminated before this point in time
+        are detached
+    :param str database: database alias to use.  If None, use default
+        connection.
+    :return: names of the detached tables
+    :rtype: list
+    """
+    connection = database_connection(database)
+    qn = connection.ops.quote_name
+    detached = []
+    with transaction.atomic(using=connection.alias), \
+            connection.cursor() as cursor:
+        partitions = _history_partitions(cursor, model)
+        for month in sorted(partitions):
+            if _next_month(month) > before:
+                break
+            cursor.execute("ALTER TABLE %s DETACH PARTITION %s"
+                           % (qn(model._meta.db_table),
+                              qn(partitions[month])))
+            detached.append(partitions[month])
+    return detached
@@ -1,11 +1,13 @@
 # -*- coding: utf-8 -*-
+import datetime
+
 from django.db.models import CharField, IntegerField, Model, ForeignKey, \
     CASCADE
 from django.db.models.deletion import DO_NOTHING, PROTECT, SET, SET_NULL
 from django.utils.encoding import python_2_unicode_compatible
 
 from versions.fields import VersionedManyToManyField, VersionedForeignKey
-from versions.models import Versionable
+from versions.models import NumberedVersionable, Versionable
 
 
 def versionable_description(obj):
@@ -141,6 +143,8 @@ class Classroom(Versionable):
 
 @python_2_unicode_compatible
 class Student(Versionable):
+    VERSION_RETENTION = datetime.timedelta(days=365)
+
     name = CharField(max_length=200)
     professors = VersionedManyToManyField("Professor", related_name='students')
     classrooms = VersionedManyToManyField("Classroom", related_name='students')
@@ -236,6 +240,14 @@ class Color(Versionable):
     name = CharField(max_length=40)
 
 
+class Paint(Model):
+    """
+    A non-versioned model referencing a version of a Versionable with a plain
+    ForeignKey.
+    """
+    color = ForeignKey(Color, related_name='paints', on_delete=CASCADE)
+
+
 ############################################
 # IntegrationNonVersionableModelsTests models
 @python_2_unicode_compatible
@@ -281,3 +293,42 @@ class Person(Versionable):
     name = CharField(max_length=200)
     children = VersionedManyToManyField('self', symmetrical=False,
                                         related_name='parents')
+
+
+############################################
+# NumberedVersionTest models
+class Track(NumberedVersionable):
+    name = CharField(max_length=200)
+
+
+############################################
+# HistoryTableTest models
+@python_2_unicode_compatible
+class Label(Versionable):
+    VERSION_HISTORY_TABLE = True
+
+    name = CharField(max_length=200)
+
+    __str__ = versionable_description
+
+
+@python_2_unicode_compatible
+class Release(Versionable):
+    VERSION_HISTORY_TABLE = True
+
+    name = CharField(max_length=200)
+    label = VersionedForeignKey(Label, null=True, db_constraint=False,
+                                related_name='releases', on_delete=CASCADE)
+
+    __str__ = versionable_description
+
+
+############################################
+# SaveVersionedTest models
+@python_2_unicode_compatible
+class Memo(Versionable):
+    VERSION_TRACK_CHANGES = True
+
+    text = CharField(max_length=200)
+
+    __str__ = versionable_description
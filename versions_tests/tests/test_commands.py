@@ -1,5 +1,15 @@
+import datetime
+from time import sleep
+
 from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils.six import StringIO
+
+from versions.maintenance import compact_versions, prune_versions
+from versions.models import get_utc_now
+from versions_tests.models import Professor, Student, Track
 
 APP_NAME = 'versions_tests'
 
@@ -7,3 +17,175 @@ APP_NAME = 'versions_tests'
 class TestMigrations(TestCase):
     def test_makemigrations_command(self):
         call_command('makemigrations', APP_NAME, dry_run=True, verbosity=0)
+
+
+class PruneVersionsTest(TestCase):
+    def setUp(self):
+        self.professor = Professor.objects.create(name='professor')
+        self.student = Student.objects.create(name='v1')
+        self.student.professors.add(self.professor)
+        for name in ('v2', 'v3'):
+            self.student = self.student.clone()
+            self.student.name = name
+            self.student.save()
+        self.through = Student.professors.through
+
+    def age_history(self, days):
+        """
+        Moves the terminated versions of the student back in time.
+        """
+        delta = datetime.timedelta(days=days)
+        for model in (Student, self.through):
+            for version in model.objects.filter(
+                    version_end_date__isnull=False):
+                model.objects.filter(pk=version.pk).update(
+                    version_start_date=version.version_start_date - delta,
+                    version_end_date=version.version_end_date - delta,
+                    version_birth_date=version.version_birth_date - delta)
+
+    def test_prune_versions(self):
+        batches = list(prune_versions(Student, get_utc_now(), batch_size=1))
+        # Two terminated student versions and two terminated through rows
+        self.assertEqual([1, 1, 1, 1], batches)
+        self.assertEqual(1, Student.objects.count())
+        self.assertEqual(1, self.through.objects.count())
+
+        current = Student.objects.current.get()
+        self.assertEqual(['professor'],
+                         [p.name for p in current.professors.all()])
+        self.assertEqual(current, Student.objects.previous_version(current))
+        self.assertLess(current.version_birth_date,
+                        current.version_start_date)
+
+    def dangling_through_rows(self):
+        """
+        Gets the many-to-many rows referring to versions that do not exist.
+        """
+        return list(self.through.objects.exclude(
+            student_id__in=Student.objects.values('id'),
+            professor_id__in=Professor.objects.values('id')).values_list(
+            'student_id', 'professor_id'))
+
+    def test_prune_keeps_foreign_keys_valid(self):
+        for deleted in prune_versions(Student, get_utc_now(), batch_size=1):
+            self.assertEqual([], self.dangling_through_rows())
+
+    def test_prune_reverse_side(self):
+        self.professor = self.professor.clone()
+        self.professor.name = 'professor v2'
+        self.professor.save()
+        self.assertEqual(4, self.through.objects.count())
+
+        for deleted in prune_versions(Professor, get_utc_now(),
+                                      batch_size=1):
+            self.assertEqual([], self.dangling_through_rows())
+        self.assertEqual(1, Professor.objects.count())
+        self.assertEqual(['professor v2'],
+                         [p.name for p in self.student.professors.all()])
+
+    def test_prune_respects_retention(self):
+        out = StringIO()
+        call_command('versions_prune', APP_NAME, stdout=out)
+        self.assertIn('versions_tests.Student: 0 rows deleted',
+                      out.getvalue())
+        self.assertEqual(3, Student.objects.count())
+
+        self.age_history(400)
+        out = StringIO()
+        call_command('versions_prune', APP_NAME, batch_size=2, stdout=out)
+        self.assertIn('versions_tests.Student: 4 rows deleted',
+                      out.getvalue())
+        self.assertIn('rows/s', out.getvalue())
+        self.assertEqual(1, Student.objects.count())
+        self.assertEqual(1, self.through.objects.count())
+        self.assertEqual(1, Professor.objects.count())
+
+
+class CompactVersionsTest(TestCase):
+    def setUp(self):
+        self.professor = Professor.objects.create(name='professor')
+        self.student = Student.objects.create(name='v1')
+        self.student.professors.add(self.professor)
+        sleep(0.001)
+        self.t1 = get_utc_now()
+        for name in ('v1', 'v1', 'v2'):
+            sleep(0.001)
+            self.student = self.student.clone()
+            self.student.name = name
+            self.student.save()
+        self.through = Student.professors.through
+
+    def test_compact_versions(self):
+        self.assertEqual(4, Student.objects.count())
+        self.assertEqual(4, self.through.objects.count())
+
+        self.assertEqual(4, sum(compact_versions(Student, batch_size=1)))
+
+        self.assertEqual(
+            [('v1', None), ('v2', self.student.id)],
+            [(s.name, s.id if s.id == s.identity else None)
+             for s in Student.objects.order_by('version_start_date')])
+        v1 = Student.objects.as_of(self.t1).get()
+        self.assertEqual(v1.version_birth_date, v1.version_start_date)
+        self.assertEqual(v1.version_end_date,
+                         self.student.version_start_date)
+        self.assertEqual(['professor'], [p.name for p in v1.professors.all()])
+
+        # The many-to-many entry was split by each clone
+        self.assertEqual(2, self.through.objects.count())
+        self.assertEqual(['professor'],
+                         [p.name for p in self.student.professors.all()])
+        self.assertEqual(0, sum(compact_versions(Student)))
+
+    def test_compact_reverse_side(self):
+        for i in range(2):
+            sleep(0.001)
+            self.professor = self.professor.clone()
+            self.professor.save()
+        self.assertEqual(6, self.through.objects.count())
+
+        # The unchanged versions of the professor, and the splits of the
+        # many-to-many entries made by cloning it
+        self.assertEqual(2 + 2, sum(compact_versions(Professor)))
+        self.assertEqual(1, Professor.objects.count())
+        # An entry for each version of the student remains
+        self.assertEqual(4, self.through.objects.count())
+        self.assertEqual(['professor'],
+                         [p.name for p in self.student.professors.all()])
+
+    def test_compact_renumbers_versions(self):
+        track = Track.objects.create(name='v1')
+        for name in ('v1', 'v2', 'v2'):
+            track = track.clone()
+            track.name = name
+            track.save()
+
+        self.assertEqual(2, sum(compact_versions(Track)))
+        self.assertEqual(
+            [(1, 'v1'), (2, 'v2')],
+            [(t.version_number, t.name)
+             for t in Track.objects.order_by('version_start_date')])
+
+    def test_compact_statements_per_batch(self):
+        def compact_queries(names):
+            for name in names:
+                track = Track.objects.create(name=name)
+                for i in range(4):
+                    track = track.clone()
+                    track.save()
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual([4 * len(names)],
+                                 list(compact_versions(Track)))
+            return len(queries)
+
+        self.assertEqual(compact_queries(['a', 'b']),
+                         compact_queries(['c', 'd', 'e', 'f', 'g', 'h']))
+        self.assertEqual(
+            [1] * 8, [t.version_number for t in Track.objects.all()])
+
+    def test_compact_command(self):
+        out = StringIO()
+        call_command('versions_compact', APP_NAME, stdout=out)
+        self.assertIn('versions_tests.Student: 4 rows removed',
+                      out.getvalue())
+        self.assertEqual(2, Student.objects.count())
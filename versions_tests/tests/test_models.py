@@ -18,29 +18,41 @@ import datetime
 import itertools
 import re
 import uuid
-from time import sleep
+from time import sleep, time
 from unittest import skip, skipUnless
 
 from django import get_version
 from django.core.exceptions import SuspiciousOperation, ObjectDoesNotExist, \
     ValidationError
-from django.db import connection, IntegrityError, transaction
-from django.db.models import Q, Count, Prefetch, Sum
+from django.core.paginator import Paginator
+from django.db import connection, IntegrityError, NotSupportedError, \
+    transaction
+from django.db.models import Q, Count, Exists, OuterRef, Prefetch, Sum
 from django.db.models.deletion import ProtectedError
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import six
 from django.utils.timezone import utc
 
+import versions
 from versions.exceptions import DeletionOfNonCurrentVersionError
-from versions.models import get_utc_now, ForeignKeyRequiresValueError, \
-    Versionable
+from versions.index import HistoryIndex
+from versions.models import clear_compiled_sql_cache, \
+    compiled_sql_cache_info, get_history_model, get_utc_now, \
+    ForeignKeyRequiresValueError, Versionable, VersionEvent
+from versions.util import uuid7
 from versions_tests.models import (
-    Award, B, C1, C2, C3, City, Classroom, Directory, Fan, Mascot, NonFan,
-    Observer, Person, Player, Professor, Pupil,
-    RabidFan, Student, Subject, Teacher, Team, Wine, WineDrinker,
+    Award, B, C1, C2, C3, City, Classroom, Directory, Fan, Label, Mascot,
+    Memo, NonFan, Observer, Person, Player, Professor, Pupil, RabidFan,
+    Release, Student, Subject, Teacher, Team, Track, Wine, WineDrinker,
     WineDrinkerHat, WizardFan
 )
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 def get_relation_table(model_class, fieldname):
     field_object = model_class._meta.get_field(fieldname)
@@ -478,6 +490,73 @@ class VersionNavigationTest(TestCase):
                           lambda: B.objects.next_version(v3))
 
 
+class NumberedVersionTest(TestCase):
+    def setUp(self):
+        self.track = Track.objects.create(name='v1')
+        for name in ('v2', 'v3'):
+            self.track = self.track.clone()
+            self.track.name = name
+            self.track.save()
+
+    def test_version_numbers_are_consecutive(self):
+        versions = Track.objects.filter(
+            identity=self.track.identity).order_by('version_start_date')
+        self.assertEqual([(1, 'v1'), (2, 'v2'), (3, 'v3')],
+                         [(t.version_number, t.name) for t in versions])
+        self.assertEqual(3, self.track.version_number)
+        self.assertEqual(self.track.id, self.track.identity)
+
+    def test_get_version(self):
+        v2 = Track.objects.get_version(self.track, 2)
+        self.assertEqual('v2', v2.name)
+        self.assertLess(v2.as_of, v2.version_end_date)
+        self.assertEqual('v3', Track.objects.get_version(self.track, 3).name)
+        self.assertRaises(ObjectDoesNotExist,
+                          lambda: Track.objects.get_version(self.track, 4))
+        self.assertRaises(ValueError,
+                          lambda: Track.objects.get_version(self.track, 0))
+
+    def test_get_version_without_number_column(self):
+        b, t1, t2, t3 = set_up_one_object_with_3_versions()
+        self.assertEqual('v1', B.objects.get_version(b, 1).name)
+        self.assertEqual('v2', B.objects.get_version(b, 2).name)
+        self.assertEqual('v3', B.objects.get_version(b, 3).name)
+        self.assertRaises(ObjectDoesNotExist,
+                          lambda: B.objects.get_version(b, 4))
+        self.assertEqual(3, B.objects.version_count(b))
+
+    def test_version_count(self):
+        self.assertEqual(3, Track.objects.version_count(self.track))
+        other = Track.objects.create(name='other')
+        self.assertEqual(1, Track.objects.version_count(other))
+
+    def test_navigation(self):
+        v1 = Track.objects.get_version(self.track, 1)
+        v2 = Track.objects.next_version(v1)
+        self.assertEqual('v2', v2.name)
+        self.assertEqual('v3', Track.objects.next_version(v2).name)
+        self.assertEqual('v3', Track.objects.next_version(self.track).name)
+
+        self.assertEqual('v2', Track.objects.previous_version(self.track).name)
+        self.assertEqual('v1', Track.objects.previous_version(v2).name)
+        self.assertEqual('v1', Track.objects.previous_version(v1).name)
+
+    def test_restore(self):
+        v1 = Track.objects.get_version(self.track, 1)
+        restored = v1.restore()
+        self.assertEqual(4, restored.version_number)
+        self.assertEqual('v1', restored.name)
+        self.assertEqual(1, Track.objects.get(pk=v1.pk).version_number)
+        self.assertEqual(4, Track.objects.version_count(self.track))
+        self.assertEqual('v3', Track.objects.previous_version(restored).name)
+
+    def test_detach(self):
+        detached = self.track.detach()
+        detached.save()
+        self.assertEqual(1, detached.version_number)
+        self.assertEqual(1, Track.objects.version_count(detached))
+
+
 class VersionNavigationAsOfTest(TestCase):
     def setUp(self):
         city1 = City.objects.create(name='city1')
@@ -2914,6 +2993,1400 @@ class SpecifiedUUIDTest(TestCase):
         self.assertEqual(p.name, Person.objects.previous_version(p2).name)
 
 
+class TimeOrderedUUIDTest(TestCase):
+    def test_uuid7_layout(self):
+        before = int(time() * 1000)
+        value = uuid7()
+        self.assertEqual(7, value.version)
+        self.assertEqual(uuid.RFC_4122, value.variant)
+        # The first 48 bits hold the creation time in milliseconds
+        self.assertGreaterEqual(value.int >> 80, before)
+        self.assertLessEqual(value.int >> 80, int(time() * 1000))
+
+    def test_uuid7_values_are_ordered(self):
+        values = []
+        for _ in range(5):
+            values.append(uuid7())
+            sleep(0.001)
+        self.assertEqual(values, sorted(values, key=lambda v: v.int))
+
+    @override_settings(VERSIONS_TIME_ORDERED_UUIDS=True)
+    def test_create_and_clone_use_time_ordered_ids(self):
+        b = B.objects.create(name='v1')
+        self.assertEqual(7, uuid.UUID(str(b.id)).version)
+        sleep(0.001)
+        b.clone()
+        historic = B.objects.filter(identity=b.identity,
+                                    version_end_date__isnull=False).get()
+        self.assertEqual(7, uuid.UUID(str(historic.id)).version)
+        self.assertGreater(uuid.UUID(str(historic.id)).int,
+                           uuid.UUID(str(b.identity)).int)
+
+    def test_specified_uuid7_requires_setting(self):
+        p_id = uuid7()
+        with six.assertRaisesRegex(self, ValueError, 'version 4 object'):
+            Person.objects.create(id=p_id, name="Alice")
+        with self.settings(VERSIONS_TIME_ORDERED_UUIDS=True):
+            p = Person.objects.create(id=p_id, name="Alice")
+            with six.assertRaisesRegex(self, ValueError,
+                                       'version 4 or version 7 object'):
+                Person.objects.create(id=uuid.uuid1(), name="Bob")
+        self.assertEqual(str(p_id), str(p.identity))
+
+
+class HistoryTableTest(TestCase):
+    def setUp(self):
+        self.label = Label.objects.create(name='label v1')
+        self.release = Release.objects.create(name='release v1',
+                                              label=self.label)
+        sleep(0.001)
+        self.t1 = get_utc_now()
+        sleep(0.001)
+        self.label = self.label.clone()
+        self.label.name = 'label v2'
+        self.label.save()
+        self.release = self.release.clone()
+        self.release.name = 'release v2'
+        self.release.save()
+        sleep(0.001)
+        self.t2 = get_utc_now()
+
+    def stored_names(self, model):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT name FROM {} ORDER BY name'.format(
+                connection.ops.quote_name(model._meta.db_table)))
+            return [row[0] for row in cursor.fetchall()]
+
+    def test_history_model(self):
+        history_model = get_history_model(Release)
+        self.assertEqual('versions_tests_release_history',
+                         history_model._meta.db_table)
+        self.assertEqual(
+            [f.column for f in Release._meta.concrete_fields],
+            [f.column for f in history_model._meta.concrete_fields])
+        self.assertIsNone(get_history_model(B))
+
+    def test_terminated_versions_are_moved(self):
+        self.assertEqual(['label v2'], self.stored_names(Label))
+        self.assertEqual(['label v1'],
+                         self.stored_names(get_history_model(Label)))
+
+        self.label.delete()
+        self.assertEqual([], self.stored_names(Label))
+        self.assertEqual(['label v1', 'label v2'],
+                         self.stored_names(get_history_model(Label)))
+
+    def test_clone_statements(self):
+        # The insert of the previous version into the history table and the
+        # update of the current version
+        with self.assertNumQueries(2):
+            self.label.clone()
+
+    def test_delete_statements(self):
+        # The delete from the table and the insert into the history table
+        with self.assertNumQueries(2):
+            self.label._delete_at(get_utc_now())
+        self.assertEqual([], self.stored_names(Label))
+
+    def test_save_historic_version(self):
+        label = Label.objects.as_of(self.t1).get()
+        label.name = 'label v1 fixed'
+        label.save()
+        self.assertEqual(['label v2'], self.stored_names(Label))
+        self.assertEqual(['label v1 fixed'],
+                         self.stored_names(get_history_model(Label)))
+
+    def test_queries(self):
+        self.assertEqual(['label v2'],
+                         [label.name for label in Label.objects.current.all()])
+        self.assertEqual('label v1', Label.objects.as_of(self.t1).get().name)
+        self.assertEqual(2, Label.objects.count())
+        self.assertEqual(self.label,
+                         Label.objects.current_version(self.label))
+        self.assertEqual('label v1',
+                         Label.objects.previous_version(self.label).name)
+
+    def test_relations(self):
+        self.assertEqual(
+            ['release v1'],
+            [r.name for r in Release.objects.as_of(self.t1).filter(
+                label__name='label v1')])
+        self.assertEqual(
+            ['release v2'],
+            [r.name for r in Release.objects.current.filter(
+                label__name='label v2')])
+        self.assertFalse(Release.objects.current.filter(
+            label__name='label v1').exists())
+
+        label_v1 = Label.objects.as_of(self.t1).get()
+        self.assertEqual(['release v1'],
+                         [r.name for r in label_v1.releases.all()])
+        self.assertEqual('label v1',
+                         Release.objects.as_of(self.t1).get().label.name)
+
+    def test_restore(self):
+        v1 = Label.objects.as_of(self.t1).get()
+        restored = v1.restore()
+        self.assertEqual('label v1', restored.name)
+        self.assertEqual([restored.pk],
+                         [label.pk for label in Label.objects.current.all()])
+        self.assertEqual(3, Label.objects.count())
+        self.assertEqual(1, len(self.stored_names(Label)))
+        self.assertEqual(2, len(self.stored_names(get_history_model(Label))))
+
+
+class SaveVersionedTest(TestCase):
+    def test_no_changes(self):
+        B.objects.create(name='v1')
+        b = B.objects.current.get()
+        self.assertEqual([], b.get_dirty_fields())
+        with self.assertNumQueries(1):
+            # Reads the values as stored
+            self.assertIs(b, b.save_versioned())
+        self.assertEqual(1, B.objects.count())
+
+    def test_loaded_values_not_kept(self):
+        B.objects.create(name='v1')
+        b = B.objects.current.get()
+        self.assertFalse(hasattr(b, '_loaded_values'))
+        B.objects.filter(pk=b.pk).update(name='v2')
+        b.name = 'v2'
+        self.assertEqual([], b.get_dirty_fields())
+
+    def test_track_changes(self):
+        Memo.objects.create(text='v1')
+        memo = Memo.objects.current.get()
+        self.assertEqual('v1', memo._loaded_values['text'])
+        with self.assertNumQueries(0):
+            self.assertIs(memo, memo.save_versioned())
+
+        memo.text = 'v2'
+        with self.assertNumQueries(0):
+            self.assertEqual(['text'], memo.get_dirty_fields())
+        current = memo.save_versioned()
+        self.assertEqual('v1', memo.text)
+        self.assertEqual([], current.get_dirty_fields())
+        self.assertEqual(
+            ['v1', 'v2'],
+            [m.text for m in Memo.objects.order_by('version_start_date')])
+
+    def test_changes(self):
+        B.objects.create(name='v1')
+        b = B.objects.current.get()
+        b.name = 'v2'
+        self.assertEqual(['name'], b.get_dirty_fields())
+
+        current = b.save_versioned()
+        self.assertEqual([], current.get_dirty_fields())
+        self.assertEqual(current.identity, current.id)
+        self.assertEqual('v1', b.name)
+        self.assertEqual(b.version_end_date, current.version_start_date)
+        self.assertEqual(
+            ['v1', 'v2'],
+            [v.name for v in B.objects.order_by('version_start_date')])
+
+        current.name = 'v3'
+        current = current.save_versioned()
+        self.assertEqual('v3', B.objects.current.get().name)
+        self.assertEqual(3, B.objects.count())
+
+    def test_unsaved_object(self):
+        self.assertRaises(ValueError, lambda: B(name='b').save_versioned())
+
+    def test_foreign_key_changes(self):
+        city1 = City.objects.create(name='city1')
+        city2 = City.objects.create(name='city2')
+        Team.objects.create(name='team', city=city1)
+        team = Team.objects.current.get()
+        team.city = city2
+        self.assertEqual(['city'], team.get_dirty_fields())
+
+        current = team.save_versioned()
+        self.assertEqual('city2', Team.objects.current.get().city.name)
+        self.assertEqual(city1.id, team.city_id)
+        self.assertEqual('city1', team.city.name)
+        self.assertEqual(2, Team.objects.count())
+        self.assertEqual(city2.id, current.city_id)
+
+    def test_many_to_many_relations(self):
+        professor = Professor.objects.create(name='professor')
+        student = Student.objects.create(name='v1')
+        student.professors.add(professor)
+        student = Student.objects.current.get()
+        student.name = 'v2'
+        student = student.save_versioned()
+
+        self.assertEqual(['professor'],
+                         [p.name for p in student.professors.all()])
+        previous = Student.objects.previous_version(student)
+        self.assertEqual('v1', previous.name)
+        self.assertEqual(['professor'],
+                         [p.name for p in previous.professors.all()])
+
+    def test_version_number(self):
+        Track.objects.create(name='v1')
+        track = Track.objects.current.get()
+        track.name = 'v2'
+        track = track.save_versioned()
+        self.assertEqual(2, Track.objects.current.get().version_number)
+        self.assertEqual(1, Track.objects.get_version(track, 1).version_number)
+
+
+@override_settings(VERSIONS_TRANSACTION_COALESCING=True)
+class TransactionCoalescingTest(TransactionTestCase):
+    def setUp(self):
+        self.b = B.objects.create(name='v1')
+
+    def names(self):
+        return [b.name for b in B.objects.order_by('version_start_date')]
+
+    def test_clones_in_transaction_are_coalesced(self):
+        with transaction.atomic():
+            b = self.b.clone()
+            b.name = 'v2'
+            b.save()
+            coalesced = b.clone()
+            self.assertIs(b, coalesced)
+            coalesced.name = 'v3'
+            coalesced.save()
+        self.assertEqual(['v1', 'v3'], self.names())
+
+        with transaction.atomic():
+            b = b.clone()
+            b.name = 'v4'
+            b.save()
+        self.assertEqual(['v1', 'v3', 'v4'], self.names())
+
+    def test_clones_without_transaction(self):
+        b = self.b.clone()
+        b.save()
+        self.assertIsNot(b, b.clone())
+        self.assertEqual(3, B.objects.count())
+
+    def test_forced_version_date(self):
+        with transaction.atomic():
+            b = self.b.clone()
+            self.assertIsNot(b, b.clone(forced_version_date=get_utc_now()))
+
+    def test_rolled_back_savepoint(self):
+        with transaction.atomic():
+            try:
+                with transaction.atomic():
+                    b = self.b.clone()
+                    raise IntegrityError
+            except IntegrityError:
+                pass
+            self.assertIsNot(b, b.clone())
+
+    def test_rolled_back_transaction(self):
+        try:
+            with transaction.atomic():
+                b = self.b.clone()
+                b.name = 'v2'
+                b.save()
+                raise IntegrityError
+        except IntegrityError:
+            pass
+        self.assertEqual(['v1'], self.names())
+        with transaction.atomic():
+            self.assertIsNot(b, b.clone())
+
+    @override_settings(VERSIONS_TRANSACTION_COALESCING=False)
+    def test_disabled(self):
+        with transaction.atomic():
+            b = self.b.clone()
+            self.assertIsNot(b, b.clone())
+
+    def test_save_versioned(self):
+        with transaction.atomic():
+            b = B.objects.current.get()
+            b.name = 'v2'
+            b = b.save_versioned()
+            b.name = 'v3'
+            self.assertIs(b, b.save_versioned())
+        self.assertEqual(['v1', 'v3'], self.names())
+
+
+class BatchTest(TestCase):
+    def setUp(self):
+        self.objects = [B.objects.create(name='%d v1' % i) for i in range(20)]
+
+    def test_clone_and_save(self):
+        with versions.batch() as batch:
+            cloned = []
+            for b in B.objects.current.all():
+                b = b.clone()
+                b.name = b.name.replace('v1', 'v2')
+                b.save()
+                cloned.append(b)
+            # Cloning again returns the version created by the batch
+            self.assertIs(cloned[0], cloned[0].clone())
+            created = B.objects.create(name='new')
+        self.assertEqual(41, B.objects.count())
+        self.assertEqual(
+            sorted(['%d v2' % i for i in range(20)] + ['new']),
+            sorted(b.name for b in B.objects.current.all()))
+        self.assertEqual(
+            set([batch.timestamp]),
+            set(b.version_start_date for b in B.objects.current.all()))
+        self.assertEqual(
+            set([batch.timestamp]),
+            set(b.version_end_date for b in B.objects.filter(
+                version_end_date__isnull=False)))
+        self.assertEqual(batch.timestamp, created.version_birth_date)
+        self.assertEqual(cloned[3].name.replace('v2', 'v1'),
+                         B.objects.previous_version(cloned[3]).name)
+        self.assertEqual([], cloned[3].get_dirty_fields())
+
+    def test_write_statements(self):
+        # A savepoint, one INSERT, one UPDATE and the release
+        with self.assertNumQueries(4):
+            with versions.batch():
+                for b in self.objects:
+                    b = b.clone()
+                    b.name = 'v2'
+                    b.save()
+
+    def test_delete(self):
+        with versions.batch() as batch:
+            for b in self.objects[:10]:
+                b.delete()
+        self.assertEqual(10, B.objects.current.count())
+        self.assertEqual(
+            set([batch.timestamp]),
+            set(b.version_end_date for b in B.objects.filter(
+                version_end_date__isnull=False)))
+        self.assertEqual(batch.timestamp, self.objects[0].version_end_date)
+
+    def test_unchanged_columns_are_not_written(self):
+        with CaptureQueriesContext(connection) as queries:
+            with versions.batch():
+                b = self.objects[0].clone()
+                b.name = '0 v2'
+                b.save()
+        update = [q['sql'] for q in queries.captured_queries
+                  if q['sql'].startswith('UPDATE')]
+        self.assertEqual(1, len(update))
+        self.assertIn('version_start_date', update[0])
+        self.assertNotIn('version_birth_date', update[0])
+        self.assertNotIn('"identity"', update[0])
+
+    def test_exception_discards_changes(self):
+        try:
+            with versions.batch():
+                self.objects[0].delete()
+                B.objects.create(name='new')
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(20, B.objects.current.count())
+
+    def versions_of(self, b):
+        return [(v.name, v.is_current) for v in B.objects.filter(
+            identity=b.identity).order_by('version_start_date')]
+
+    def test_save_versioned(self):
+        b = self.objects[0]
+        with versions.batch() as batch:
+            b.name = '0 v2'
+            later = b.save_versioned()
+            self.assertEqual(1, B.objects.filter(identity=b.identity).count())
+        self.assertEqual([('0 v1', False), ('0 v2', True)],
+                         self.versions_of(b))
+        self.assertEqual(batch.timestamp, later.version_start_date)
+
+    def test_clone_with_forced_version_date(self):
+        b = self.objects[0]
+        with versions.batch():
+            later = b.clone(forced_version_date=get_utc_now())
+            later.name = '0 v2'
+            later.save()
+            self.assertEqual(2, B.objects.filter(identity=b.identity).count())
+        self.assertEqual([('0 v1', False), ('0 v2', True)],
+                         self.versions_of(b))
+
+    def test_restore(self):
+        old = self.objects[0]
+        current = old.clone()
+        current.name = '0 v2'
+        current.save()
+        with versions.batch():
+            restored = old.restore()
+        self.assertEqual([('0 v1', False), ('0 v2', False), ('0 v1', True)],
+                         self.versions_of(old))
+        self.assertEqual(restored, B.objects.current.get(
+            identity=old.identity))
+
+    def test_immediate_write_of_pending_object(self):
+        b = self.objects[0]
+        with versions.batch():
+            b.name = '0 v2'
+            b.save()
+            with self.assertRaises(ValueError):
+                b.clone(forced_version_date=get_utc_now())
+        self.assertEqual([('0 v2', True)], self.versions_of(b))
+
+    def test_force_insert(self):
+        b = self.objects[0]
+        copy = B(id=B.uuid(), identity=b.identity, name='0 v0',
+                 version_start_date=b.version_start_date - datetime.timedelta(
+                     days=1),
+                 version_end_date=b.version_start_date,
+                 version_birth_date=b.version_birth_date)
+        copy._state.adding = False
+        with versions.batch():
+            copy.save(force_insert=True)
+        self.assertEqual([('0 v0', False), ('0 v1', True)],
+                         self.versions_of(b))
+
+    def test_nested_batches(self):
+        with versions.batch() as outer:
+            with versions.batch() as inner:
+                self.assertIs(outer, inner)
+                B.objects.create(name='new')
+            self.assertEqual(20, B.objects.count())
+        self.assertEqual(21, B.objects.count())
+
+    def test_many_to_many_relations(self):
+        professors = [Professor.objects.create(name='p%d' % i)
+                      for i in range(3)]
+        student = Student.objects.create(name='v1')
+        student.professors.add(professors[0], professors[1])
+        sleep(0.001)
+        t1 = get_utc_now()
+        sleep(0.001)
+
+        with versions.batch():
+            student = student.clone()
+            student.name = 'v2'
+            student.save()
+            student.professors.add(professors[2])
+            student.professors.remove(professors[0])
+            other = Student.objects.create(name='other')
+            other.professors.add(*professors)
+
+        self.assertEqual(['p1', 'p2'], sorted(
+            p.name for p in Student.objects.current.get(
+                identity=student.identity).professors.all()))
+        self.assertEqual(['p0', 'p1'], sorted(
+            p.name for p in Student.objects.as_of(t1).get(
+                identity=student.identity).professors.all()))
+        self.assertEqual(['p0', 'p1', 'p2'], sorted(
+            p.name for p in Student.objects.current.get(
+                name='other').professors.all()))
+        previous = Student.objects.previous_version(student)
+        self.assertEqual(['p0', 'p1'], sorted(
+            p.name for p in previous.professors.all()))
+
+
+class SyncTest(TestCase):
+    def setUp(self):
+        self.bern = City.objects.create(name='Bern')
+        self.basel = City.objects.create(name='Basel')
+        self.yb = Team.objects.create(name='YB', city=self.bern)
+        self.fcb = Team.objects.create(name='FCB', city=self.basel)
+        self.gc = Team.objects.create(name='GC')
+        sleep(0.001)
+
+    def test_sync(self):
+        t1 = get_utc_now()
+        result = Team.objects.sync([
+            {'name': 'YB', 'city_id': self.bern.identity},
+            {'name': 'FCB', 'city_id': None},
+            {'name': 'FCZ', 'city': self.basel},
+        ], key_fields='name')
+
+        self.assertEqual(['FCZ'], [t.name for t in result.created])
+        self.assertEqual(['FCB'], [t.name for t in result.updated])
+        self.assertEqual(['GC'], [t.name for t in result.deleted])
+        self.assertEqual(
+            {'YB': self.bern.identity, 'FCB': None, 'FCZ': self.basel.id},
+            dict(Team.objects.current.values_list('name', 'city_id')))
+        self.assertEqual(
+            ['FCB', 'GC', 'YB'],
+            sorted(Team.objects.as_of(t1).values_list('name', flat=True)))
+
+        fcb = Team.objects.current.get(name='FCB')
+        self.assertEqual(self.fcb.identity, fcb.identity)
+        self.assertIsNone(fcb.city)
+        self.assertEqual(self.yb.version_start_date,
+                         Team.objects.current.get(name='YB')
+                         .version_start_date)
+        self.assertEqual(fcb.version_start_date,
+                         result.created[0].version_birth_date)
+
+    def test_sync_clears_values(self):
+        # All the new values of the column are NULL
+        result = Team.objects.sync([
+            {'name': 'YB', 'city': None},
+            {'name': 'FCB', 'city': None},
+            {'name': 'GC', 'city': None},
+        ], key_fields='name')
+        self.assertEqual(['FCB', 'YB'],
+                         sorted(t.name for t in result.updated))
+        self.assertEqual(
+            {'YB': None, 'FCB': None, 'GC': None},
+            dict(Team.objects.current.values_list('name', 'city_id')))
+        self.assertEqual(5, Team.objects.count())
+
+    def test_sync_queries(self):
+        for i in range(10):
+            B.objects.create(name=str(i))
+        rows = [{'name': str(i)} for i in range(5, 15)]
+        # One SELECT, the savepoint, one INSERT for the created and one
+        # UPDATE for the deleted objects, and the release
+        with self.assertNumQueries(5):
+            result = B.objects.sync(rows, key_fields='name')
+        self.assertEqual((5, 0, 5), tuple(len(objs) for objs in result))
+
+    def test_sync_unchanged(self):
+        result = Team.objects.sync([
+            {'name': 'YB'}, {'name': 'FCB'}, {'name': 'GC'},
+        ], key_fields=['name'])
+        self.assertEqual(([], [], []), result)
+        self.assertEqual(3, Team.objects.count())
+
+    def test_sync_timestamp(self):
+        t1 = get_utc_now()
+        sleep(0.001)
+        Team.objects.sync([{'name': 'YB'}], key_fields='name', timestamp=t1)
+        self.assertEqual(
+            ['YB'], list(Team.objects.as_of(t1).values_list(
+                'name', flat=True)))
+
+    def test_sync_duplicate_keys(self):
+        with self.assertRaises(ValueError):
+            Team.objects.sync([{'name': 'YB'}, {'name': 'YB'}], 'name')
+        with self.assertRaises(ValueError):
+            Team.objects.sync([{'name': 'YB', 'id': '1'}], 'name')
+        self.assertEqual(3, Team.objects.count())
+
+
+class ChangesTest(TestCase):
+    def setUp(self):
+        self.updated = B.objects.create(name='updated')
+        self.deleted = B.objects.create(name='deleted')
+        self.unchanged = B.objects.create(name='unchanged')
+        self.restored = B.objects.create(name='restored')
+        self.restored.delete()
+        sleep(0.001)
+        self.t1 = get_utc_now()
+        sleep(0.001)
+
+        updated = self.updated.clone()
+        updated.name = 'updated v2'
+        updated.save()
+        self.old_updated_id = self.updated.id
+        updated = updated.clone()
+        updated.name = 'updated v3'
+        updated.save()
+        self.deleted.delete()
+        self.created = B.objects.create(name='created')
+        temporary = B.objects.create(name='temporary')
+        temporary.delete()
+        self.restored = B.objects.previous_version(self.restored).restore()
+        sleep(0.001)
+        self.t2 = get_utc_now()
+        sleep(0.001)
+
+        B.objects.create(name='later')
+
+    def test_changes(self):
+        changes = B.objects.changes(self.t1, self.t2)
+        self.assertEqual(
+            sorted([(self.created.identity, None, self.created.id),
+                    (self.restored.identity, None, self.restored.id)]),
+            sorted(c[1:] for c in changes.created))
+        self.assertEqual(
+            [('updated', self.updated.identity, self.old_updated_id,
+              self.updated.identity)],
+            changes.updated)
+        self.assertEqual(
+            [('deleted', self.deleted.identity, self.deleted.id, None)],
+            changes.deleted)
+
+    def test_changes_until_now(self):
+        changes = B.objects.changes(self.t2)
+        self.assertEqual(['later'], [B.objects.get(id=c.new_id).name
+                                     for c in changes.created])
+        self.assertEqual(([], []), (changes.updated, changes.deleted))
+
+    def test_iter_changes(self):
+        changes = list(B.objects.iter_changes(self.t1, self.t2))
+        self.assertEqual(4, len(changes))
+        self.assertEqual(sorted(c.identity for c in changes),
+                         [c.identity for c in changes])
+        self.assertEqual([], list(B.objects.iter_changes(self.t2, self.t2)))
+        with self.assertRaises(ValueError):
+            list(B.objects.iter_changes(self.t2, self.t1))
+
+
+@override_settings(VERSIONS_EVENT_LOG=True)
+class VersionEventLogTest(TestCase):
+    def events(self):
+        return [(e.kind, e.model, e.identity, e.old_id, e.new_id,
+                 e.related_id) for e in VersionEvent.objects.order_by('id')]
+
+    def test_object_events(self):
+        b = B.objects.create(name='v1')
+        v1 = b.clone()
+        v1.name = 'v2'
+        v1.save()
+        v1 = B.objects.previous_version(v1)
+        B.objects.current.get(identity=b.identity).delete()
+        restored = v1.restore()
+
+        identity = uuid.UUID(str(b.identity))
+        self.assertEqual([
+            ('created', 'versions_tests.b', identity, None, identity, None),
+            ('cloned', 'versions_tests.b', identity, uuid.UUID(str(b.id)),
+             identity, None),
+            ('deleted', 'versions_tests.b', identity, identity, None, None),
+            ('restored', 'versions_tests.b', identity, uuid.UUID(str(v1.id)),
+             uuid.UUID(str(restored.id)), None),
+        ], self.events())
+        self.assertEqual(b.version_end_date,
+                         VersionEvent.objects.get(kind='cloned').timestamp)
+
+    def test_relation_events(self):
+        professor = Professor.objects.create(name='p')
+        student = Student.objects.create(name='s')
+        student.professors.add(professor)
+        student.professors.add(professor)
+        professor.students.remove(student)
+        VersionEvent.objects.filter(kind='created').delete()
+
+        link = ('versions_tests.student_professors',
+                uuid.UUID(str(student.identity)), None, None,
+                uuid.UUID(str(professor.identity)))
+        self.assertEqual([('linked',) + link, ('unlinked',) + link],
+                         self.events())
+
+    def test_add_queries(self):
+        professor = Professor.objects.create(name='p')
+        student = Student.objects.create(name='s')
+        # Finding the existing entries, inserting the new ones and their
+        # events
+        with self.assertNumQueries(3):
+            student.professors.add(professor)
+
+    def test_batch_events(self):
+        professor = Professor.objects.create(name='p')
+        student = Student.objects.create(name='s')
+        VersionEvent.objects.all().delete()
+        with versions.batch() as batch:
+            student = student.clone()
+            student.professors.add(professor)
+            B.objects.create(name='b')
+        self.assertEqual(['created', 'cloned', 'linked'],
+                         [e[0] for e in self.events()])
+        self.assertEqual(
+            set([batch.timestamp]),
+            set(VersionEvent.objects.values_list('timestamp', flat=True)))
+
+    @override_settings(VERSIONS_EVENT_LOG=False)
+    def test_disabled(self):
+        b = B.objects.create(name='v1')
+        b.clone().delete()
+        self.assertEqual(0, VersionEvent.objects.count())
+
+    def test_tail(self):
+        for i in range(5):
+            B.objects.create(name=str(i))
+        first = VersionEvent.objects.order_by('id').first().id
+        batches = list(VersionEvent.objects.tail(after=first,
+                                                 batch_size=3))
+        self.assertEqual([3, 1], [len(events) for events in batches])
+        self.assertEqual(
+            ['1', '2', '3', '4'],
+            [B.objects.get(id=e.new_id).name
+             for events in batches for e in events])
+        self.assertEqual([], VersionEvent.objects.read(
+            after=batches[-1][-1].id))
+
+
+@override_settings(VERSIONS_EVENT_LOG=True)
+class VersionEventAtomicityTest(TransactionTestCase):
+    """
+    The changes are rolled back together with their events if the events
+    can not be written.
+    """
+    def setUp(self):
+        self.professor = Professor.objects.create(name='p')
+        self.student = Student.objects.create(name='s')
+
+    def assertRolledBack(self, change):
+        def failing_log_version_events(events, using=None):
+            raise IntegrityError('event log unavailable')
+
+        backup = versions.models.log_version_events
+        versions.models.log_version_events = failing_log_version_events
+        try:
+            with self.assertRaises(IntegrityError):
+                change()
+        finally:
+            versions.models.log_version_events = backup
+
+    def test_clone(self):
+        self.assertRolledBack(self.student.clone)
+        self.assertEqual(1, Student.objects.filter(
+            identity=self.student.identity).count())
+
+    def test_add(self):
+        self.assertRolledBack(
+            lambda: self.student.professors.add(self.professor))
+        self.assertEqual(0, self.student.professors.through.objects.count())
+
+    def test_batch(self):
+        def change():
+            with versions.batch():
+                student = self.student.clone()
+                student.name = 's2'
+                student.save()
+                student.professors.add(self.professor)
+                Student.objects.create(name='s3')
+
+        self.assertRolledBack(change)
+        self.assertEqual(['s'], [s.name for s in Student.objects.all()])
+        self.assertEqual(0, self.student.professors.through.objects.count())
+
+    def test_remove(self):
+        self.student.professors.add(self.professor)
+        self.assertRolledBack(
+            lambda: self.student.professors.remove_at(get_utc_now(),
+                                                      self.professor))
+        self.assertEqual([None], [
+            link.version_end_date
+            for link in self.student.professors.through.objects.all()])
+
+
+class DiffTest(TestCase):
+    def setUp(self):
+        self.bern = City.objects.create(name='Bern')
+        self.renamed = Team.objects.create(name='YB', city=self.bern)
+        self.moved = Team.objects.create(name='FCB', city=self.bern)
+        self.unchanged = Team.objects.create(name='GC')
+        self.cloned = Team.objects.create(name='FCZ')
+        self.removed = Team.objects.create(name='FCSG')
+        sleep(0.001)
+        self.t1 = get_utc_now()
+        sleep(0.001)
+
+        renamed = self.renamed.clone()
+        renamed.name = 'Young Boys'
+        renamed.save()
+        moved = self.moved.clone()
+        moved.city = None
+        moved.save()
+        self.cloned.clone()
+        self.removed.delete()
+        self.added = Team.objects.create(name='Servette')
+        sleep(0.001)
+        self.t2 = get_utc_now()
+
+    def test_diff(self):
+        differences = sorted(Team.objects.diff(self.t1, self.t2),
+                             key=lambda d: (d.kind, d.changed_fields))
+        self.assertEqual([
+            ('added', self.added.identity, None, self.added.id, []),
+            ('changed', self.moved.identity, self.moved.id,
+             self.moved.identity, ['city']),
+            ('changed', self.renamed.identity, self.renamed.id,
+             self.renamed.identity, ['name']),
+            ('removed', self.removed.identity, self.removed.id, None, []),
+        ], [tuple(d[:4]) + (d.changed_fields,) for d in differences])
+
+    def test_diff_fields(self):
+        differences = list(Team.objects.diff(self.t1, self.t2,
+                                             fields=['name']))
+        self.assertEqual(['added', 'changed', 'removed'],
+                         sorted(d.kind for d in differences))
+        self.assertEqual([self.renamed.identity],
+                         [d.identity for d in differences
+                          if d.kind == 'changed'])
+
+    def test_diff_same_time(self):
+        self.assertEqual([], list(Team.objects.diff(self.t2, self.t2)))
+
+
+class WithChangesTest(TestCase):
+    def setUp(self):
+        self.bern = City.objects.create(name='Bern')
+        team = Team.objects.create(name='YB')
+        team = team.clone()
+        team.city = self.bern
+        team.save()
+        team = team.clone()
+        team.save()
+        team = team.clone()
+        team.name = 'Young Boys'
+        team.city = None
+        team.save()
+        self.team = team
+        Team.objects.create(name='FCB')
+
+    def test_with_changes(self):
+        with self.assertNumQueries(1):
+            versions = list(Team.objects.filter(
+                identity=self.team.identity).with_changes().order_by(
+                'version_start_date'))
+        self.assertEqual([[], ['city'], [], ['name', 'city']],
+                         [v.changed_fields for v in versions])
+
+    def test_with_changes_fields(self):
+        versions = Team.objects.with_changes(fields=['name']).filter(
+            identity=self.team.identity).order_by('version_start_date')
+        self.assertEqual([[], [], [], ['name']],
+                         [v.changed_fields for v in versions])
+
+    def test_with_changes_slice(self):
+        versions = Team.objects.with_changes().filter(
+            identity=self.team.identity).order_by('-version_start_date')[:2]
+        self.assertEqual([['name', 'city'], []],
+                         [v.changed_fields for v in versions])
+
+    def test_with_changes_count(self):
+        versions = Team.objects.filter(
+            identity=self.team.identity).with_changes()
+        self.assertEqual(4, versions.count())
+        self.assertEqual({'count': 4}, versions.aggregate(count=Count('id')))
+        self.assertTrue(versions.exists())
+
+    def test_with_changes_paginator(self):
+        paginator = Paginator(Team.objects.filter(
+            identity=self.team.identity).with_changes().order_by(
+            'version_start_date'), 3)
+        self.assertEqual(4, paginator.count)
+        self.assertEqual([[], ['city'], []],
+                         [v.changed_fields for v in paginator.page(1)])
+        self.assertEqual([['name', 'city']],
+                         [v.changed_fields for v in paginator.page(2)])
+
+    def test_with_changes_filter(self):
+        versions = Team.objects.with_changes()
+        with self.assertRaises(NotSupportedError):
+            versions.filter(_changed_name=1)
+        with self.assertRaises(NotSupportedError):
+            versions.exclude(Q(_changed_city=0))
+        with self.assertRaises(NotSupportedError):
+            versions.aggregate(Sum('_changed_name'))
+
+    def test_without_changes(self):
+        self.assertIsNone(Team.objects.current.get(
+            identity=self.team.identity).changed_fields)
+
+
+class CountSeriesTest(TestCase):
+    def setUp(self):
+        self.t0 = get_utc_now()
+        sleep(0.001)
+        self.team_a = Team.objects.create(name='a')
+        self.team_b = Team.objects.create(name='b')
+        p1 = Player.objects.create(name='p1', team=self.team_a)
+        p2 = Player.objects.create(name='p2', team=self.team_a)
+        self.t1 = get_utc_now()
+        sleep(0.001)
+        p1 = p1.clone()
+        p1.team = self.team_b
+        p1.save()
+        p2.delete()
+        Player.objects.create(name='p3', team=None)
+        self.t2 = get_utc_now()
+
+    def test_count_series(self):
+        timestamps = [self.t0, self.t1, self.t2, self.t1]
+        with self.assertNumQueries(1):
+            counts = Player.objects.count_series(timestamps)
+        self.assertEqual([0, 2, 2, 2], counts)
+        self.assertEqual(
+            [Player.objects.as_of(t).count() for t in timestamps], counts)
+
+    def test_count_series_filtered(self):
+        self.assertEqual([0, 1, 0], Player.objects.filter(
+            name='p2').count_series([self.t0, self.t1, self.t2]))
+        self.assertEqual([0, 1, 1], Player.objects.as_of(self.t0).filter(
+            name='p1').count_series([self.t0, self.t1, self.t2]))
+
+    def test_count_series_by_field(self):
+        with self.assertNumQueries(1):
+            counts = Player.objects.count_series(
+                [self.t0, self.t1, self.t2], field='team')
+        self.assertEqual({self.team_a.identity: [0, 2, 0],
+                          self.team_b.identity: [0, 0, 1],
+                          None: [0, 0, 1]}, dict(counts))
+
+    def test_count_series_batches(self):
+        counts = Player.objects.count_series([self.t0, self.t1] * 600)
+        self.assertEqual([0, 2] * 600, counts)
+
+    @skipUnless(connection.vendor == 'sqlite',
+                'SQLite-specific parameter limit')
+    def test_count_series_batches_large_filter(self):
+        # 999 parameters per query, 700 of which are taken by the filter
+        ids = [uuid.uuid4() for i in range(698)] + list(
+            Player.objects.filter(name='p1').values_list('id', flat=True))
+        with self.assertNumQueries(3):
+            counts = Player.objects.filter(id__in=ids).count_series(
+                [self.t0, self.t1] * 300)
+        self.assertEqual([0, 1] * 300, counts)
+
+    def test_count_series_empty(self):
+        self.assertEqual([], Player.objects.count_series([]))
+
+    @skipUnless(numpy, 'NumPy is not installed')
+    def test_count_series_array(self):
+        counts = Player.objects.count_series([self.t0, self.t1],
+                                             as_array=True)
+        self.assertEqual([0, 2], counts.tolist())
+        counts = Player.objects.count_series([self.t1], field='team',
+                                             as_array=True)
+        self.assertEqual([2], counts[self.team_a.identity].tolist())
+
+
+@skipUnless(numpy, 'NumPy is not installed')
+class TimeSeriesTest(TestCase):
+    def setUp(self):
+        self.t0 = datetime.datetime(2020, 1, 1, tzinfo=utc)
+        self.day = datetime.timedelta(days=1)
+        self.a = B.objects._create_at(self.t0 + self.day, name='a1')
+        self.a = self.a.clone(forced_version_date=self.t0 + 3 * self.day)
+        self.a.name = 'a2'
+        self.a.save()
+        self.b = B.objects._create_at(self.t0 + 2 * self.day, name='b1')
+        self.b._delete_at(self.t0 + 5 * self.day)
+
+    def test_to_timeseries(self):
+        series = B.objects.all().to_timeseries(
+            'name', self.t0, self.t0 + 6 * self.day, self.day)
+        self.assertEqual([self.t0 + i * self.day for i in range(6)],
+                         series.timestamps)
+        self.assertEqual((2, 6), series.values.shape)
+        rows = dict(zip(series.identities, series.values.tolist()))
+        self.assertEqual([None, 'a1', 'a1', 'a2', 'a2', 'a2'],
+                         rows[self.a.identity])
+        self.assertEqual([None, None, 'b1', 'b1', 'b1', None],
+                         rows[self.b.identity])
+
+    def test_to_timeseries_step(self):
+        with self.assertRaises(ValueError):
+            B.objects.all().to_timeseries(
+                'name', self.t0, self.t0 + self.day, datetime.timedelta(0))
+
+    def test_to_timeseries_period(self):
+        series = B.objects.filter(name__startswith='a').to_timeseries(
+            'name', self.t0 + 3 * self.day, self.t0 + 5 * self.day,
+            datetime.timedelta(hours=12), fill_value='', dtype='U2')
+        self.assertEqual([self.a.identity], series.identities)
+        self.assertEqual([['a2'] * 4], series.values.tolist())
+
+    def test_to_timeseries_empty(self):
+        series = B.objects.all().to_timeseries(
+            'name', self.t0 - 2 * self.day, self.t0, self.day)
+        self.assertEqual([], series.identities)
+        self.assertEqual((0, 2), series.values.shape)
+
+
+class DuringTest(TestCase):
+    def setUp(self):
+        self.t0 = datetime.datetime(2020, 1, 1, tzinfo=utc)
+        self.day = datetime.timedelta(days=1)
+        self.a = B.objects._create_at(self.t0 + self.day, name='a1')
+        self.a = self.a.clone(forced_version_date=self.t0 + 3 * self.day)
+        self.a.name = 'a2'
+        self.a.save()
+        self.b = B.objects._create_at(self.t0 + 2 * self.day, name='b1')
+        self.b._delete_at(self.t0 + 5 * self.day)
+
+    def names(self, start, end):
+        return sorted(b.name for b in B.objects.during(
+            self.t0 + datetime.timedelta(days=start),
+            self.t0 + datetime.timedelta(days=end)))
+
+    def test_during(self):
+        self.assertEqual([], self.names(-1, 0))
+        self.assertEqual(['a1'], self.names(0, 1.5))
+        self.assertEqual(['a1', 'a2', 'b1'], self.names(2.5, 3.5))
+        self.assertEqual(['a2'], self.names(6, 7))
+
+    def test_during_instant(self):
+        t = self.t0 + 3 * self.day
+        self.assertEqual(
+            sorted(b.name for b in B.objects.as_of(t)),
+            sorted(b.name for b in B.objects.during(t, t)))
+
+    def test_during_querytime(self):
+        versions = B.objects.during(self.t0, self.t0 + 6 * self.day)
+        self.assertEqual(3, len(versions))
+        for version in versions:
+            self.assertFalse(version._querytime.active)
+
+    def test_during_joins(self):
+        city = City.objects._create_at(self.t0, name='c1')
+        city = city.clone(forced_version_date=self.t0 + 2 * self.day)
+        city.name = 'c2'
+        city.save()
+        team = Team.objects._create_at(self.t0 + self.day, name='t1',
+                                       city=city)
+        team._delete_at(self.t0 + 3 * self.day)
+
+        def teams(start, end, city_name):
+            return list(Team.objects.during(
+                self.t0 + datetime.timedelta(days=start),
+                self.t0 + datetime.timedelta(days=end)).filter(
+                city__name=city_name).values_list('name', flat=True))
+
+        self.assertEqual(['t1'], teams(1, 2.5, 'c1'))
+        self.assertEqual(['t1'], teams(1, 2.5, 'c2'))
+        self.assertEqual([], teams(2.5, 4, 'c1'))
+        self.assertEqual(['t1'], teams(2.5, 4, 'c2'))
+        self.assertEqual([], teams(4, 5, 'c2'))
+
+    def test_invalid_period(self):
+        with self.assertRaises(ValueError):
+            B.objects.during(self.t0 + self.day, self.t0)
+        with self.assertRaises(ValueError):
+            B.objects.during(None, self.t0)
+
+
+class HistoryIndexTest(TestCase):
+    def setUp(self):
+        self.t0 = datetime.datetime(2020, 1, 1, tzinfo=utc)
+        self.day = datetime.timedelta(days=1)
+        self.city = City.objects._create_at(self.t0, name='c1')
+        self.city = self.city.clone(forced_version_date=self.t0 + 2 * self.day)
+        self.city.name = 'c2'
+        self.city.save()
+        self.team = Team.objects._create_at(self.t0 + self.day, name='t1',
+                                            city=self.city)
+        self.team._delete_at(self.t0 + 3 * self.day)
+        self.index = HistoryIndex(City)
+
+    def test_get(self):
+        with self.assertNumQueries(0):
+            city = self.index.get(self.city.identity, self.t0 + self.day)
+            self.assertEqual('c1', city.name)
+            self.assertEqual(self.t0 + self.day, city.as_of)
+            self.assertEqual('c2', self.index.get(self.city.identity).name)
+            self.assertEqual('c2', self.index.get(
+                self.city.identity, self.t0 + 2 * self.day).name)
+            with self.assertRaises(City.DoesNotExist):
+                self.index.get(self.city.identity, self.t0 - self.day)
+            with self.assertRaises(City.DoesNotExist):
+                self.index.get(self.team.identity)
+
+    def test_as_of(self):
+        index = HistoryIndex(Team)
+        self.assertEqual([], index.as_of(self.t0))
+        self.assertEqual(['t1'], [team.name for team in
+                                  index.as_of(self.t0 + 2 * self.day)])
+        self.assertEqual([], index.as_of())
+        self.assertEqual(2, len(self.index.versions(self.city.identity)))
+
+    def test_resolve(self):
+        team = Team.objects.as_of(self.t0 + self.day).get(
+            identity=self.team.identity)
+        with self.assertNumQueries(0):
+            self.assertEqual('c1', self.index.resolve(team, 'city').name)
+            self.assertEqual('c1', team.city.name)
+            self.assertEqual(self.t0 + self.day, team.city.as_of)
+        with self.assertRaises(ValueError):
+            HistoryIndex(Team).resolve(team, 'city')
+
+    def test_queryset(self):
+        index = HistoryIndex(City.objects.as_of(self.t0).filter(name='c2'))
+        self.assertEqual(1, len(index))
+        self.assertIn(self.city.identity, index)
+        self.assertEqual([], index.as_of(self.t0))
+
+
+class SnapshotTest(TestCase):
+    def setUp(self):
+        self.city = City.objects.create(name='c1')
+        self.team = Team.objects.create(name='t1', city=self.city)
+        self.p1 = Player.objects.create(name='p1', team=self.team)
+        self.p2 = Player.objects.create(name='p2', team=self.team)
+        self.award = Award.objects.create(name='a1')
+        self.award.players.add(self.p1)
+        self.t1 = get_utc_now()
+        sleep(0.001)
+        self.city = self.city.clone()
+        self.city.name = 'c2'
+        self.city.save()
+        self.p2.delete()
+        Award.objects.create(name='a2').players.add(self.p1)
+
+    def test_snapshot(self):
+        with self.assertNumQueries(5):
+            teams = versions.snapshot(self.t1, Team.objects.all(),
+                                      follow=['city', 'player_set__awards'])
+        with self.assertNumQueries(0):
+            self.assertEqual(1, len(teams))
+            team = teams[0]
+            self.assertEqual('c1', team.city.name)
+            players = sorted(team.player_set.all(), key=lambda p: p.name)
+            self.assertEqual(['p1', 'p2'], [p.name for p in players])
+            self.assertIs(team, players[0].team)
+            self.assertEqual(['a1'], [a.name for a in players[0].awards.all()])
+            self.assertEqual([], list(players[1].awards.all()))
+            for obj in [team, team.city] + players:
+                self.assertEqual(self.t1, obj.as_of)
+
+    def test_snapshot_current(self):
+        players = versions.snapshot(None, Player.objects.all(),
+                                    follow=['team__city', 'awards__players'])
+        with self.assertNumQueries(0):
+            self.assertEqual(['p1'], [p.name for p in players])
+            self.assertEqual('c2', players[0].team.city.name)
+            awards = players[0].awards.all()
+            self.assertEqual(['a1', 'a2'], sorted(a.name for a in awards))
+            for award in awards:
+                self.assertEqual([players[0]], list(award.players.all()))
+
+    def test_snapshot_loads_objects_once(self):
+        with self.assertNumQueries(2):
+            teams = versions.snapshot(self.t1, Team.objects.all(),
+                                      follow=['player_set__team'])
+        with self.assertNumQueries(0):
+            for player in teams[0].player_set.all():
+                self.assertIs(teams[0], player.team)
+
+    def test_unknown_relation(self):
+        with self.assertRaises(ValueError):
+            versions.snapshot(self.t1, Team.objects.all(), follow=['coach'])
+        with self.assertRaises(ValueError):
+            versions.snapshot(self.t1, Team.objects.all(), follow=['name'])
+
+
+class ManyJoinsTest(TestCase):
+    """
+    Compiles as_of queries joining the versioned many-to-many tables 20
+    times, each join having its own time restriction.
+    """
+
+    def setUp(self):
+        self.professor = Professor.objects.create(name='p')
+        self.student = Student.objects.create(name='s')
+        self.student.professors.add(self.professor)
+        self.t1 = get_utc_now()
+        sleep(0.001)
+        self.student.professors.remove(self.professor)
+        self.lookup = '__'.join(['professors__students'] * 5) + '__name'
+
+    def test_restrictions(self):
+        queryset = Student.objects.as_of(self.t1).filter(
+            **{self.lookup: 's'})
+        sql, params = queryset.query.get_compiler(
+            queryset.db).as_sql()
+        self.assertEqual(20, len(re.findall(
+            r'version_start_date <= %s', sql)))
+        self.assertEqual(['s'], [s.name for s in queryset.distinct()])
+        self.assertEqual([], list(Student.objects.current.filter(
+            **{self.lookup: 's'})))
+
+    def test_restriction_per_joined_alias(self):
+        queryset = Student.objects.as_of(self.t1).filter(
+            **{self.lookup: 's'})
+        sql, params = queryset.query.get_compiler(
+            queryset.db).as_sql()
+        joined = [alias for alias, join in queryset.query.alias_map.items()
+                  if join.parent_alias is not None]
+        self.assertEqual(20, len(joined))
+        self.assertEqual(sorted(joined), sorted(re.findall(
+            r'(\w+)\.version_start_date <= %s', sql)))
+
+
+class AggregationQueryTimeTest(TestCase):
+    """
+    Aggregations over versioned relations only count the related versions
+    valid at the query time, also when Django promotes the joins or wraps
+    the query in a subquery.
+    """
+
+    def setUp(self):
+        self.city = City.objects.create(name='c')
+        self.team = Team.objects.create(name='t', city=self.city)
+        self.player = Player.objects.create(name='p', team=self.team)
+        self.professor = Professor.objects.create(name='prof')
+        self.student = Student.objects.create(name='s')
+        self.student.professors.add(self.professor)
+        for i in range(3):
+            self.team = self.team.clone()
+            self.team.save()
+            self.player = self.player.clone()
+            self.player.save()
+            self.student = self.student.clone()
+            self.student.save()
+        self.t1 = get_utc_now()
+        sleep(0.001)
+        Player.objects.create(name='p2', team=self.team)
+
+    def test_foreign_key(self):
+        self.assertEqual([1], list(Team.objects.as_of(self.t1).annotate(
+            n=Count('player')).values_list('n', flat=True)))
+        self.assertEqual([2], list(Team.objects.current.annotate(
+            n=Count('player')).values_list('n', flat=True)))
+        self.assertEqual([1], list(Player.objects.as_of(self.t1).annotate(
+            n=Count('team')).values_list('n', flat=True)))
+        self.assertEqual([1], list(City.objects.as_of(self.t1).annotate(
+            n=Count('team__player')).values_list('n', flat=True)))
+
+    def test_many_to_many(self):
+        self.assertEqual([1], list(Professor.objects.as_of(self.t1).annotate(
+            n=Count('students')).values_list('n', flat=True)))
+        self.assertEqual([1], list(Student.objects.as_of(self.t1).annotate(
+            n=Count('professors')).values_list('n', flat=True)))
+
+    def test_group_by_input_rows(self):
+        # The rows fed to GROUP BY are the joined rows
+        self.assertEqual(1, len(Team.objects.as_of(self.t1).values_list(
+            'id', 'player__id')))
+        self.assertEqual(1, len(Professor.objects.as_of(self.t1).values_list(
+            'id', 'students__id')))
+
+    def test_promoted_join(self):
+        queryset = Team.objects.as_of(self.t1).filter(
+            Q(player__name='p') | Q(name='t')).annotate(n=Count('player'))
+        self.assertIn('LEFT OUTER JOIN', str(queryset.query))
+        self.assertEqual([1], list(queryset.values_list('n', flat=True)))
+
+    def test_aggregation_subquery(self):
+        self.assertEqual({'total': 1}, Team.objects.as_of(self.t1).annotate(
+            n=Count('player')).aggregate(total=Sum('n')))
+        self.assertEqual({'total': 2}, Team.objects.current.annotate(
+            n=Count('player')).aggregate(total=Sum('n')))
+        self.assertEqual({'total': 1}, Professor.objects.as_of(
+            self.t1).annotate(n=Count('students')).aggregate(
+            total=Sum('n')))
+        self.assertEqual(1, Team.objects.as_of(self.t1).annotate(
+            n=Count('player')).filter(n=1).count())
+
+
+class CompiledSQLCacheTest(TestCase):
+    def setUp(self):
+        self.b = B.objects.create(name='v1')
+        self.t1 = get_utc_now()
+        sleep(0.001)
+        self.b = self.b.clone()
+        self.b.name = 'v2'
+        self.b.save()
+        B.objects.create(name='other')
+        self.t2 = get_utc_now()
+        clear_compiled_sql_cache()
+
+    def test_restrictions_compiled_once(self):
+        self.assertEqual('v1', B.objects.as_of(self.t1).get().name)
+        self.assertEqual((0, 2, 2), compiled_sql_cache_info())
+        self.assertEqual('v2', B.objects.as_of(self.t2).get(
+            identity=self.b.identity).name)
+        self.assertEqual((2, 2, 2), compiled_sql_cache_info())
+        self.assertEqual(2, B.objects.current.count())
+        self.assertEqual(2, B.objects.current.count())
+        self.assertEqual((3, 3, 3), compiled_sql_cache_info())
+
+    def test_same_sql_as_uncached(self):
+        queryset = B.objects.as_of(self.t1).filter(name='v1')
+        sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+        queryset = B.objects.as_of(self.t2).filter(name='v1')
+        cached_sql, cached_params = queryset.query.get_compiler(
+            queryset.db).as_sql()
+        self.assertEqual(sql, cached_sql)
+        self.assertEqual(len(params), len(cached_params))
+        self.assertEqual([], list(queryset))
+
+    def test_subquery_alias(self):
+        inner = B.objects.as_of(self.t1).values('id')
+        self.assertEqual(['v1'], [
+            b.name for b in B.objects.filter(id__in=inner)])
+        self.assertEqual(['v2'], [
+            b.name for b in B.objects.as_of(self.t2).filter(
+                identity__in=inner.values('identity'))])
+
+    def test_clear(self):
+        B.objects.current.count()
+        clear_compiled_sql_cache()
+        self.assertEqual((0, 0, 0), compiled_sql_cache_info())
+
+
+class QueryTimeCompilationTest(TestCase):
+    def setUp(self):
+        self.team = Team.objects.create(name='t.v1')
+        Player.objects.create(name='p', team=self.team)
+        self.t1 = get_utc_now()
+        sleep(0.001)
+        self.team = self.team.clone()
+        self.team.name = 't.v2'
+        self.team.save()
+        self.t2 = get_utc_now()
+
+    def test_query_not_changed_by_compiling(self):
+        queryset = Team.objects.as_of(self.t1).filter(name='t.v1')
+        sql = str(queryset.query)
+        self.assertEqual(sql, str(queryset.query))
+        self.assertEqual(1, len(queryset.query.where.children))
+        self.assertEqual(1, queryset.count())
+
+    def test_compiled_queryset_as_of(self):
+        queryset = Team.objects.as_of(self.t1)
+        self.assertEqual(['t.v1'], [t.name for t in queryset])
+        self.assertEqual(['t.v2'], [t.name for t in queryset.as_of(self.t2)])
+        self.assertEqual(['t.v2'], [t.name for t in queryset.as_of()])
+
+    def test_restriction_with_aggregate_filter(self):
+        queryset = Team.objects.as_of(self.t1).annotate(
+            players=Count('player')).filter(players__gt=0)
+        self.assertEqual(['t.v1'], [t.name for t in queryset])
+        self.assertEqual([], list(Team.objects.as_of(self.t2).annotate(
+            players=Count('player')).filter(players__gt=1)))
+
+
+class SubqueryQueryTimeTest(TestCase):
+    def setUp(self):
+        self.team = Team.objects.create(name='t')
+        self.player = Player.objects.create(name='p', team=self.team)
+        self.t1 = get_utc_now()
+        sleep(0.001)
+        self.player.delete()
+        self.t2 = get_utc_now()
+
+    def teams_with_players(self, queryset):
+        return list(queryset.annotate(has_players=Exists(
+            Player.objects.filter(team=OuterRef('identity')))).filter(
+            has_players=True))
+
+    def test_exists(self):
+        self.assertEqual(
+            [self.team], self.teams_with_players(Team.objects.as_of(self.t1)))
+        self.assertEqual(
+            [], self.teams_with_players(Team.objects.as_of(self.t2)))
+        self.assertEqual([], self.teams_with_players(Team.objects.current))
+        # Without query time, all versions are considered
+        self.assertEqual(
+            [self.team], self.teams_with_players(Team.objects.all()))
+
+    def test_in(self):
+        players = Player.objects.values('team_id')
+        self.assertEqual([self.team], list(Team.objects.as_of(self.t1).filter(
+            identity__in=players)))
+        self.assertEqual([], list(Team.objects.as_of(self.t2).filter(
+            identity__in=players)))
+
+    def test_own_query_time(self):
+        players = Player.objects.as_of(self.t1).values('team_id')
+        self.assertEqual([self.team], list(Team.objects.as_of(self.t2).filter(
+            identity__in=players)))
+
+    def test_joins_of_subquery(self):
+        team = self.team.clone()
+        team.name = 'u'
+        team.save()
+        players = Player.objects.filter(team__name='u').values('team_id')
+        self.assertEqual([], list(Team.objects.as_of(self.t1).filter(
+            identity__in=players)))
+        players = Player.objects.filter(team__name='t').values('team_id')
+        self.assertEqual(['t'], [t.name for t in Team.objects.as_of(
+            self.t1).filter(identity__in=players)])
+
+
 class VersionRestoreTest(TestCase):
     def setup_common(self):
         sf = City.objects.create(name="San Francisco")
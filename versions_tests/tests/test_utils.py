@@ -1,11 +1,18 @@
+import datetime
+import uuid
 from unittest import skipUnless
 
-from django.db import IntegrityError
+from django.db import IntegrityError, NotSupportedError
 from django.db import connection
 from django.test import TestCase, TransactionTestCase
 
-from versions.util.postgresql import get_uuid_like_indexes_on_table
-from versions_tests.models import ChainStore, Color
+from versions.models import CompactUUIDField, get_utc_now
+from versions.util.helper import convert_uuid_columns_to_binary
+from versions.util.postgresql import create_version_history_partitions, \
+    current_partition_name, detach_version_history_partitions, \
+    get_uuid_like_indexes_on_table, history_partition_name, \
+    partition_versionable_table
+from versions_tests.models import ChainStore, Color, Paint, Track
 
 
 @skipUnless(connection.vendor == 'postgresql', "Postgresql-specific test")
@@ -106,3 +113,101 @@ class PostgresqlUuidLikeIndexesTest(TestCase):
         # been removed by the post_migrate handler in
         # versions_tests.apps.VersionsTestsConfig.ready.
         self.assertEqual(0, len(get_uuid_like_indexes_on_table(ChainStore)))
+
+
+@skipUnless(connection.vendor == 'postgresql', "Postgresql-specific test")
+class PostgresqlPartitioningTest(TransactionTestCase):
+    def count(self, table_name):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM %s'
+                           % connection.ops.quote_name(table_name))
+            return cursor.fetchone()[0]
+
+    def test_partitioning(self):
+        if connection.pg_version < 110000:
+            self.skipTest('Partitioning requires PostgreSQL 11 or later')
+        terminated = Track.objects.create(name='v1')
+        current = terminated.clone()
+        now = get_utc_now()
+
+        self.assertLessEqual(4, partition_versionable_table(Track))
+        self.assertEqual(0, partition_versionable_table(Track))
+
+        self.assertEqual(1, self.count(current_partition_name(Track)))
+        self.assertEqual(1, self.count(history_partition_name(Track, now)))
+        self.assertEqual(2, Track.objects.count())
+        self.assertEqual(current, Track.objects.current.get())
+
+        # Updates move terminated versions to their history partition
+        current.clone()
+        self.assertEqual(1, self.count(current_partition_name(Track)))
+        self.assertEqual(2, self.count(history_partition_name(Track, now)))
+
+        self.assertEqual(0, create_version_history_partitions(Track))
+        self.assertEqual(1, create_version_history_partitions(
+            Track, months_ahead=4))
+
+        next_month = now + datetime.timedelta(days=31)
+        detached = detach_version_history_partitions(Track, next_month)
+        self.assertIn(history_partition_name(Track, now), detached)
+        self.assertEqual(1, Track.objects.count())
+
+    def test_unsupported_version(self):
+        pg_version = connection.pg_version
+        connection.pg_version = 100000
+        try:
+            with self.assertRaises(NotSupportedError):
+                partition_versionable_table(Track)
+        finally:
+            connection.pg_version = pg_version
+
+
+class CompactUUIDFieldTest(TestCase):
+    def test_round_trip(self):
+        field = CompactUUIDField()
+        value = uuid.uuid4()
+        db_value = field.get_db_prep_value(value, connection)
+        if connection.features.has_native_uuid_field:
+            self.assertEqual(value, db_value)
+        else:
+            self.assertEqual(16, len(bytes(db_value)))
+        self.assertEqual(value,
+                         field.from_db_value(db_value, None, connection, {}))
+
+    def test_to_python(self):
+        field = CompactUUIDField()
+        value = uuid.uuid4()
+        self.assertEqual(value, field.to_python(value.bytes))
+        self.assertEqual(value, field.to_python(str(value)))
+        self.assertEqual(value, field.to_python(value.hex))
+        self.assertIsNone(field.to_python(None))
+
+
+@skipUnless(connection.vendor == 'sqlite', "SQLite-specific test")
+class ConvertUUIDColumnsToBinaryTest(TestCase):
+    def test_convert(self):
+        red = Color.objects.create(name='red')
+        red = red.clone()
+        ChainStore.objects.create(subchain_id=1, city='Bern', name='Bern',
+                                  opening_hours='9-5', door_frame_color=red,
+                                  door_color=red)
+        Paint.objects.create(color=red)
+
+        convert_uuid_columns_to_binary('versions_tests')
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT id, identity FROM versions_tests_color "
+                "WHERE version_end_date IS NULL")
+            row = cursor.fetchone()
+            self.assertEqual(red.id, uuid.UUID(bytes=bytes(row[0])))
+            self.assertEqual(red.identity, uuid.UUID(bytes=bytes(row[1])))
+            cursor.execute(
+                "SELECT typeof(door_color_id), typeof(door_frame_color_id) "
+                "FROM versions_tests_chainstore")
+            self.assertEqual(('blob', 'blob'), cursor.fetchone())
+            cursor.execute("SELECT typeof(color_id) FROM versions_tests_paint")
+            self.assertEqual(('blob',), cursor.fetchone())
+
+        # Converting again does not change anything
+        self.assertEqual(0, convert_uuid_columns_to_binary('versions_tests'))